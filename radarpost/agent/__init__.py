@@ -1,2 +1,4 @@
 from radarpost.agent.plugins import *
-from radarpost.agent.feed import *
\ No newline at end of file
+from radarpost.agent.feed import *
+from radarpost.agent.poller import *
+from radarpost.agent.schedule import *
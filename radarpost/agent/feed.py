@@ -4,82 +4,357 @@ import hashlib
 import logging
 import traceback
 
-from radarpost.feed import FEED_SUBSCRIPTION_TYPE, parse, update_feed_subscription, InvalidFeedError
+from radarpost.feed import FEED_SUBSCRIPTION_TYPE, parse, InvalidFeedError
+from radarpost.feed import plan_feed_update, store_feed_update
 from radarpost import http
-from radarpost.mailbox import Subscription
+from radarpost.mailbox import Message, Subscription, update_subscription_state
 from radarpost import plugins
-from radarpost.agent.plugins import SUBSCRIPTION_UPDATE_HANDLER
+from radarpost.agent.plugins import SUBSCRIPTION_UPDATE_HANDLER, SUBSCRIPTION_PLANNER
+from radarpost.agent.poller import PollJob, current_poll
+from radarpost.agent.schedule import schedule_delta
 
 log = logging.getLogger(__name__)
 
-def poll_feed(mb, sub, client, force=False):
+def poll_feed(mb, sub, client, force=False, config=None):
     """
     poll a single feed in a single mailbox.
+    returns the number of new items.
     
     mb - the mailbox to update 
     sub - the subscription document in the mailbox
-    client - an http client (httplib2)
+    client - an http client (httplib2) or http.PollingSession
     force - if true, try to update even if a previously 
             encountered result is fetched.
+    config - used to schedule the next poll.
     """
-    log.info("polling %s" % sub.url)
-    did_update, status, count = _try_poll_feed(mb, sub, client, force)
+    status, count = poll_feed_url(sub.url, [(mb, sub)], client, 
+                                  force=force, config=config)[0]
+    return count
 
-    if did_update:
-        log.info("feed %s => created %d new items" % (sub.url, count))
-        return
+def poll_feed_url(url, subscribers, client, force=False, config=None, 
+                  pipeline=None, writer=None):
+    """
+    poll a feed once on behalf of any number of subscriptions 
+    to it. The feed is fetched and parsed once and the result
+    is used to update each subscription.
 
-    # no update performed, update the subscription info to 
-    # indicate that we tried...
-    now = datetime.utcnow()
-    while(sub.last_update is None or sub.last_update < now):
-        try:
-            sub.status = status
-            sub.last_update = now
-            sub.store(mb)
-            break
-        except ResourceConflict:
-            # oops changed since we started, reload it.
-            try:
-                subscription = mailbox[subscription.id]
-            except ResourceNotFound:
-                # deleted from underneath us, bail out.
-                break
-    return 0
-
-def _try_poll_feed(mb, sub, client, force):
+    url - the url of the feed
+    subscribers - list of (mailbox, subscription) pairs 
+                  subscribed to the feed.
+    client - an http client (httplib2) or http.PollingSession
+    force - if true, try to update even if a previously 
+            encountered result is fetched.
+    config - used to schedule the next poll.
+    pipeline - if given (an agent.pipeline.IngestPipeline) 
+               changed feeds are handed to it to be parsed 
+               and stored.
+    writer - if given (an agent.writer.FeedUpdateWriter) 
+             updates are stored by it.
+
+    returns a list of (status, new item count) corresponding 
+    to subscribers.  The result is None for subscribers handed 
+    to the pipeline or writer, they report them to their 
+    on_result callback instead.
+    """
+    log.info("polling %s" % url)
     try:
         # fetch the feed
-        headers = {'Connection': 'close'}
-        response, content = client.request(sub.url, headers=headers)
-        log.info("feed %s => status %d" % (sub.url, response.status))
-        if response.status != 200:
-            return False, Subscription.STATUS_ERROR, 0
-
-        # try to reject update based on content digest...
-        digest = hashlib.md5()
-        digest.update(content)
-        digest = digest.hexdigest()
-        
+        headers = {}
+        if not force:
+            headers.update(_shared_conditional_headers(subscribers))
+        else:
+            headers['Cache-Control'] = 'no-cache'
+        response, content = client.request(url, headers=headers)
+        log.info("feed %s => status %d" % (url, response.status))
+        # a caching client answers a 304 with what it has cached
+        cached = getattr(response, 'fromcache', False)
+        poll = current_poll()
+        if poll is not None and not cached:
+            poll.stats.record_fetch(len(content))
+    except KeyboardInterrupt:
+        raise
+    except:
+        log.error("feed %s: error fetching feed: %s" % (url, traceback.format_exc()))
+        return _record_all(subscribers, Subscription.STATUS_ERROR, config)
+
+    if response.status == 304 or cached:
+        log.info("feed %s: not modified since last update" % url)
+        # a 304 may carry newer validators, those it 
+        # leaves out are unchanged.
+        validators = dict([(k, v) for k, v in response_validators(response).items()
+                           if v is not None])
+        return _record_all(subscribers, Subscription.STATUS_UNCHANGED, config, 
+                           response, validators)
+    if response.status != 200:
+        return _record_all(subscribers, Subscription.STATUS_ERROR, config, response)
+
+    validators = response_validators(response)
+
+    # try to reject update based on content digest...
+    digest = hashlib.md5()
+    digest.update(content)
+    digest = digest.hexdigest()
+
+    results = {}
+    changed = []
+    for mb, sub in subscribers:
         if digest == sub.last_digest:
             if not force:
-                log.info("mailbox %s <= feed %s: unchanged since last update" % (mb.name, sub.url))
-                return False, Subscription.STATUS_UNCHANGED, 0
+                log.info("mailbox %s <= feed %s: unchanged since last update" % (mb.name, url))
+                delta = schedule_delta(sub, Subscription.STATUS_UNCHANGED, config, 
+                                       response=response)
+                delta.update(validators)
+                results[id(sub)] = _record_status(mb, sub, Subscription.STATUS_UNCHANGED, delta)
+                continue
             else:
-                log.info("mailbox %s <= feed %s unchanged since last update (*forcing update)" % (mb.name, sub.url))
+                log.info("mailbox %s <= feed %s unchanged since last update (*forcing update)" % (mb.name, url))
+        changed.append((mb, sub))
+
+    if len(changed) > 0 and pipeline is not None:
+        def store(ok, updates):
+            if not ok:
+                log.error("feed %s: unexpected error parsing feed: %s" % (url, updates))
+                updates = None
+            elif updates is not None:
+                updates = [_wrap_update(update) for update in updates]
+            results = _store_feed_updates(url, changed, updates, response, 
+                                          digest, validators, config, writer)
+            return [r for r in results if r is not None]
+        payload = [sub.unwrap() for mb, sub in changed]
+        pipeline.submit(prepare_feed_update, (content, url, payload), store)
+        for mb, sub in changed:
+            results[id(sub)] = None
+
+    elif len(changed) > 0:
+        try:
+            # html is only sanitized for entries that are stored
+            feed = parse(content, url, raw=True)
+        except InvalidFeedError:
+            log.error("feed %s: parse error" % url)
+            feed = None
+        except KeyboardInterrupt:
+            raise
+        except:
+            log.error("feed %s: unexpected error parsing feed: %s" % (url, traceback.format_exc()))
+            feed = None
+
+        updates = None
+        if feed is not None:
+            updates = [_plan_update(url, sub, feed) for mb, sub in changed]
+        stored = _store_feed_updates(url, changed, updates, response, 
+                                     digest, validators, config, writer)
+        for (mb, sub), result in zip(changed, stored):
+            results[id(sub)] = result
+
+    return [results[id(sub)] for mb, sub in subscribers]
+
+def _updated_delta(sub, config, response, digest, validators):
+    # the schedule depends on how many new items were found
+    def delta(new_items):
+        d = schedule_delta(sub, Subscription.STATUS_OK, config,
+                           new_items=new_items, response=response)
+        d['last_digest'] = digest
+        d.update(validators)
+        return d
+    return delta
 
-        feed = parse(content, sub.url)
-        count = update_feed_subscription(mb, sub, feed, subscription_delta={'last_digest': digest})
-        return True, Subscription.STATUS_OK, count
+def prepare_feed_update(content, url, subscriptions):
+    """
+    parses the feed content retrieved from url and works 
+    out the update needed for each of the subscriptions 
+    given (as unwrapped documents).  Run in a parse process 
+    by the pipeline, so everything given and returned is 
+    picklable.
 
+    returns a list of (new message documents, current ids), 
+    or None where the update failed, corresponding to 
+    subscriptions or None if the feed could not be parsed.
+    """
+    try:
+        feed = parse(content, url, raw=True)
     except InvalidFeedError:
-        log.error("mailbox %s <= feed %s: parse error" % (mb.name, sub.url))
-        return False, Subscription.STATUS_ERROR, 0
+        log.error("feed %s: parse error" % url)
+        return None
+
+    updates = []
+    for data in subscriptions:
+        sub = Subscription.wrap(data)
+        update = _plan_update(url, sub, feed)
+        if update is not None:
+            new_messages, current_ids = update
+            update = ([message.unwrap() for message in new_messages], current_ids)
+        updates.append(update)
+    return updates
+
+def _wrap_update(update):
+    if update is None:
+        return None
+    docs, current_ids = update
+    return [Message.wrap(doc) for doc in docs], current_ids
+
+def _plan_update(url, sub, feed):
+    try:
+        return plan_feed_update(sub, feed)
     except KeyboardInterrupt:
         raise
     except:
-        log.error("mailbox %s <= feed %s: unexpected error: %s" % (mb.name, sub.url, traceback.format_exc()))
-        return False, Subscription.STATUS_ERROR, 0
+        log.error("feed %s: unexpected error updating subscription %s: %s" % 
+                  (url, sub.id, traceback.format_exc()))
+        return None
+
+def _store_feed_updates(url, subscribers, updates, response, digest, validators, 
+                        config, writer=None):
+    """
+    stores the (new messages, current ids) planned for each 
+    subscriber, or records an error where the update is None.
+    updates may be None if the feed could not be parsed.
+
+    returns a list of (status, new item count) corresponding 
+    to subscribers, or None for those handed to the writer.
+    """
+    results = []
+    for i, (mb, sub) in enumerate(subscribers):
+        update = None
+        if updates is not None:
+            update = updates[i]
+        if update is None:
+            results.append(_record_error(mb, sub, config, response))
+            continue
+
+        new_messages, current_ids = update
+        delta = _updated_delta(sub, config, response, digest, validators)
+        if writer is not None:
+            def stored(count, mb=mb, sub=sub):
+                return _stored_result(url, mb, sub, count, config, response)
+            writer.add(mb, sub, new_messages, current_ids, 
+                       subscription_delta=delta, callback=stored)
+            results.append(None)
+            continue
+
+        try:
+            count = store_feed_update(mb, sub, new_messages, current_ids, 
+                                      subscription_delta=delta)
+        except KeyboardInterrupt:
+            raise
+        except:
+            log.error("mailbox %s <= feed %s: unexpected error: %s" % (mb.name, url, traceback.format_exc()))
+            count = None
+        results.append(_stored_result(url, mb, sub, count, config, response))
+    return results
+
+def _stored_result(url, mb, sub, count, config, response):
+    if count is None:
+        return _record_error(mb, sub, config, response)
+    log.info("mailbox %s <= feed %s: created %d new items" % (mb.name, url, count))
+    return Subscription.STATUS_OK, count
+
+def _record_all(subscribers, status, config, response=None, validators=None):
+    results = []
+    for mb, sub in subscribers:
+        delta = schedule_delta(sub, status, config, response=response)
+        if validators:
+            delta.update(validators)
+        results.append(_record_status(mb, sub, status, delta))
+    return results
+
+def _record_error(mb, sub, config, response=None):
+    delta = schedule_delta(sub, Subscription.STATUS_ERROR, config, response=response)
+    return _record_status(mb, sub, Subscription.STATUS_ERROR, delta)
+
+def _record_status(mb, sub, status, delta=None):
+    """
+    no update performed, update the subscription info to 
+    indicate that we tried...
+    returns (status, 0)
+    """
+    try:
+        state = {'status': status, 'last_update': datetime.utcnow()}
+        if delta is not None:
+            state.update(delta)
+        update_subscription_state(mb, sub, state)
+    except KeyboardInterrupt:
+        raise
+    except:
+        log.error("mailbox %s <= feed %s: error recording status: %s" % (mb.name, sub.url, traceback.format_exc()))
+    return status, 0
+
+def conditional_headers(sub):
+    """
+    produces the headers needed to make a conditional 
+    request for the given subscription based on the 
+    validators recorded during the last fetch.
+    """
+    headers = {}
+    if sub.etag:
+        headers['If-None-Match'] = sub.etag
+    if sub.last_modified:
+        headers['If-Modified-Since'] = sub.last_modified
+    return headers
+
+def _shared_conditional_headers(subscribers):
+    # a conditional request is only made if every subscriber 
+    # was last updated with the same version of the feed, 
+    # otherwise someone may miss out on a 304.
+    headers = None
+    for mb, sub in subscribers:
+        sub_headers = conditional_headers(sub)
+        if headers is not None and sub_headers != headers:
+            return {}
+        headers = sub_headers
+    return headers or {}
+
+def response_validators(response):
+    """
+    produces a subscription delta recording the cache 
+    validators given in an http response.
+    """
+    return {'etag': response.get('etag'),
+            'last_modified': response.get('last-modified')}
+
+class FeedJob(PollJob):
+    """
+    polls a feed url once on behalf of every subscription to it.
+    """
+    def __init__(self, url, subscribers, force=False):
+        self.url = url
+        self.subscribers = subscribers
+        self.force = force
+        self.mailboxes = []
+        for mb, sub in subscribers:
+            if not mb in self.mailboxes:
+                self.mailboxes.append(mb)
+
+    def run(self, poll):
+        for result in poll_feed_url(self.url, self.subscribers, 
+                                    poll.session, force=self.force,
+                                    config=poll.config, pipeline=poll.pipeline,
+                                    writer=poll.writer):
+            if result is None:
+                # recorded by the pipeline or writer
+                continue
+            status, count = result
+            poll.stats.record_poll(error=(status == Subscription.STATUS_ERROR))
+
+@plugins.plugin(SUBSCRIPTION_PLANNER)
+def plan_feed_polls(subscriptions, config):
+    """
+    groups feed subscriptions in all mailboxes by url so 
+    that each feed is fetched and parsed once.
+    """
+    by_url = {}
+    urls = []
+    leftover = []
+    for mb, sub in subscriptions:
+        if sub.subscription_type != FEED_SUBSCRIPTION_TYPE or not sub.url:
+            leftover.append((mb, sub))
+            continue
+        if not sub.url in by_url:
+            by_url[sub.url] = []
+            urls.append(sub.url)
+        by_url[sub.url].append((mb, sub))
+
+    jobs = [FeedJob(url, by_url[url]) for url in urls]
+    return jobs, leftover
 
 @plugins.plugin(SUBSCRIPTION_UPDATE_HANDLER)
 def poll_feed_sub(mb, sub, config):
@@ -87,9 +362,17 @@ def poll_feed_sub(mb, sub, config):
         return False
     
     # sweet, go ahead...
-    client = http.create_client(config)
+    poll = current_poll()
+    if poll is not None:
+        # share connections with the rest of the run
+        poll_feed(mb, sub, poll.session, config=config)
+        return True
+
+    # the subscription keeps the validators, a cached 
+    # response would hide a 304.
+    client = http.create_client(config, cache=False)
     try:
-        poll_feed(mb, sub, client)
+        poll_feed(mb, sub, client, config=config)
     finally:
         http.close_all(client)
     return True
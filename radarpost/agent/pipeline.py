@@ -0,0 +1,258 @@
+import cPickle
+import logging
+import multiprocessing
+from Queue import Queue
+import threading
+import time
+import traceback
+
+from radarpost.threads import join_all, JOIN_INTERVAL
+
+__all__ = ['IngestPipeline', 'StageStats',
+           'DEFAULT_WRITERS', 'DEFAULT_DEPTH_PER_PROCESS', 
+           'DEFAULT_PARSE_TIMEOUT']
+
+log = logging.getLogger(__name__)
+
+DEFAULT_WRITERS = 2
+DEFAULT_DEPTH_PER_PROCESS = 2
+DEFAULT_PARSE_TIMEOUT = 300
+
+class StageStats(object):
+    """
+    thread safe queue depth metrics for a stage of
+    an IngestPipeline.
+
+    depth - number of items currently waiting in or
+            being worked on by the stage.
+    max_depth - the largest depth seen
+    capacity - the most items the stage will hold
+    items - total number of items that entered the stage
+    blocked - total seconds spent waiting for room in the stage
+    """
+
+    def __init__(self, name, capacity):
+        self._lock = threading.Lock()
+        self.name = name
+        self.capacity = capacity
+        self.depth = 0
+        self.max_depth = 0
+        self.items = 0
+        self.blocked = 0.0
+
+    def enter(self, waited=0.0):
+        with self._lock:
+            self.items += 1
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            self.blocked += waited
+
+    def leave(self):
+        with self._lock:
+            self.depth -= 1
+
+    def __str__(self):
+        return ("%s: %d items, max depth %d/%d, blocked %.1fs" %
+                (self.name, self.items, self.max_depth, self.capacity, self.blocked))
+
+def _call(func, args):
+    # runs in a pool process. errors are handed back rather
+    # than raised, there is no error callback for apply_async.
+    # a result that cannot be pickled would fail on the way 
+    # back, so it is checked here too.
+    try:
+        value = func(*args)
+        cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        return True, value
+    except KeyboardInterrupt:
+        raise
+    except:
+        return False, traceback.format_exc()
+
+class _Item(object):
+
+    def __init__(self, store):
+        self.store = store
+        self.started = time.time()
+        self.result = None
+        self.done = False
+
+class IngestPipeline(object):
+    """
+    hands fetched content to a pool of processes for
+    parsing and the parsed results to a pool of writer
+    threads for storing so that fetching, parsing and
+    storing proceed at once and parsing can use every
+    core.
+
+    processes - number of parse processes
+    depth - the most items held by each of the parse and
+            store stages, submit blocks when the parse stage
+            is full and the parse stage holds on to its items
+            while the store stage is full.
+    writers - number of writer threads
+    on_result - called with each (status, count) returned
+                by a store callable.
+    parse_timeout - seconds after which an item still being 
+                    parsed (eg. by a process that died) is 
+                    given up on and handed to its store 
+                    callable as an error.
+    """
+
+    def __init__(self, processes, depth=None, writers=DEFAULT_WRITERS,
+                 on_result=None, parse_timeout=DEFAULT_PARSE_TIMEOUT):
+        processes = max(int(processes), 1)
+        if depth is None:
+            depth = DEFAULT_DEPTH_PER_PROCESS * processes
+        depth = max(int(depth), 1)
+        self.on_result = on_result
+
+        self._parse_stats = StageStats('parse', depth)
+        self._store_stats = StageStats('store', depth)
+        self.stages = [self._parse_stats, self._store_stats]
+
+        self.parse_timeout = parse_timeout
+        # number of items submitted and not yet stored
+        self._pending = 0
+        # items submitted and not yet parsed
+        self._parsing = set()
+        # True once an item has been given up on, the pool 
+        # may never finish it.
+        self._abandoned = False
+        self._closed = False
+        self._idle = threading.Condition()
+        self._parse_slots = threading.Semaphore(depth)
+        self._writes = Queue(depth)
+        self._pool = multiprocessing.Pool(processes)
+        self._writers = []
+        for i in range(max(int(writers), 1)):
+            writer = threading.Thread(target=self._write, name='pipeline-writer-%d' % i)
+            writer.daemon = True
+            writer.start()
+            self._writers.append(writer)
+        self._reaper = threading.Thread(target=self._reap, name='pipeline-reaper')
+        self._reaper.daemon = True
+        self._reaper.start()
+
+    def submit(self, func, args, store):
+        """
+        run func(*args) in a parse process then store(ok, value)
+        in a writer thread. ok is True if func returned value,
+        otherwise value is the formatted traceback of the error.
+        store should return a list of (status, count).
+
+        func must be a module level function and args and its
+        result must be picklable.
+        """
+        started = time.time()
+        self._parse_slots.acquire()
+        self._parse_stats.enter(time.time() - started)
+        item = _Item(store)
+        with self._idle:
+            self._pending += 1
+            self._parsing.add(item)
+
+        def parsed(outcome):
+            # runs in the pool's result handler thread,
+            # blocking here holds up further results.
+            self._parsed(item, outcome)
+        item.result = self._pool.apply_async(_call, (func, args), callback=parsed)
+
+    def _parsed(self, item, outcome):
+        # called once for each item, by whichever of the pool's 
+        # callback and the reaper gets to it first.
+        with self._idle:
+            if item.done:
+                return
+            item.done = True
+            self._parsing.discard(item)
+        started = time.time()
+        self._writes.put((item.store, outcome))
+        self._store_stats.enter(time.time() - started)
+        self._parse_stats.leave()
+        self._parse_slots.release()
+
+    def _reap(self):
+        # the pool only calls back for results it got, anything
+        # that failed on the way (eg. arguments that could not be 
+        # pickled) or was lost with its process is handed on here 
+        # so that its parse slot is not lost too.
+        while True:
+            with self._idle:
+                if self._closed:
+                    return
+                items = list(self._parsing)
+            now = time.time()
+            for item in items:
+                result = item.result
+                if result is not None and result.ready() and not result.successful():
+                    try:
+                        result.get(0)
+                        error = 'unknown error'
+                    except:
+                        error = traceback.format_exc()
+                    self._parsed(item, (False, error))
+                elif now - item.started > self.parse_timeout:
+                    with self._idle:
+                        self._abandoned = True
+                    self._parsed(item, (False, 'gave up parsing after %d seconds' % 
+                                                self.parse_timeout))
+            time.sleep(1.0)
+
+    def _write(self):
+        while True:
+            item = self._writes.get()
+            if item is None:
+                break
+            store, (ok, value) = item
+            try:
+                results = store(ok, value)
+            except:
+                log.error("unexpected error storing parsed content: %s" %
+                          traceback.format_exc())
+                results = []
+            self._store_stats.leave()
+            if self.on_result is not None:
+                for status, count in results:
+                    self.on_result(status, count)
+            with self._idle:
+                self._pending -= 1
+                if self._pending == 0:
+                    self._idle.notify_all()
+
+    def join(self):
+        """
+        wait for everything submitted so far to be stored, 
+        the pipeline is left running.
+        """
+        with self._idle:
+            while self._pending > 0:
+                # as in threads.join_all
+                self._idle.wait(JOIN_INTERVAL)
+
+    def close(self):
+        """
+        wait for everything submitted to be stored and
+        shut down the processes and threads.
+        """
+        self.join()
+        with self._idle:
+            self._closed = True
+            abandoned = self._abandoned
+        if abandoned:
+            # the pool would wait forever for what was given up on.
+            self._pool.terminate()
+        else:
+            self._pool.close()
+            self._pool.join()
+        for writer in self._writers:
+            self._writes.put(None)
+        join_all(self._writers)
+
+    def terminate(self):
+        """
+        stop immediately, abandoning anything not yet stored.
+        """
+        with self._idle:
+            self._closed = True
+        self._pool.terminate()
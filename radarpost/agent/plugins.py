@@ -17,4 +17,33 @@ def update_twizzle(mb, sub, config):
     # contact twizzle.org
     # ...
     return True
-"""
\ No newline at end of file
+"""
+
+SUBSCRIPTION_PLANNER = 'radarpost.agent.plugins.subscription_planner'
+"""
+Register methods that group subscriptions from any number of mailboxes 
+into jobs that are polled together, eg. fetching a feed once on behalf 
+of every mailbox that subscribes to it.
+
+method signature is: 
+plan(subscriptions, config) => (jobs, leftover subscriptions)
+
+subscriptions is a list of (mailbox, subscription) pairs.  Any pairs 
+returned as leftovers are offered to the next planner and finally 
+updated one at a time using the SUBSCRIPTION_UPDATE_HANDLER plugins.
+
+jobs should be radarpost.agent.poller.PollJob instances.
+
+eg: 
+
+@plugin(SUBSCRIPTION_PLANNER)
+def plan_twizzles(subscriptions, config):
+    jobs = []
+    leftover = []
+    for mb, sub in subscriptions:
+        if sub.subscription_type == 'twizzle':
+            jobs.append(TwizzleJob(mb, sub))
+        else:
+            leftover.append((mb, sub))
+    return jobs, leftover
+"""
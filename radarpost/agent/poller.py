@@ -0,0 +1,478 @@
+from collections import deque
+from couchdb.http import ResourceNotFound
+from couchdb.mapping import DateTimeField
+from datetime import datetime
+import logging
+import threading
+import time
+import traceback
+from urlparse import urlparse
+
+from radarpost.agent.pipeline import IngestPipeline
+from radarpost.agent.plugins import SUBSCRIPTION_UPDATE_HANDLER, SUBSCRIPTION_PLANNER
+from radarpost.agent.schedule import is_due
+from radarpost.agent.writer import FeedUpdateWriter, DEFAULT_WRITE_BATCH_SIZE, DEFAULT_WRITE_DELAY
+from radarpost.config import CONFIG_INI_PARSER_PLUGIN, parse_bool
+from radarpost.mailbox import Subscription, MailboxInfo, enforce_retention
+from radarpost.mailbox import has_retention_policy, DEFAULT_RETENTION_BUDGET
+from radarpost import http
+from radarpost import plugins
+from radarpost.threads import join_all
+
+__all__ = ['Poller', 'PollStats', 'PollJob', 'SubscriptionJob', 
+           'current_poll', 'update_subscription',
+           'DEFAULT_CONCURRENCY', 'DEFAULT_PER_HOST']
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 10
+DEFAULT_PER_HOST = 2
+
+_context = threading.local()
+
+def current_poll():
+    """
+    returns the Poller running in the current thread
+    or None if the current thread is not polling.
+    """
+    return getattr(_context, 'poll', None)
+
+def update_subscription(mb, sub, config):
+    """
+    hands the subscription to the first
+    SUBSCRIPTION_UPDATE_HANDLER that accepts it.
+    returns True if the subscription was handled.
+    """
+    for handler in plugins.get(SUBSCRIPTION_UPDATE_HANDLER):
+        if handler(mb, sub, config) == True:
+            return True
+    log.info('%s: no update handler for subscription "%s" of type "%s"' %
+             (mb.name, sub.id, sub.subscription_type))
+    return False
+
+class PollStats(object):
+    """
+    thread safe tally of the work done by a Poller.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = None
+        self.finished = None
+        self.polled = 0
+        self.errors = 0
+        self.fetches = 0
+        self.bytes = 0
+        # agent.pipeline.StageStats when parsing in a pipeline
+        self.stages = []
+
+    def start(self):
+        self.started = time.time()
+
+    def finish(self):
+        self.finished = time.time()
+
+    def record_poll(self, error=False):
+        with self._lock:
+            self.polled += 1
+            if error:
+                self.errors += 1
+
+    def record_fetch(self, nbytes):
+        with self._lock:
+            self.fetches += 1
+            self.bytes += nbytes
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        end = self.finished or time.time()
+        return max(end - self.started, 0.000001)
+
+    @property
+    def feeds_per_second(self):
+        return self.polled / self.elapsed
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / self.elapsed
+
+    def __str__(self):
+        text = ("polled %d subscriptions (%d errors) with %d fetches, "
+                "%d bytes in %.1fs [%.2f feeds/s, %.0f bytes/s]" %
+                (self.polled, self.errors, self.fetches, self.bytes, 
+                 self.elapsed, self.feeds_per_second, self.bytes_per_second))
+        for stage in self.stages:
+            text += " [%s]" % stage
+        return text
+
+class PollJob(object):
+    """
+    A unit of work handed out by a Poller. 
+
+    url - the remote resource that will be fetched, used to 
+          limit the number of requests made to a host at once.
+          may be None.
+    mailboxes - the mailboxes that are updated by the job.
+    subscribers - the (mailbox, subscription) pairs updated 
+                  by the job.
+    """
+    url = None
+    mailboxes = ()
+    subscribers = ()
+
+    def run(self, poll):
+        """
+        perform the update. poll is the Poller running the 
+        job. Errors for individual subscriptions should be 
+        handled and recorded using poll.stats.record_poll
+        """
+        raise NotImplementedError()
+
+class SubscriptionJob(PollJob):
+    """
+    updates a single subscription using a handler, by default 
+    the SUBSCRIPTION_UPDATE_HANDLER plugins.
+    """
+
+    def __init__(self, mb, sub, handler):
+        self.mailbox = mb
+        self.subscription = sub
+        self.handler = handler
+        self.url = getattr(sub, 'url', None)
+        self.mailboxes = [mb]
+        self.subscribers = [(mb, sub)]
+
+    def run(self, poll):
+        mb, sub = self.mailbox, self.subscription
+        try:
+            self.handler(mb, sub)
+            poll.stats.record_poll()
+        except:
+            poll.stats.record_poll(error=True)
+            log.error('%s: error updating subscription "%s" of type "%s": %s' %
+                      (mb.name, sub.id, sub.subscription_type, traceback.format_exc()))
+
+class Poller(object):
+    """
+    Polls the subscriptions of a set of mailboxes using a
+    pool of worker threads.
+
+    concurrency - maximum number of subscriptions polled at once
+    per_host - maximum number of subscriptions polled at once
+               from the same remote host.
+
+    Subscriptions are first grouped into jobs by the 
+    SUBSCRIPTION_PLANNER plugins, anything left over is updated
+    individually by handler (by default the SUBSCRIPTION_UPDATE_HANDLER
+    plugins).  Jobs are handed out round-robin across mailboxes 
+    so that a mailbox with many subscriptions does not starve the
+    others.  An error updating one subscription is logged and
+    does not affect any other subscription.
+
+    If a refresher (mailbox.ViewRefresher) is given, it is 
+    touched for each mailbox updated by a job and flushed at 
+    the end of the run.
+
+    Only subscriptions that are due according to their next_poll 
+    time are polled unless ignore_schedule is given.
+
+    While running, the poller's session is an http.PollingSession 
+    shared by all subscriptions, handlers may find it using 
+    current_poll().session
+
+    parse_processes - if more than 0, jobs that support it hand
+                      fetched content to an agent.pipeline.IngestPipeline 
+                      with this many parse processes (current_poll().pipeline) 
+                      so that the worker threads only fetch.
+    pipeline - an IngestPipeline to use instead of starting one 
+               for the run, it is waited on but left running at 
+               the end of the run so that it can be reused.
+    write_batch_size - if more than 0, jobs that support it store 
+                       updates using an agent.writer.FeedUpdateWriter
+                       (current_poll().writer) that writes up to this 
+                       many documents per request to each mailbox.
+                       by default agent.write_batch_size, written at 
+                       most agent.write_delay seconds later.
+    retention_budget - after each job, at most this many messages 
+                       are deleted from each mailbox updated by the 
+                       job to keep it within the retention policy 
+                       of its MailboxInfo (see mailbox.enforce_retention).
+                       by default agent.retention_budget, 0 disables.
+                       Updates still waiting in the writer are 
+                       covered by a later job or run.
+    """
+
+    def __init__(self, config, concurrency=None, per_host=None, handler=None,
+                 planners=None, ignore_schedule=False, refresher=None,
+                 parse_processes=None, write_batch_size=None,
+                 retention_budget=None, pipeline=None):
+        self.config = config
+        self.ignore_schedule = ignore_schedule
+        self.refresher = refresher
+        if concurrency is None:
+            concurrency = config.get('agent.concurrency', DEFAULT_CONCURRENCY)
+        if per_host is None:
+            per_host = config.get('agent.per_host', DEFAULT_PER_HOST)
+        self.concurrency = max(int(concurrency), 1)
+        self.per_host = max(int(per_host), 1)
+        if parse_processes is None:
+            parse_processes = config.get('agent.parse_processes', 0)
+        self.parse_processes = max(int(parse_processes), 0)
+        if write_batch_size is None:
+            write_batch_size = config.get('agent.write_batch_size', DEFAULT_WRITE_BATCH_SIZE)
+        self.write_batch_size = max(int(write_batch_size), 0)
+        if retention_budget is None:
+            retention_budget = config.get('agent.retention_budget', DEFAULT_RETENTION_BUDGET)
+        self.retention_budget = max(int(retention_budget), 0)
+
+        if handler is None:
+            handler = lambda mb, sub: update_subscription(mb, sub, config)
+        self.handler = handler
+
+        if planners is None:
+            planners = plugins.get(SUBSCRIPTION_PLANNER)
+        self.planners = planners
+
+        self.stats = PollStats()
+        self.session = None
+        self.pipeline = pipeline
+        self._owns_pipeline = False
+        self.writer = None
+        self._cond = threading.Condition()
+        self._queues = deque()
+        self._queue_for = {}
+        self._host_load = {}
+        self._stopped = False
+        self._policy_lock = threading.Lock()
+        self._policies = {}
+
+    def run(self, mailboxes):
+        """
+        poll all subscriptions in the mailboxes given.
+        returns PollStats describing the run.
+        """
+        for job in self.plan(mailboxes):
+            self._enqueue(job)
+
+        if self.pipeline is None and self.parse_processes > 0:
+            # started before any threads so that the 
+            # parse processes are forked from a quiet process.
+            self.pipeline = IngestPipeline(self.parse_processes, 
+                                           depth=self.config.get('agent.pipeline_depth'))
+            self._owns_pipeline = True
+        if self.pipeline is not None:
+            self.pipeline.on_result = self._record_result
+            self.stats.stages = self.pipeline.stages
+        if self.write_batch_size > 0:
+            self.writer = FeedUpdateWriter(self.write_batch_size, 
+                                           self.config.get('agent.write_delay', DEFAULT_WRITE_DELAY),
+                                           on_result=self._record_result)
+
+        self.session = http.PollingSession(self.config, per_host=self.per_host)
+        self.stats.start()
+        workers = []
+        try:
+            for i in range(self.concurrency):
+                worker = threading.Thread(target=self._work, name='poller-%d' % i)
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+
+            join_all(workers)
+            if self._owns_pipeline:
+                self.pipeline.close()
+            elif self.pipeline is not None:
+                self.pipeline.join()
+        except KeyboardInterrupt:
+            self.stop()
+            if self._owns_pipeline:
+                self.pipeline.terminate()
+            raise
+        finally:
+            # what was already fetched is written even 
+            # when interrupted.
+            if self.writer is not None:
+                self.writer.close()
+            self.stats.finish()
+            self.session.close()
+        if self.refresher is not None:
+            self.refresher.flush()
+        return self.stats
+
+    def _record_result(self, status, count):
+        self.stats.record_poll(error=(status == Subscription.STATUS_ERROR))
+
+    def plan(self, mailboxes):
+        """
+        returns the list of jobs needed to poll the given mailboxes
+        """
+        subscriptions = []
+        for mb in mailboxes:
+            try:
+                for sub in self._subscriptions(mb):
+                    subscriptions.append((mb, sub))
+            except:
+                log.error("%s: error listing subscriptions: %s" % 
+                          (mb.name, traceback.format_exc()))
+
+        jobs = []
+        for planner in self.planners:
+            planned, subscriptions = planner(subscriptions, self.config)
+            jobs += planned
+        for mb, sub in subscriptions:
+            jobs.append(SubscriptionJob(mb, sub, self.handler))
+        return jobs
+
+    def _subscriptions(self, mb):
+        if self.ignore_schedule:
+            return Subscription.view(mb, Subscription.by_type, include_docs=True)
+
+        # everything never polled (null) or due by now
+        now = datetime.utcnow()
+        try:
+            return list(Subscription.view(mb, Subscription.by_next_poll, 
+                                          endkey=DateTimeField()._to_json(now), 
+                                          include_docs=True))
+        except ResourceNotFound:
+            log.warning("%s: no schedule view, checking every subscription (sync needed?)" % mb.name)
+        return [sub for sub in Subscription.view(mb, Subscription.by_type, include_docs=True)
+                if is_due(sub, now)]
+
+    def _enqueue(self, job):
+        # a job shared by several mailboxes is queued 
+        # with whichever of them has the least work so far.
+        owner = None
+        for key in [mb.name for mb in job.mailboxes] or [None]:
+            jobs = self._queue_for.get(key)
+            if jobs is None:
+                jobs = deque()
+                self._queue_for[key] = jobs
+                self._queues.append(jobs)
+            if owner is None or len(jobs) < len(owner):
+                owner = jobs
+        owner.append(job)
+
+    def stop(self):
+        """
+        stop handing out new work, subscriptions already
+        being polled are allowed to finish.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def _work(self):
+        _context.poll = self
+        try:
+            while True:
+                task = self._next_task()
+                if task is None:
+                    break
+                job, host = task
+                try:
+                    job.run(self)
+                    self._enforce_retention(job)
+                    if self.refresher is not None:
+                        for mb in job.mailboxes:
+                            self.refresher.touch(mb)
+                except:
+                    log.error("unexpected error running poll job: %s" % 
+                              traceback.format_exc())
+                finally:
+                    self._task_done(host)
+        finally:
+            _context.poll = None
+
+    def _enforce_retention(self, job):
+        if self.retention_budget == 0:
+            return
+        subscription_ids = {}
+        for mb, sub in job.subscribers:
+            subscription_ids.setdefault(mb.name, (mb, []))[1].append(sub.id)
+        for mb, sub_ids in subscription_ids.values():
+            try:
+                info = self._retention_policy(mb)
+                if info is not None:
+                    enforce_retention(mb, info, sub_ids, max_deletes=self.retention_budget)
+            except:
+                log.error("%s: error enforcing retention policy: %s" % 
+                          (mb.name, traceback.format_exc()))
+
+    def _retention_policy(self, mb):
+        # the MailboxInfo of each mailbox is loaded once per 
+        # poller, None if there is no policy to enforce.
+        with self._policy_lock:
+            if mb.name in self._policies:
+                return self._policies[mb.name]
+        info = MailboxInfo.get(mb)
+        if not has_retention_policy(info):
+            info = None
+        with self._policy_lock:
+            self._policies[mb.name] = info
+        return info
+
+    def _next_task(self):
+        with self._cond:
+            while True:
+                if self._stopped:
+                    return None
+                task = self._pick()
+                if task is not None:
+                    return task
+                if len(self._queues) == 0:
+                    return None
+                # everything left is waiting on a busy host.
+                self._cond.wait()
+
+    def _pick(self):
+        """
+        choose the next job to run, rotating through
+        mailboxes and skipping hosts that are at their limit.
+        """
+        for i in range(len(self._queues)):
+            if len(self._queues) == 0:
+                break
+            jobs = self._queues[0]
+            for index, job in enumerate(jobs):
+                host = _job_host(job)
+                if self._host_load.get(host, 0) < self.per_host:
+                    del jobs[index]
+                    if len(jobs) == 0:
+                        self._queues.popleft()
+                    else:
+                        self._queues.rotate(-1)
+                    self._host_load[host] = self._host_load.get(host, 0) + 1
+                    return job, host
+            if len(jobs) == 0:
+                self._queues.popleft()
+            else:
+                self._queues.rotate(-1)
+        return None
+
+    def _task_done(self, host):
+        with self._cond:
+            self._host_load[host] -= 1
+            if self._host_load[host] == 0:
+                del self._host_load[host]
+            self._cond.notify_all()
+
+def _job_host(job):
+    url = job.url
+    if not url:
+        # no known host, limit these as a group
+        return None
+    return urlparse(url)[1].lower()
+
+@plugins.plugin(CONFIG_INI_PARSER_PLUGIN)
+def parse_agent_config(cfg):
+    for key in ['agent.concurrency', 'agent.per_host', 'agent.refresh_threshold',
+                'agent.parse_processes', 'agent.pipeline_depth', 
+                'agent.write_batch_size', 'agent.retention_budget']:
+        if key in cfg:
+            cfg[key] = int(cfg[key])
+    if 'agent.write_delay' in cfg:
+        cfg['agent.write_delay'] = float(cfg['agent.write_delay'])
+    if 'agent.background_refresh' in cfg:
+        cfg['agent.background_refresh'] = parse_bool(cfg['agent.background_refresh'])
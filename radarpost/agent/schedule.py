@@ -0,0 +1,134 @@
+"""
+Decides when a subscription should next be polled.
+
+Each subscription keeps a poll_interval that adapts to how
+often the source actually changes: it shrinks when new items 
+are found and grows while the source is unchanged.  Errors 
+back off exponentially without disturbing the learned 
+interval, and servers may ask for longer intervals using 
+Cache-Control: max-age or Retry-After.
+"""
+from datetime import datetime, timedelta
+from email.utils import parsedate_tz, mktime_tz
+import re
+
+from radarpost.config import CONFIG_INI_PARSER_PLUGIN
+from radarpost.mailbox import Subscription
+from radarpost import plugins
+
+__all__ = ['schedule_delta', 'is_due', 
+           'DEFAULT_INTERVAL', 'MIN_INTERVAL', 'MAX_INTERVAL']
+
+# all intervals are in seconds
+DEFAULT_INTERVAL = 60*60
+MIN_INTERVAL = 5*60
+MAX_INTERVAL = 24*60*60
+
+# interval multipliers applied when new items are / are not found
+SPEEDUP = 0.5
+SLOWDOWN = 1.5
+
+# longest error backoff is MAX_INTERVAL, reached after this many errors
+MAX_ERROR_BACKOFF = 10
+
+def schedule_delta(sub, status, config=None, new_items=0, response=None, now=None):
+    """
+    produces a subscription delta containing poll_interval, 
+    error_count and next_poll given the outcome of a poll.
+
+    sub - the subscription that was polled
+    status - the Subscription.STATUS_* outcome of the poll
+    config - used to find agent.min_interval, agent.max_interval 
+             and agent.default_interval
+    new_items - the number of new items that were found
+    response - the http response received, if any
+    """
+    if config is None:
+        config = {}
+    if now is None:
+        now = datetime.utcnow()
+    min_interval = config.get('agent.min_interval', MIN_INTERVAL)
+    max_interval = config.get('agent.max_interval', MAX_INTERVAL)
+    interval = sub.poll_interval or config.get('agent.default_interval', DEFAULT_INTERVAL)
+    error_count = sub.error_count or 0
+
+    if status == Subscription.STATUS_ERROR:
+        # leave the learned interval alone, just back off.
+        error_count += 1
+        wait = interval * 2**min(error_count, MAX_ERROR_BACKOFF)
+    else:
+        error_count = 0
+        if status == Subscription.STATUS_OK and new_items > 0:
+            interval = interval * SPEEDUP
+        else:
+            interval = interval * SLOWDOWN
+        interval = int(min(max(interval, min_interval), max_interval))
+        wait = interval
+
+    if response is not None:
+        # don't bother asking again before the content expires
+        max_age = cache_max_age(response)
+        if max_age is not None:
+            wait = max(wait, max_age)
+        # or before the server is willing to talk to us
+        retry_after = parse_retry_after(response, now)
+        if retry_after is not None:
+            wait = max(wait, retry_after)
+
+    wait = min(max(wait, min_interval), max_interval)
+    return {'poll_interval': interval,
+            'error_count': error_count,
+            'next_poll': now + timedelta(seconds=wait)}
+
+def is_due(sub, now=None):
+    """
+    True if the subscription should be polled now.
+    """
+    if sub.next_poll is None:
+        return True
+    if now is None:
+        now = datetime.utcnow()
+    return sub.next_poll <= now
+
+MAX_AGE_PAT = re.compile(r'max-age\s*=\s*"?(\d+)"?', re.I)
+def cache_max_age(response):
+    """
+    returns the max-age in seconds given in a Cache-Control
+    header in the response or None
+    """
+    cc = response.get('cache-control')
+    if not cc:
+        return None
+    if 'no-cache' in cc.lower():
+        return None
+    m = MAX_AGE_PAT.search(cc)
+    if m is None:
+        return None
+    return int(m.group(1))
+
+def parse_retry_after(response, now=None):
+    """
+    returns the number of seconds until the time given in 
+    a Retry-After header in the response or None
+    """
+    ra = response.get('retry-after')
+    if not ra:
+        return None
+    ra = ra.strip()
+    if ra.isdigit():
+        return int(ra)
+    date = parsedate_tz(ra)
+    if date is None:
+        return None
+    if now is None:
+        now = datetime.utcnow()
+    then = datetime.utcfromtimestamp(mktime_tz(date))
+    delta = then - now
+    return max(delta.days*86400 + delta.seconds, 0)
+
+@plugins.plugin(CONFIG_INI_PARSER_PLUGIN)
+def parse_schedule_config(cfg):
+    for key in ['agent.min_interval', 'agent.max_interval', 
+                'agent.default_interval', 'agent.tick']:
+        if key in cfg:
+            cfg[key] = int(cfg[key])
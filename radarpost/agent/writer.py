@@ -0,0 +1,220 @@
+from couchdb.http import ResourceConflict
+from datetime import datetime
+import logging
+import threading
+import time
+import traceback
+
+from radarpost.feed import count_new_messages, set_subscription_state, save_subscription_state
+from radarpost.mailbox import Subscription
+from radarpost.threads import join_all
+
+__all__ = ['FeedUpdateWriter', 'DEFAULT_WRITE_BATCH_SIZE', 'DEFAULT_WRITE_DELAY']
+
+log = logging.getLogger(__name__)
+
+DEFAULT_WRITE_BATCH_SIZE = 500
+DEFAULT_WRITE_DELAY = 5.0
+
+class _Update(object):
+
+    def __init__(self, subscription, messages, current_ids, delta, callback):
+        self.subscription = subscription
+        self.messages = messages
+        self.current_ids = current_ids
+        self.delta = delta
+        self.callback = callback
+        self.count = 0
+        self.error = None
+
+class _Pending(object):
+
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+        self.updates = []
+        self.docs = 0
+        self.since = time.time()
+
+class FeedUpdateWriter(object):
+    """
+    coalesces the writes made by feed updates (see
+    feed.store_feed_update) across subscriptions.
+
+    Updates are buffered per mailbox and written in batches,
+    first the new messages of every update in the batch, then
+    the new state of every subscription, each using _bulk_docs
+    requests of at most max_docs documents.  A mailbox's
+    updates are written once they hold max_docs documents
+    (by the thread adding the last of them) or max_delay
+    seconds after the first of them was added (by a
+    background thread).
+
+    on_result - called with each (status, count) returned by
+                the callbacks given to add.
+
+    requests - the number of _bulk_docs requests made so far.
+    """
+
+    def __init__(self, max_docs=DEFAULT_WRITE_BATCH_SIZE,
+                 max_delay=DEFAULT_WRITE_DELAY, on_result=None):
+        self.max_docs = max(int(max_docs), 1)
+        self.max_delay = max_delay
+        self.on_result = on_result
+        self.requests = 0
+
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._closed = False
+        self._flusher = threading.Thread(target=self._flush_expired,
+                                         name='feed-update-writer')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def add(self, mailbox, subscription, new_messages, current_ids,
+            subscription_delta=None, callback=None):
+        """
+        queue an update, the arguments are the same as
+        those of feed.store_feed_update.
+
+        callback - called once the update is written with the
+                   number of new items stored, or None if the
+                   update could not be written. should return
+                   a (status, count) for on_result or None.
+        """
+        update = _Update(subscription, new_messages, current_ids,
+                         subscription_delta, callback)
+        full = None
+        with self._cond:
+            pending = self._pending.get(mailbox.name)
+            if pending is None:
+                pending = _Pending(mailbox)
+                self._pending[mailbox.name] = pending
+                self._cond.notify_all()
+            pending.updates.append(update)
+            # one document for the subscription
+            pending.docs += len(new_messages) + 1
+            if pending.docs >= self.max_docs:
+                full = self._pending.pop(mailbox.name)
+        if full is not None:
+            self._write(full)
+
+    def flush(self):
+        """
+        write everything that is pending
+        """
+        with self._cond:
+            pending = self._pending.values()
+            self._pending = {}
+        for p in pending:
+            self._write(p)
+
+    def close(self):
+        """
+        write everything that is pending and stop the
+        background thread.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        join_all([self._flusher])
+        self.flush()
+
+    def _flush_expired(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        return
+                    now = time.time()
+                    expired = [name for name, p in self._pending.items()
+                               if now - p.since >= self.max_delay]
+                    if expired:
+                        break
+                    if self._pending:
+                        wait = min([p.since for p in self._pending.values()]) + self.max_delay - now
+                    else:
+                        wait = None
+                    self._cond.wait(wait)
+                expired = [self._pending.pop(name) for name in expired]
+            for pending in expired:
+                self._write(pending)
+
+    def _count_request(self):
+        with self._cond:
+            self.requests += 1
+
+    def _write(self, pending):
+        mb = pending.mailbox
+        try:
+            self._write_messages(mb, pending.updates)
+        except:
+            log.error("%s: error writing messages: %s" % (mb.name, traceback.format_exc()))
+            for update in pending.updates:
+                update.error = True
+        try:
+            self._write_subscriptions(mb, [u for u in pending.updates if not u.error])
+        except:
+            log.error("%s: error writing subscriptions: %s" % (mb.name, traceback.format_exc()))
+            for update in pending.updates:
+                update.error = True
+
+        for update in pending.updates:
+            if update.callback is None:
+                continue
+            try:
+                result = update.callback(None if update.error else update.count)
+            except:
+                log.error("%s: error reporting update: %s" % (mb.name, traceback.format_exc()))
+                continue
+            if result is not None and self.on_result is not None:
+                self.on_result(*result)
+
+    def _write_messages(self, mb, updates):
+        docs = []
+        owners = []
+        for update in updates:
+            for message in update.messages:
+                docs.append(message)
+                owners.append(update)
+
+        for start in range(0, len(docs), self.max_docs):
+            batch_owners = owners[start:start + self.max_docs]
+            self._count_request()
+            results = mb.update(docs[start:start + self.max_docs])
+            for result, owner in zip(results, batch_owners):
+                try:
+                    owner.count += count_new_messages([result])
+                except:
+                    log.error("%s: error writing message %s for subscription %s: %s" %
+                              (mb.name, result[1], owner.subscription.id, result[2]))
+                    owner.error = True
+
+    def _write_subscriptions(self, mb, updates):
+        now = datetime.utcnow()
+        changed = []
+        for update in updates:
+            delta = update.delta
+            if callable(delta):
+                delta = delta(update.count)
+            update.delta = delta
+            if set_subscription_state(update.subscription, update.current_ids, now, delta):
+                changed.append(update)
+
+        for start in range(0, len(changed), self.max_docs):
+            batch = changed[start:start + self.max_docs]
+            self._count_request()
+            results = mb.update([u.subscription for u in batch])
+            for (success, doc_id, rev_ex), update in zip(results, batch):
+                if success == True:
+                    update.subscription._data['_rev'] = rev_ex
+                elif isinstance(rev_ex, ResourceConflict):
+                    # changed since we started, reload it and store
+                    # it the slow way.
+                    subscription = Subscription.load(mb, doc_id)
+                    if subscription is not None:
+                        save_subscription_state(mb, subscription, update.current_ids,
+                                                now, update.delta)
+                else:
+                    log.error("%s: error writing subscription %s: %s" %
+                              (mb.name, doc_id, rev_ex))
+                    update.error = True
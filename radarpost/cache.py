@@ -0,0 +1,214 @@
+"""
+Simple size bounded caches.
+
+Both caches map string keys to (metadata, body) pairs where 
+metadata is any picklable object and body is a byte string.
+The metadata of an entry can be fetched without its body.
+"""
+import cPickle as pickle
+from hashlib import md5
+import logging
+import os
+import tempfile
+import threading
+
+__all__ = ['LRUCache', 'DiskCache']
+
+log = logging.getLogger(__name__)
+
+class LRUCache(object):
+    """
+    In-memory cache holding at most max_size bytes of 
+    entry bodies.  The least recently used entries are 
+    discarded first.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = {}
+        self._tick = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        returns (metadata, body) or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._tick += 1
+            entry[2] = self._tick
+            return entry[0], entry[1]
+
+    def get_meta(self, key):
+        """
+        returns the metadata of the entry or None
+        """
+        entry = self.get(key)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def set(self, key, meta, body):
+        if len(body) > self.max_size:
+            return
+        with self._lock:
+            self._remove(key)
+            self._tick += 1
+            self._entries[key] = [meta, body, self._tick]
+            self.size += len(body)
+            if self.size > self.max_size:
+                self._evict()
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self.size = 0
+
+    def _remove(self, key):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old[1])
+
+    def _evict(self):
+        # make some room while we're at it so that 
+        # eviction is not needed on every set.
+        target = self.max_size * 0.9
+        by_use = [(entry[2], key) for key, entry in self._entries.items()]
+        by_use.sort()
+        for tick, key in by_use:
+            if self.size <= target:
+                break
+            self._remove(key)
+
+class DiskCache(object):
+    """
+    Cache stored as files in a directory, shared by any 
+    number of processes.  When the bodies stored exceed 
+    max_size bytes, the least recently used entries 
+    (by file access time) are removed.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._size = self._scan_size()
+
+    def get(self, key):
+        meta = self.get_meta(key)
+        if meta is None:
+            return None
+        try:
+            filename = self._path(key, '.body')
+            f = open(filename, 'rb')
+            try:
+                body = f.read()
+            finally:
+                f.close()
+            os.utime(filename, None)
+            return meta, body
+        except (IOError, OSError):
+            return None
+
+    def get_meta(self, key):
+        try:
+            f = open(self._path(key, '.meta'), 'rb')
+            try:
+                return pickle.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def set(self, key, meta, body):
+        if len(body) > self.max_size:
+            return
+        # an existing entry's body is replaced, not added to.
+        try:
+            old_size = os.path.getsize(self._path(key, '.body'))
+        except OSError:
+            old_size = 0
+        try:
+            # body first, an entry exists once its metadata does.
+            self._write(self._path(key, '.body'), body)
+            self._write(self._path(key, '.meta'), pickle.dumps(meta, 2))
+        except (IOError, OSError):
+            log.error("unable to write cache entry to %s" % self.directory)
+            return
+        with self._lock:
+            self._size += len(body) - old_size
+            if self._size > self.max_size:
+                self._evict()
+
+    def delete(self, key):
+        for ext in ('.meta', '.body'):
+            try:
+                os.remove(self._path(key, ext))
+            except OSError:
+                pass
+
+    def _path(self, key, ext):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.directory, md5(key).hexdigest() + ext)
+
+    def _write(self, filename, data):
+        # write and rename so readers never see a partial file.
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            os.rename(tmp, filename)
+        except:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    def _bodies(self):
+        bodies = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.body'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            # access times may not be kept up to date by the 
+            # filesystem, get() touches entries as well.
+            used = max(st.st_atime, st.st_mtime)
+            bodies.append((used, st.st_size, name[:-len('.body')]))
+        return bodies
+
+    def _scan_size(self):
+        return sum([size for atime, size, name in self._bodies()])
+
+    def _evict(self):
+        # other processes share the directory, so start 
+        # from what is actually there.
+        bodies = self._bodies()
+        bodies.sort()
+        size = sum([b[1] for b in bodies])
+        target = self.max_size * 0.9
+        for atime, body_size, name in bodies:
+            if size <= target:
+                break
+            for ext in ('.meta', '.body'):
+                try:
+                    os.remove(os.path.join(self.directory, name + ext))
+                except OSError:
+                    pass
+            size -= body_size
+        self._size = size
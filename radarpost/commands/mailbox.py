@@ -1,20 +1,24 @@
-from couchdb import Server, ResourceConflict, ResourceNotFound
+from couchdb import ResourceConflict, ResourceNotFound
 from datetime import datetime, timedelta
 import logging
+import threading
 import traceback
-from radarpost.agent import SUBSCRIPTION_UPDATE_HANDLER
+from radarpost.agent import Poller, update_subscription
+from radarpost.agent.pipeline import IngestPipeline
 from radarpost.feed import *
 from radarpost.mailbox import *
 from radarpost.cli import COMMANDLINE_PLUGIN, BasicCommand, InvalidArguments
+from radarpost.couch import get_server
 from radarpost import plugins
-from time import sleep
+from radarpost.threads import join_all
+from time import sleep, time
 
 log = logging.getLogger(__name__)
 
 class MailboxHelper(object):
 
     def _get_mailbox(self, slug):
-        couchdb = Server(self.config['couchdb.address'])
+        couchdb = get_server(self.config)
         prefix = self.config['couchdb.prefix']
 
         name = prefix + slug
@@ -31,11 +35,12 @@ class MailboxHelper(object):
         if get_all == True and slugs and len(slugs) > 0:
             raise InvalidArguments("Cannot specify all and list of mailboxes.")
 
-        couchdb = Server(self.config['couchdb.address'])
+        couchdb = get_server(self.config)
         prefix = self.config['couchdb.prefix']
 
         if get_all:
-            return iter_mailboxes(couchdb, prefix=prefix)
+            return iter_mailboxes(couchdb, prefix=prefix, 
+                                  registry=self._get_registry(couchdb))
         else:
             selected = []
             for slug in slugs:
@@ -45,14 +50,20 @@ class MailboxHelper(object):
                 raise InvalidArguments('You must specify at least one mailbox.')
             return selected
 
+    def _get_registry(self, couchdb):
+        name = self.config.get('couchdb.registry_database')
+        if not name:
+            return None
+        return get_registry(couchdb, name)
+
     def _update_subscription(self, mailbox, sub):
-        for handler in plugins.get(SUBSCRIPTION_UPDATE_HANDLER):
-            if handler(mailbox, sub, self.config) == True:
-                refresh_views(mailbox)
-                return True
-        log.info('%s: no update handler for subscription "%s" of type "%s"' % 
-                 (mb.name, sub.id, sub.subscription_type))
-        return False
+        return update_subscription(mailbox, sub, self.config)
+
+    def _get_view_refresher(self, background=None):
+        threshold = self.config.get('agent.refresh_threshold', DEFAULT_REFRESH_THRESHOLD)
+        if background is None:
+            background = self.config.get('agent.background_refresh', False)
+        return ViewRefresher(threshold=threshold, background=background)
         
     def _reset_subscription(self, mailbox, sub):
         log.info("Resetting subscription %s / %s" % (mailbox.name, sub.id))
@@ -80,25 +91,102 @@ class UpdateSubscriptionsCommand(MailboxesCommand):
     command_name = 'update'
     description = 'update all subscriptions in a set of mailboxes'
 
-    def __call__(self, mailboxes=None, update_all=False):
+    @classmethod
+    def setup_options(cls, parser):
+        super(UpdateSubscriptionsCommand, cls).setup_options(parser)
+        parser.add_option('--concurrency', type="int", dest="concurrency", 
+                          help="maximum number of subscriptions to poll at once")
+        parser.add_option('--per-host', type="int", dest="per_host", 
+                          help="maximum number of subscriptions to poll at once from a single host")
+        parser.add_option('--ignore-schedule', action='store_true', dest="ignore_schedule", default=False, 
+                          help="poll all subscriptions, not just those that are due")
+
+    def __call__(self, mailboxes=None, update_all=False, concurrency=None, per_host=None,
+                 ignore_schedule=False):
         """
-        update all subscriptions in the given list of mailboxes.
+        update all subscriptions that are due in the given list of mailboxes.
         mailboxes - list of mailboxes to update (slugs)
         update_all - update all mailboxes
+        concurrency - maximum number of subscriptions to poll at once
+        per_host - maximum number of subscriptions to poll at once from a single host
+        ignore_schedule - update all subscriptions, even if they are not due
         """
-        for mb in self._get_mailboxes(mailboxes, get_all=update_all):
-            for sub in Subscription.view(mb, Subscription.by_type, include_docs=True):
-                try:
-                    self._update_subscription(mb, sub)
-                except KeyboardInterrupt: 
-                    log.error("Exiting at user request...")
-                    return
-                except: 
-                    log.error('%s: error updating subscription "%s" of type "%s": %s' % 
-                        (mb.name, sub.id, sub.subscription_type, traceback.format_exc()))
+        refresher = self._get_view_refresher()
+        poller = Poller(self.config, concurrency=concurrency, per_host=per_host,
+                        handler=self._update_subscription, 
+                        ignore_schedule=ignore_schedule,
+                        refresher=refresher)
+        try:
+            stats = poller.run(self._get_mailboxes(mailboxes, get_all=update_all))
+            refresher.join()
+        except KeyboardInterrupt: 
+            log.error("Exiting at user request...")
+            return
+        print "Finished update: %s" % stats
 
 plugins.register(UpdateSubscriptionsCommand, COMMANDLINE_PLUGIN)
 
+DEFAULT_AGENT_TICK = 60
+
+class AgentCommand(BasicCommand, MailboxHelper):
+
+    command_name = 'agent'
+    description = 'continuously update subscriptions in all mailboxes as they become due'
+
+    @classmethod
+    def setup_options(cls, parser):
+        parser.set_usage(r"%prog " + "%s [options]" % cls.command_name)
+        parser.add_option('--tick', type="int", dest="tick", 
+                          help="seconds between checks for subscriptions that are due")
+        parser.add_option('--concurrency', type="int", dest="concurrency", 
+                          help="maximum number of subscriptions to poll at once")
+        parser.add_option('--per-host', type="int", dest="per_host", 
+                          help="maximum number of subscriptions to poll at once from a single host")
+
+    def __call__(self, tick=None, concurrency=None, per_host=None):
+        """
+        poll due subscriptions in all mailboxes until interrupted.
+        tick - seconds between checks for subscriptions that are due
+        concurrency - maximum number of subscriptions to poll at once
+        per_host - maximum number of subscriptions to poll at once from a single host
+        """
+        if tick is None:
+            tick = self.config.get('agent.tick', DEFAULT_AGENT_TICK)
+
+        log.info("Starting agent, checking for updates every %d seconds" % tick)
+        # the parse processes are forked once, before any 
+        # threads are started, and reused by every round.
+        pipeline = None
+        parse_processes = self.config.get('agent.parse_processes', 0)
+        if parse_processes > 0:
+            pipeline = IngestPipeline(parse_processes, 
+                                      depth=self.config.get('agent.pipeline_depth'))
+        # views are warmed in the background so that 
+        # they never hold up the next round of polling.
+        refresher = self._get_view_refresher(background=True)
+        try:
+            while True:
+                started = time()
+                try:
+                    # mailboxes are listed each time around to 
+                    # pick up any that were created or removed.
+                    poller = Poller(self.config, concurrency=concurrency, per_host=per_host,
+                                    handler=self._update_subscription,
+                                    refresher=refresher, pipeline=pipeline)
+                    stats = poller.run(self._get_mailboxes(get_all=True))
+                    if stats.polled > 0:
+                        log.info("Finished update: %s" % stats)
+                except KeyboardInterrupt:
+                    raise
+                except:
+                    log.error("Error running update: %s" % traceback.format_exc())
+                sleep(max(tick - (time() - started), 0))
+        except KeyboardInterrupt:
+            log.error("Exiting at user request...")
+            if pipeline is not None:
+                pipeline.terminate()
+plugins.register(AgentCommand, COMMANDLINE_PLUGIN)
+
 class ResetSubscriptionsCommand(MailboxesCommand):
 
     command_name = 'reset'
@@ -123,6 +211,8 @@ class ResetSubscriptionsCommand(MailboxesCommand):
 
 plugins.register(ResetSubscriptionsCommand, COMMANDLINE_PLUGIN)
 
+DEFAULT_SYNC_CONCURRENCY = 4
+
 class SyncCommand(MailboxesCommand):
     
     command_name = 'sync'
@@ -132,19 +222,79 @@ class SyncCommand(MailboxesCommand):
     def setup_options(cls, parser):
         super(SyncCommand, cls).setup_options(parser)
         parser.add_option('--refresh', action='store_true', dest="refresh", default=False, help="refresh views after sync")
-
-    def __call__(self, mailboxes=None, update_all=False, refresh=False):
-        for mb in self._get_mailboxes(mailboxes, get_all=update_all):
-            try:
-                log.info("Syncing mailbox %s" % mb.name)
-                sync_mailbox(mb)
-                if refresh:
-                    refresh_views(mb)
-            except:
-                log.error("Error syncing mailbox %s: %s" % (mb.name, traceback.format_exc()))
+        parser.add_option('--no-stage', action='store_false', dest="stage", default=True, 
+                          help="write changed design docs without building their views first")
+        parser.add_option('--concurrency', type="int", dest="concurrency", 
+                          help="maximum number of mailboxes to sync at once (default %d)" % 
+                                DEFAULT_SYNC_CONCURRENCY)
+
+    def __call__(self, mailboxes=None, update_all=False, refresh=False, stage=True, 
+                 concurrency=None):
+        """
+        update the design docs of mailboxes, several at once.
+        mailboxes - list of mailboxes to sync (by slug)
+        update_all - sync all mailboxes
+        refresh - refresh views after sync
+        stage - build the views of changed design docs before 
+                they are deployed (see mailbox.sync_mailbox)
+        concurrency - maximum number of mailboxes to sync at once
+        """
+        if concurrency is None:
+            concurrency = DEFAULT_SYNC_CONCURRENCY
+        registry = self._get_registry(get_server(self.config))
+        lock = threading.Lock()
+        todo = iter(self._get_mailboxes(mailboxes, get_all=update_all))
+
+        def sync():
+            while True:
+                with lock:
+                    try:
+                        mb = todo.next()
+                    except StopIteration:
+                        return
+                try:
+                    log.info("Syncing mailbox %s" % mb.name)
+                    changed = sync_mailbox(mb, stage=stage)
+                    for ddid in changed:
+                        log.info("Updated %s in mailbox %s" % (ddid, mb.name))
+                    if registry is not None:
+                        register_mailbox(registry, mb)
+                    if refresh:
+                        refresh_views(mb)
+                except:
+                    log.error("Error syncing mailbox %s: %s" % (mb.name, traceback.format_exc()))
+
+        workers = []
+        for i in range(max(concurrency, 1)):
+            worker = threading.Thread(target=sync, name='sync-%d' % i)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        try:
+            join_all(workers)
+        except KeyboardInterrupt: 
+            log.error("Exiting at user request...")
 
 plugins.register(SyncCommand, COMMANDLINE_PLUGIN)
 
+class RebuildRegistryCommand(BasicCommand, MailboxHelper):
+
+    command_name = 'rebuild_registry'
+    description = 'rebuild the registry of mailboxes by examining every database'
+
+    def __call__(self):
+        """
+        find all mailboxes on the server and record them in 
+        the configured mailbox registry.
+        """
+        couchdb = get_server(self.config)
+        registry = self._get_registry(couchdb)
+        if registry is None:
+            raise InvalidArguments("No mailbox registry is configured (couchdb.registry_database)")
+        count = rebuild_registry(couchdb, registry, prefix=self.config['couchdb.prefix'])
+        print "Registered %d mailboxes in %s" % (count, registry.name)
+plugins.register(RebuildRegistryCommand, COMMANDLINE_PLUGIN)
+
 
 
 class TrimCommand(MailboxesCommand):
@@ -173,46 +323,118 @@ class TrimCommand(MailboxesCommand):
             print "Deleted %d items from %s" % (deletes, mb.name)
 plugins.register(TrimCommand, COMMANDLINE_PLUGIN)
 
+class RetentionCommand(MailboxesCommand):
+
+    command_name = 'retention'
+    description = 'show, set or enforce the retention policy of a set of mailboxes'
+
+    @classmethod
+    def setup_options(cls, parser):
+        super(RetentionCommand, cls).setup_options(parser)
+        parser.add_option('--days', type="int", dest="days", 
+                          help="keep items for at most this number of days (0 for no limit)")
+        parser.add_option('--items', type="int", dest="items", 
+                          help="keep at most this many items per subscription (0 for no limit)")
+        parser.add_option('--bytes', type="int", dest="max_bytes", 
+                          help="keep at most this many bytes of items (0 for no limit)")
+        parser.add_option('--enforce', action='store_true', dest="enforce", default=False, 
+                          help="delete everything outside the policy now")
+
+    def __call__(self, mailboxes=None, update_all=False, days=None, items=None, 
+                 max_bytes=None, enforce=False):
+        """
+        set the retention policy of mailboxes, which the agent
+        enforces a little at a time as subscriptions are updated.
+        mailboxes - list of mailboxes (by slug)
+        update_all - apply to all mailboxes
+        days - maximum age of items in days
+        items - maximum number of items per subscription
+        max_bytes - maximum total size of items
+        enforce - delete everything outside the policy now
+        """
+        changes = {'max_age_days': days, 
+                   'max_items_per_subscription': items, 
+                   'max_bytes': max_bytes}
+        for mb in self._get_mailboxes(mailboxes, get_all=update_all):
+            info = MailboxInfo.get(mb)
+            if info is None:
+                log.error("%s has no mailbox info (sync needed?)" % mb.name)
+                continue
+
+            changed = False
+            for field, value in changes.items():
+                if value is not None:
+                    setattr(info, field, value or None)
+                    changed = True
+            if changed:
+                info.store(mb)
+                # the size of every message is only indexed
+                # while there is a byte limit.
+                sync_retention_views(mb, info)
+
+            print "%s: max age %s days, max %s items per subscription, max %s bytes" % (
+                mb.name, info.max_age_days or 'unlimited', 
+                info.max_items_per_subscription or 'unlimited', 
+                info.max_bytes or 'unlimited')
+
+            if enforce:
+                sub_ids = [row.id for row in mb.view(Subscription.by_type)]
+                deletes = 0
+                while True:
+                    count = enforce_retention(mb, info, sub_ids, stale=False)
+                    if count == 0:
+                        break
+                    deletes += count
+                print "Deleted %d items from %s" % (deletes, mb.name)
+plugins.register(RetentionCommand, COMMANDLINE_PLUGIN)
+
 class CompactCommand(MailboxesCommand):
 
     command_name = 'compact'
-    description = 'sequentially compact mailbox databases and indices'
-
+    description = 'compact fragmented mailbox databases and indices'
 
-    def __call__(self, mailboxes=None, update_all=False):
+    @classmethod
+    def setup_options(cls, parser):
+        super(CompactCommand, cls).setup_options(parser)
+        parser.add_option('--concurrency', type="int", dest="concurrency", 
+                          help="maximum number of mailboxes to compact at once (default %d)" % 
+                                DEFAULT_COMPACTION_CONCURRENCY)
+        parser.add_option('--threshold', type="float", dest="threshold", 
+                          help="skip databases and indices less than this percent fragmented (default %d)" % 
+                                (DEFAULT_COMPACTION_THRESHOLD * 100))
+
+    def __call__(self, mailboxes=None, update_all=False, concurrency=None, threshold=None):
         """
         run couch db compaction on each mailbox and design doc
-        *sequentially*
+        that is fragmented, several mailboxes at once.
+        mailboxes - list of mailboxes to compact (by slug)
+        update_all - compact all mailboxes
+        concurrency - maximum number of mailboxes to compact at once
+        threshold - minimum fragmentation in percent
         """
-        for mb in self._get_mailboxes(mailboxes, get_all=update_all):
-            log.info('Compacting mailbox %s' % mb.name)
-            mb.compact() # compact the database 
-            info = mb.info()
-            while (info.get('compact_running', False) == True):
-                sleep(3)
-                info = mb.info()
-            log.info("Finished compacting mailbox %s" % mb.name)
-            
-            for ddoc in plugins.get(DESIGN_DOC_PLUGIN):
-                ddid = ddoc['_id'][len('_design/'):]
-                log.info("Compacting mailbox %s / view %s" % (mb.name, ddid))
-                try: 
-                    mb.compact(ddid)
-                
-                    # grab something like:
-                    # http://localhost:5984/databasename/_design/test/_info
-                    # Ack ! can't ask for this due to wierd quoting behavior of 
-                    # couchdb library -- use workaround
-                    status, headers, data = get_json_raw_url(mb, ['_design', ddid, '_info'])
-                    while data.get('view_index', {}).get('compact_running', False) == True: 
-                        sleep(3)
-                        status, headers, data = get_json_raw_url(mb, ['_design', ddid, '_info'])
-                    log.info("Finished compacting mailbox %s / view %s" % (mb.name, ddid))
-                except KeyboardInterrupt: 
-                    log.info("Exiting at user request.")
-                    return
-                except: 
-                    log.error("Error compacting mailbox %s / view %s: %s" % (mb.name, ddid, traceback.format_exc()))
+        if concurrency is None:
+            concurrency = DEFAULT_COMPACTION_CONCURRENCY
+        if threshold is None:
+            threshold = DEFAULT_COMPACTION_THRESHOLD
+        else:
+            threshold = threshold / 100.0
+
+        def progress(mb, ddid, before, after):
+            if ddid is None:
+                name = mb.name
+            else:
+                name = '%s / view %s' % (mb.name, ddid)
+            print "[%d mailboxes, %d compacted] %s: %d -> %d bytes" % (
+                scheduler.stats.mailboxes, scheduler.stats.compacted, name, before, after)
+
+        scheduler = CompactionScheduler(concurrency=concurrency, threshold=threshold, 
+                                        on_progress=progress)
+        try:
+            stats = scheduler.run(self._get_mailboxes(mailboxes, get_all=update_all))
+        except KeyboardInterrupt: 
+            log.info("Exiting at user request.")
+            return
+        print stats
 plugins.register(CompactCommand, COMMANDLINE_PLUGIN)
 
 
@@ -287,7 +509,10 @@ class UpdateSubscriptionCommand(SubscriptionCommand):
     description = 'update a particular subscription in a mailbox'
 
     def __call__(self, mailbox, subscription):
-        return self._update_subscription(mailbox, subscription)
+        if self._update_subscription(mailbox, subscription) == True:
+            refresh_views(mailbox)
+            return True
+        return False
 plugins.register(UpdateSubscriptionCommand, COMMANDLINE_PLUGIN)
 
 
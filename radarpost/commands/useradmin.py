@@ -1,5 +1,6 @@
-from couchdb import Server, ResourceNotFound
+from couchdb import ResourceNotFound
 from radarpost.cli import COMMANDLINE_PLUGIN, BasicCommand, get_basic_option_parser
+from radarpost.couch import get_server
 from radarpost import plugins
 from radarpost.user import User, ROLE_ADMIN
 from getpass import getpass
@@ -25,7 +26,7 @@ class CreateUserCommand(BasicCommand):
         is_locked - if True, create with a locked password
         is_admin  - if True, grant administrative rights to the user
         """
-        couchdb = Server(self.config['couchdb.address'])
+        couchdb = get_server(self.config)
         try:
             udb = couchdb[self.config['couchdb.users_database']]
         except: 
@@ -77,7 +78,7 @@ class ResetPasswordCommand(BasicCommand):
         Reset the password of the user with the given username.
         is_locked - if True, lock the user's password
         """
-        couchdb = Server(self.config['couchdb.address'])
+        couchdb = get_server(self.config)
         try:
             udb = couchdb[self.config['couchdb.users_database']]
         except: 
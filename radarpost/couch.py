@@ -0,0 +1,124 @@
+"""
+Shared connections to CouchDB.
+
+couchdb.Server objects are cheap, but each one brings its own 
+http Session and so its own set of connections.  The servers 
+returned by get_server share a single keep-alive session per 
+CouchDB address for the life of the process.
+"""
+from couchdb import Server
+from couchdb.http import ResponseBody, Session
+import threading
+
+from radarpost.config import CONFIG_INI_PARSER_PLUGIN
+from radarpost import plugins
+
+__all__ = ['get_server', 'PooledSession', 'DEFAULT_MAX_CONNECTIONS']
+
+DEFAULT_MAX_CONNECTIONS = 20
+DEFAULT_CACHE_SIZE = 1000
+
+class PooledSession(Session):
+    """
+    A thread safe couchdb http Session that limits the number 
+    of requests in flight at once to max_connections.  Connections
+    are kept alive and reused by the underlying Session.
+
+    A request holds its slot until its connection is free again, 
+    for a streamed (large or chunked) response that is once the 
+    body has been read to the end or closed.
+    """
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS, **kw):
+        if not 'cache' in kw:
+            # the default response cache grows without bound.
+            kw['cache'] = _BoundedCache(DEFAULT_CACHE_SIZE)
+        Session.__init__(self, **kw)
+        self.max_connections = max_connections
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._local = threading.local()
+
+    def request(self, *args, **kw):
+        if getattr(self._local, 'holding', False):
+            # a redirect followed by Session.request, 
+            # already counted.
+            return Session.request(self, *args, **kw)
+
+        self._slots.acquire()
+        self._local.holding = True
+        release = self._slots.release
+        try:
+            status, headers, data = Session.request(self, *args, **kw)
+            if isinstance(data, ResponseBody):
+                data.callback = _ReleaseOnce(data.callback, release)
+                release = None
+            return status, headers, data
+        finally:
+            self._local.holding = False
+            if release is not None:
+                release()
+
+class _ReleaseOnce(object):
+    """
+    returns a streamed response's connection to the 
+    Session and then frees its slot, the body may be
+    closed more than once.
+    """
+
+    def __init__(self, callback, release):
+        self.callback = callback
+        self.release = release
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            if self.release is None:
+                return
+            release = self.release
+            self.release = None
+        try:
+            self.callback()
+        finally:
+            release()
+
+class _BoundedCache(dict):
+
+    def __init__(self, size):
+        dict.__init__(self)
+        self.size = size
+        self._lock = threading.Lock()
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            if len(self) >= self.size and not key in self:
+                try:
+                    dict.pop(self, iter(self).next())
+                except (StopIteration, KeyError):
+                    pass
+            dict.__setitem__(self, key, value)
+
+_servers = {}
+_servers_lock = threading.Lock()
+
+def get_server(config):
+    """
+    get a connection to the configured couchdb server, 
+    shared with everything else using the same address.
+    """
+    address = config['couchdb.address']
+    max_connections = config.get('couchdb.max_connections', DEFAULT_MAX_CONNECTIONS)
+    key = (address, max_connections)
+    server = _servers.get(key)
+    if server is None:
+        with _servers_lock:
+            server = _servers.get(key)
+            if server is None:
+                session = PooledSession(max_connections=max_connections)
+                server = Server(address, session=session)
+                _servers[key] = server
+    return server
+
+@plugins.plugin(CONFIG_INI_PARSER_PLUGIN)
+def parse_couchdb_config(cfg):
+    if 'couchdb.max_connections' in cfg:
+        cfg['couchdb.max_connections'] = int(cfg['couchdb.max_connections'])
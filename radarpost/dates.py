@@ -0,0 +1,133 @@
+"""
+Cached parsing of the dates found in feeds.
+
+parse_date gives the same results as feedparser's date parsing
+(a 9-tuple in UTC or None) but tries precompiled patterns for the
+RFC 3339 and RFC 822 forms that nearly all feeds use before the
+rest of feedparser's date handlers, remembers which handler worked
+last for each feed and keeps a bounded memo of recently seen date
+strings.
+
+Importing this module registers parse_date as feedparser's first
+date handler so that feeds parsed by feedparser itself also
+benefit.
+"""
+import calendar
+import re
+import rfc822
+import time
+
+from radarpost.lib import feedparser
+
+__all__ = ['parse_date', 'MEMO_SIZE']
+
+# maximum number of date strings / feed urls remembered
+MEMO_SIZE = 10000
+
+_memo = {}
+_handler_for_url = {}
+
+def parse_date(value, url=None):
+    """
+    parse the date string value into a 9-tuple in UTC
+    or return None if it cannot be parsed.
+
+    url - the feed the date appeared in, if given the
+    handler that parsed the last date seen in the same
+    feed is tried first.
+    """
+    try:
+        return _memo[value]
+    except KeyError:
+        pass
+
+    preferred = None
+    if url is not None:
+        preferred = _handler_for_url.get(url)
+
+    handlers = [_parse_rfc3339, _parse_rfc822] + \
+               [h for h in feedparser._date_handlers if h is not _feedparser_handler]
+    if preferred is not None:
+        handlers.insert(0, preferred)
+
+    result = None
+    for handler in handlers:
+        result = _try_handler(handler, value)
+        if result is not None:
+            if url is not None and handler is not preferred:
+                _remember(_handler_for_url, url, handler)
+            break
+    _remember(_memo, value, result)
+    return result
+
+def _remember(cache, key, value):
+    if len(cache) >= MEMO_SIZE:
+        cache.clear()
+    cache[key] = value
+
+def _try_handler(handler, value):
+    # the same checks feedparser._parse_date makes
+    try:
+        date9 = handler(value)
+        if not date9 or len(date9) != 9:
+            return None
+        map(int, date9)
+        return date9
+    except:
+        return None
+
+# the subset of W3DTF with full date, time and zone that
+# feedparser's _parse_date_w3dtf accepts, parsed the same way.
+_RFC3339_PAT = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d)(?::(\d\d))?'
+                          r'(?:Z|([-+])(\d\d):?(\d\d))$')
+
+def _parse_rfc3339(value):
+    m = _RFC3339_PAT.match(value)
+    if m is None:
+        return None
+    year, month, day, hours, minutes, seconds, sign, tzh, tzm = m.groups()
+    year, month, day = int(year), int(month), int(day)
+    if year < 1000 or not 1 <= month <= 12:
+        return None
+    when = calendar.timegm((year, month, day, int(hours), int(minutes),
+                            int(seconds or 0), 0, 0, 0))
+    if sign is not None:
+        offset = (int(tzh) * 60 + int(tzm)) * 60
+        if sign == '+':
+            when -= offset
+        else:
+            when += offset
+    return time.gmtime(when)
+
+# 'Sat, 03 Apr 2010 05:58:24 GMT' and friends with a known zone,
+# parsed the same way as feedparser's _parse_date_rfc822
+_RFC822_PAT = re.compile(r'(?:(?:Mon|Tue|Wed|Thu|Fri|Sat|Sun), )?(\d\d?) '
+                         r'(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) '
+                         r'(\d{4}) (\d\d):(\d\d)(?::(\d\d))? ([A-Z]+|[-+]\d{4})$')
+_MONTHS = dict((name, i + 1) for i, name in
+               enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                          'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']))
+
+def _parse_rfc822(value):
+    m = _RFC822_PAT.match(value)
+    if m is None:
+        return None
+    day, month, year, hours, minutes, seconds, zone = m.groups()
+    if zone in rfc822._timezones:
+        offset = rfc822._timezones[zone]
+    elif zone[0] in '+-':
+        offset = int(zone)
+    else:
+        # unknown zones are taken as local time
+        return None
+    sign = 1
+    if offset < 0:
+        sign, offset = -1, -offset
+    offset = sign * ((offset // 100) * 3600 + (offset % 100) * 60)
+    when = calendar.timegm((int(year), _MONTHS[month], int(day), int(hours),
+                            int(minutes), int(seconds or 0), 0, 0, 0))
+    return time.gmtime(when - offset)
+
+def _feedparser_handler(value):
+    return parse_date(value)
+feedparser.registerDateHandler(_feedparser_handler)
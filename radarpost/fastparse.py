@@ -0,0 +1,780 @@
+"""
+A fast parser for well formed Atom 1.0 and RSS 2.0 feeds
+built on ElementTree's iterparse.
+
+The result has the same shape as the result of feedparser.parse
+for the parts of a feed that radarpost uses: entries are stored,
+text is cleaned up, embedded html is sanitized and relative uris
+are resolved following the same rules as feedparser.
+
+Anything that is not handled the same way feedparser would
+handle it (documents that are not well formed, other formats,
+base64 or out of line content, extension elements that feedparser
+folds into core fields...) raises UnsupportedFeed so that the
+caller can fall back to feedparser.
+"""
+from cStringIO import StringIO
+from htmlentitydefs import entitydefs
+import re
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
+
+from radarpost.lib import feedparser
+from radarpost.lib.feedparser import FeedParserDict, _urljoin, _xmlescape
+from radarpost.dates import parse_date
+
+__all__ = ['parse', 'clean', 'UnsupportedFeed']
+
+class UnsupportedFeed(Exception):
+    """
+    raised when a document cannot be parsed by the fast parser
+    """
+    pass
+
+ATOM_NS = 'http://www.w3.org/2005/Atom'
+ITUNES_SCHEME = 'http://www.itunes.com/'
+_XML_BASE = '{http://www.w3.org/XML/1998/namespace}base'
+_XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+
+# namespace uri -> feedparser's prefix for elements in the namespace
+_PREFIXES = dict((uri.lower(), prefix) for uri, prefix in
+                 feedparser._FeedParserMixin.namespaces.items())
+
+# every element that feedparser has a handler for
+_HANDLED = set()
+for _attr in dir(feedparser._FeedParserMixin):
+    for _p in ('_start_', '_end_'):
+        if _attr.startswith(_p):
+            _HANDLED.add(_attr[len(_p):].lower())
+
+# elements handled by feedparser that only affect fields radarpost
+# does not use, they are skipped.
+_HARMLESS = set(['admin_errorreportsto', 'admin_generatoragent', 'cloud',
+                 'created', 'dc_language', 'dc_publisher', 'dcterms_created',
+                 'email', 'expirationdate', 'feedburner_browserfriendly',
+                 'generator', 'height', 'homepage', 'info', 'itunes_block',
+                 'itunes_email', 'itunes_explicit', 'itunes_image', 'itunes_link',
+                 'itunes_name', 'itunes_owner', 'itunes_subtitle', 'language', 'media_content',
+                 'media_player', 'media_thumbnail', 'name', 'subtitle', 'tagline',
+                 'uri', 'url', 'webmaster', 'width'])
+# skipped, but they reset feedparser's idea of whether a title was seen
+_TITLED = set(['image', 'textinput'])
+
+_CAN_BE_RELATIVE_URI = set(feedparser._FeedParserMixin.can_be_relative_uri)
+_CAN_CONTAIN_RELATIVE_URIS = set(feedparser._FeedParserMixin.can_contain_relative_uris)
+_CAN_CONTAIN_DANGEROUS_MARKUP = set(feedparser._FeedParserMixin.can_contain_dangerous_markup)
+_HTML_TYPES = ['text/html', 'application/xhtml+xml']
+_TEXT_TYPES = ['text/plain'] + _HTML_TYPES
+_ACCEPTABLE_ELEMENTS = set(feedparser._HTMLSanitizer.acceptable_elements)
+_CP1252 = dict((ord(k), v) for k, v in feedparser._cp1252.items())
+
+_XML_DECL_PAT = re.compile(r'^\s*<\?xml[^>]*?encoding\s*=\s*["\']([^"\']+)["\']')
+_DOCTYPE_PAT = re.compile(r'<!DOCTYPE', re.I)
+_NON_ASCII_PAT = re.compile(u'[^\x00-\x7f]')
+_CLOSE_TAG_PAT = re.compile(r'</(\w+)>')
+_REF_PAT = re.compile(r'&#?\w+;')
+_TAG_NAME_PAT = re.compile(r'</?(\w+)')
+_ENTITY_NAME_PAT = re.compile(r'&(\w+);')
+
+def parse(content, url, raw=False):
+    """
+    parses the feed document given (a string) retrieved
+    from url.  returns a FeedParserDict in the same form
+    as feedparser.
+
+    if raw is True, html text constructs are not sanitized
+    and relative uris in them are not resolved. Their details
+    are marked 'raw' and keep the base uri and content type
+    needed to do this later using clean(detail).  Only the
+    detail values are cleaned by clean, the plain values
+    (eg entry['title']) stay raw.
+
+    raises UnsupportedFeed if the document cannot be handled.
+    """
+    if not isinstance(content, str):
+        raise UnsupportedFeed('content is not a string of bytes')
+    # whitespace before the xml declaration is not well formed, 
+    # but common enough to accept.
+    content = content.lstrip()
+    _check_encoding(content)
+    return _FeedBuilder(url, raw=raw).parse(content)
+
+def clean(detail):
+    """
+    sanitizes and resolves relative uris in the value of 
+    a text construct left raw by parse(..., raw=True) in the 
+    same way feedparser would have.  The detail is updated 
+    in place. returns the clean value.
+    """
+    if detail.get('raw'):
+        ctype = detail['type']
+        output = feedparser._resolveRelativeURIs(detail['value'], detail['base'], 
+                                                 'utf-8', ctype)
+        output = feedparser._sanitizeHTML(output, 'utf-8', ctype)
+        detail['value'] = _fix_text(output)
+        del detail['raw']
+    return detail['value']
+
+def _check_encoding(content):
+    """
+    feedparser is told that documents are utf-8, only handle
+    documents where the declared encoding cannot disagree.
+    """
+    if content.startswith('\xfe\xff') or content.startswith('\xff\xfe'):
+        raise UnsupportedFeed('utf-16 document')
+    head = content[:4096]
+    if _DOCTYPE_PAT.search(head):
+        raise UnsupportedFeed('document has a doctype')
+    try:
+        text = content.decode('utf-8')
+    except UnicodeDecodeError:
+        raise UnsupportedFeed('document is not utf-8')
+    m = _XML_DECL_PAT.match(head)
+    if (m is not None and m.group(1).lower() not in ('utf-8', 'utf8') and
+        _NON_ASCII_PAT.search(text)):
+        raise UnsupportedFeed('document is %s' % m.group(1))
+
+_names = {}
+def _element_name(tag):
+    """
+    returns the name feedparser gives the element with the
+    ElementTree tag given, or None if it is in an unknown
+    namespace.
+    """
+    try:
+        return _names[tag]
+    except KeyError:
+        pass
+    if tag[0] == '{':
+        uri, local = tag[1:].split('}', 1)
+        uri = uri.lower()
+        if uri.find('backend.userland.com/rss') != -1:
+            prefix = ''
+        else:
+            prefix = _PREFIXES.get(uri)
+    else:
+        prefix, local = '', tag
+    if prefix is None:
+        name = None
+    elif prefix:
+        name = '%s_%s' % (prefix, local.lower())
+    else:
+        name = local.lower()
+    _names[tag] = name
+    return name
+
+def _attrs(elem):
+    """
+    the attributes of elem as feedparser presents them
+    """
+    attrs = {}
+    for key, value in elem.items():
+        if key[0] == '{':
+            uri, local = key[1:].split('}', 1)
+            prefix = _PREFIXES.get(uri.lower(), '')
+            if prefix:
+                key = '%s:%s' % (prefix, local)
+            else:
+                key = local
+        key = key.lower()
+        value = _u(value)
+        if key in ('rel', 'type'):
+            value = value.lower()
+        attrs[key] = value
+    return attrs
+
+def _u(s):
+    if s is None:
+        return u''
+    if isinstance(s, unicode):
+        return s
+    return unicode(s, 'utf-8')
+
+def _direct_text(elem):
+    pieces = [_u(elem.text)]
+    for child in elem:
+        pieces.append(_u(child.tail))
+    return u''.join(pieces)
+
+def _simple_text(elem):
+    if len(elem):
+        raise UnsupportedFeed('unexpected markup in <%s>' % elem.tag)
+    return _u(elem.text)
+
+def _fix_text(output):
+    """
+    feedparser's clean up of decoded text: undo utf-8 that was
+    decoded as iso-8859-1 and map windows-1252 characters.
+    """
+    output = _u(output)
+    if _NON_ASCII_PAT.search(output) is not None:
+        try:
+            output = unicode(output.encode('iso-8859-1'), 'utf-8')
+        except UnicodeError:
+            pass
+        output = output.translate(_CP1252)
+    return output
+
+def _map_type(ctype):
+    ctype = ctype.lower()
+    if ctype == 'text':
+        return 'text/plain'
+    elif ctype == 'html':
+        return 'text/html'
+    elif ctype == 'xhtml':
+        return 'application/xhtml+xml'
+    return ctype
+
+def _looks_like_html(s):
+    # see feedparser's lookslikehtml
+    if not (_CLOSE_TAG_PAT.search(s) or _REF_PAT.search(s)):
+        return False
+    for tag in _TAG_NAME_PAT.findall(s):
+        if tag.lower() not in _ACCEPTABLE_ELEMENTS:
+            return False
+    for ref in _ENTITY_NAME_PAT.findall(s):
+        if ref not in entitydefs:
+            return False
+    return True
+
+def _scope(elem, base, lang):
+    """
+    returns the base uri and language in effect for elem
+    """
+    xbase = elem.get(_XML_BASE) or elem.get('base')
+    if xbase:
+        base = _urljoin(base, _u(xbase))
+    xlang = elem.get(_XML_LANG, elem.get('lang'))
+    if xlang == '':
+        lang = None
+    elif xlang is not None:
+        lang = _u(xlang)
+    return base, lang
+
+class _FeedBuilder(object):
+    """
+    builds the feedparser representation of a feed, elements
+    are visited in document order so that state feedparser keeps
+    across elements (eg whether a title has been seen) matches.
+    """
+
+    def __init__(self, url, raw=False):
+        self.url = url
+        self.raw = raw
+        self.version = None
+        self.feed = FeedParserDict()
+        self.entries = []
+        self.has_title = False
+
+    def parse(self, content):
+        # feed level elements are at depth 1 for atom and
+        # depth 2 (inside channel) for rss.
+        container_depth = None
+        scopes = []
+        try:
+            for event, elem in iterparse(StringIO(content), events=('start', 'end')):
+                if event == 'start':
+                    if len(scopes) == 0:
+                        container_depth = self._start_root(elem)
+                        base, lang = _urljoin(self.url, self.url), None
+                    else:
+                        base, lang = scopes[-1]
+                    base, lang = _scope(elem, base, lang)
+                    scopes.append((base, lang))
+                    if len(scopes) == 1 and lang:
+                        self.feed['language'] = lang.replace('_', '-')
+                    continue
+
+                base, lang = scopes.pop()
+                depth = len(scopes)
+                if depth == container_depth:
+                    self._element(elem, self.feed, base, lang, 'feed')
+                    elem.clear()
+                elif depth < container_depth:
+                    if _element_name(elem.tag) not in ('rss', 'channel', 'feed'):
+                        self._skip(elem)
+        except SyntaxError, e:
+            raise UnsupportedFeed('document is not well formed: %s' % e)
+
+        if self.version is None:
+            raise UnsupportedFeed('empty document')
+
+        result = FeedParserDict()
+        result['feed'] = self.feed
+        result['entries'] = self.entries
+        result['bozo'] = 0
+        result['encoding'] = 'utf-8'
+        result['version'] = self.version
+        result['namespaces'] = {}
+        return result
+
+    def _start_root(self, elem):
+        if elem.tag == '{%s}feed' % ATOM_NS:
+            self.version = 'atom10'
+            return 1
+        elif elem.tag == 'rss' and elem.get('version', '').startswith('2.'):
+            self.version = 'rss20'
+            return 2
+        raise UnsupportedFeed('not an atom 1.0 or rss 2.0 document')
+
+    def _element(self, elem, context, base, lang, kind):
+        """
+        handle an element inside a feed, entry or source
+        """
+        name = _element_name(elem.tag)
+        handler = _HANDLERS.get(name)
+        if handler is not None:
+            if handler == _FeedBuilder._entry and kind != 'feed':
+                raise UnsupportedFeed('nested entry')
+            handler(self, elem, name, context, base, lang, kind)
+        elif name in _TITLED:
+            self.has_title = False
+            for child in elem:
+                if (_element_name(child.tag) in ('title', 'dc_title') and
+                    _direct_text(child).strip()):
+                    self.has_title = True
+        else:
+            self._skip(elem)
+
+    def _skip(self, elem):
+        """
+        make sure nothing feedparser would use is inside
+        an element that is being ignored.
+        """
+        for sub in elem.getiterator():
+            name = _element_name(sub.tag)
+            if name in _HANDLED and name not in _HARMLESS:
+                raise UnsupportedFeed('unsupported element <%s>' % sub.tag)
+
+    def _children(self, elem, context, base, lang, kind):
+        for child in elem:
+            cbase, clang = _scope(child, base, lang)
+            self._element(child, context, cbase, clang, kind)
+
+    #
+    # storing values, see feedparser's _FeedParserMixin.pop
+    #
+
+    def _store(self, element, output, context, kind, params=None):
+        if element == 'title' and self.has_title:
+            return
+        if kind == 'entry':
+            if element == 'content':
+                detail = FeedParserDict(params)
+                detail['value'] = output
+                context.setdefault('content', []).append(detail)
+            elif element == 'link':
+                context['link'] = output
+                if output:
+                    context['links'][-1]['href'] = output
+            else:
+                if element == 'description':
+                    element = 'summary'
+                context[element] = output
+                if params is not None:
+                    detail = FeedParserDict(params)
+                    detail['value'] = output
+                    context[element + '_detail'] = detail
+        else:
+            if element == 'description':
+                element = 'subtitle'
+            context[element] = output
+            if element == 'link':
+                context['links'][-1]['href'] = output
+            elif params is not None:
+                detail = FeedParserDict(params)
+                detail['value'] = output
+                context[element + '_detail'] = detail
+
+    def _value(self, element, text, base):
+        """
+        the value of a simple (non-content) element
+        """
+        output = text.strip()
+        if element in _CAN_BE_RELATIVE_URI and output:
+            output = _urljoin(base, output)
+        return _fix_text(output)
+
+    def _content(self, elem, element, default_type, context, base, lang, kind):
+        """
+        the value of a text construct, returns (value, params)
+        """
+        attrs = _attrs(elem)
+        ctype = _map_type(attrs.get('type', default_type))
+        if attrs.get('mode') == 'base64' or ctype not in _TEXT_TYPES:
+            raise UnsupportedFeed('unsupported content type %s' % ctype)
+        if element == 'content' and attrs.get('src'):
+            raise UnsupportedFeed('out of line content')
+        if lang:
+            lang = lang.replace('_', '-')
+        params = {'type': ctype, 'language': lang, 'base': base}
+
+        if ctype == 'application/xhtml+xml':
+            output = self._xhtml(elem, base, lang)
+        else:
+            output = _simple_text(elem)
+        output = output.strip()
+
+        if not self.version.startswith('atom') and ctype == 'text/plain':
+            if _looks_like_html(output):
+                ctype = params['type'] = 'text/html'
+
+        if (ctype in _HTML_TYPES and self.raw and 
+            element in _CAN_CONTAIN_RELATIVE_URIS and 
+            element in _CAN_CONTAIN_DANGEROUS_MARKUP):
+            # left for clean()
+            if element in ('content', 'description', 'summary'):
+                self._microformats(output, context, base, kind)
+            params['raw'] = True
+            return output, params
+
+        if ctype in _HTML_TYPES:
+            if element in _CAN_CONTAIN_RELATIVE_URIS:
+                output = feedparser._resolveRelativeURIs(output, base, 'utf-8', ctype)
+            if element in ('content', 'description', 'summary'):
+                self._microformats(output, context, base, kind)
+            if element in _CAN_CONTAIN_DANGEROUS_MARKUP:
+                output = feedparser._sanitizeHTML(output, 'utf-8', ctype)
+
+        return _fix_text(output), params
+
+    def _xhtml(self, elem, base, lang):
+        pieces = []
+        if elem.text:
+            pieces.append(_xmlescape(_u(elem.text)))
+        for child in elem:
+            self._xhtml_element(child, pieces)
+
+        # feedparser removes an enclosing div
+        while len(pieces) > 1 and not pieces[-1].strip():
+            del pieces[-1]
+        while len(pieces) > 1 and not pieces[0].strip():
+            del pieces[0]
+        if (pieces and (pieces[0] == '<div>' or pieces[0].startswith('<div '))
+            and pieces[-1] == '</div>'):
+            depth = 0
+            for piece in pieces[:-1]:
+                if piece.startswith('</'):
+                    depth -= 1
+                    if depth == 0:
+                        break
+                elif piece.startswith('<') and not piece.endswith('/>'):
+                    depth += 1
+            else:
+                pieces = pieces[1:-1]
+        return u''.join(pieces)
+
+    def _xhtml_element(self, elem, pieces):
+        tag = elem.tag
+        if tag[0] == '{':
+            tag = tag[1:].split('}', 1)[1]
+        tag = tag.lower()
+        if tag in ('svg', 'math'):
+            raise UnsupportedFeed('inline %s' % tag)
+        attrs = ''.join([' %s="%s"' % (k, _xmlescape(v, {'"': '&quot;'}))
+                         for k, v in _attrs(elem).items()])
+        pieces.append(u'<%s%s>' % (tag, attrs))
+        if elem.text:
+            pieces.append(_xmlescape(_u(elem.text)))
+        for child in elem:
+            self._xhtml_element(child, pieces)
+        pieces.append(u'</%s>' % tag)
+        if elem.tail:
+            pieces.append(_xmlescape(_u(elem.tail)))
+
+    def _microformats(self, output, context, base, kind):
+        if not feedparser.BeautifulSoup:
+            return
+        mfresults = feedparser._parseMicroformats(output, base, 'utf-8')
+        if not mfresults:
+            return
+        for tag in mfresults.get('tags', []):
+            _add_tag(context, tag['term'], tag['scheme'], tag['label'])
+        for enclosure in mfresults.get('enclosures', []):
+            _add_enclosure(context, enclosure)
+        for xfn in mfresults.get('xfn', []):
+            value = FeedParserDict({'relationships': xfn['relationships'],
+                                    'href': xfn['href'], 'name': xfn['name']})
+            xfns = context.setdefault('xfn', [])
+            if value not in xfns:
+                xfns.append(value)
+        if mfresults.get('vcard'):
+            context['vcard'] = mfresults['vcard']
+
+    #
+    # element handlers
+    #
+
+    def _entry(self, elem, name, context, base, lang, kind):
+        if elem.get('{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about') or \
+           elem.get('lastmod') or elem.get('href'):
+            raise UnsupportedFeed('unsupported entry attributes')
+        entry = FeedParserDict()
+        self.entries.append(entry)
+        self.has_title = False
+        self._children(elem, entry, base, lang, 'entry')
+
+    def _title(self, elem, name, context, base, lang, kind):
+        output, params = self._content(elem, 'title', 'text/plain', context, base, lang, kind)
+        self._store('title', output, context, kind, params)
+        if output:
+            self.has_title = True
+
+    def _text_construct(self, elem, name, context, base, lang, kind):
+        element = {'copyright': 'rights', 'dc_rights': 'rights'}.get(name, name)
+        output, params = self._content(elem, element, 'text/plain', context, base, lang, kind)
+        self._store(element, output, context, kind, params)
+
+    def _summary(self, elem, name, context, base, lang, kind):
+        if context.has_key('summary'):
+            return self._content_element(elem, 'content', context, base, lang, kind)
+        if name == 'summary':
+            element, default_type = 'summary', 'text/plain'
+        else:
+            element, default_type = 'description', 'text/html'
+        output, params = self._content(elem, element, default_type, context, base, lang, kind)
+        self._store(element, output, context, kind, params)
+
+    def _content_element(self, elem, name, context, base, lang, kind):
+        if name in ('content_encoded', 'fullitem'):
+            default_type = 'text/html'
+        else:
+            default_type = 'text/plain'
+        ctype = _map_type(_attrs(elem).get('type', default_type))
+        output, params = self._content(elem, 'content', default_type, context, base, lang, kind)
+        self._store('content', output, context, kind, params)
+        if ctype in _TEXT_TYPES:
+            context.setdefault('description', output)
+
+    def _link(self, elem, name, context, base, lang, kind):
+        attrs = _attrs(elem)
+        attrs.setdefault('rel', 'alternate')
+        if attrs['rel'] == 'self':
+            attrs.setdefault('type', 'application/atom+xml')
+        else:
+            attrs.setdefault('type', 'text/html')
+        attrs = _its_an_href(attrs)
+        if attrs.has_key('href'):
+            attrs['href'] = _urljoin(base, attrs['href'])
+            if attrs.get('rel') == 'enclosure' and not context.get('id'):
+                context['id'] = attrs.get('href')
+        context.setdefault('links', [])
+        context['links'].append(FeedParserDict(attrs))
+        if attrs.has_key('href'):
+            if attrs.get('rel') == 'alternate' and _map_type(attrs.get('type')) in _HTML_TYPES:
+                context['link'] = attrs['href']
+        else:
+            self._store('link', self._value('link', _simple_text(elem), base),
+                        context, kind)
+
+    def _id(self, elem, name, context, base, lang, kind):
+        self._store('id', self._value('id', _simple_text(elem), base), context, kind)
+
+    def _guid(self, elem, name, context, base, lang, kind):
+        guidislink = (_attrs(elem).get('ispermalink', 'true') == 'true')
+        value = self._value('id', _simple_text(elem), base)
+        self._store('id', value, context, kind)
+        context.setdefault('guidislink', guidislink and not context.has_key('link'))
+        if guidislink:
+            context.setdefault('link', value)
+
+    def _date(self, elem, name, context, base, lang, kind):
+        if name in ('published', 'issued', 'dcterms_issued'):
+            element = 'published'
+        else:
+            element = 'updated'
+        value = self._value(element, _simple_text(elem), base)
+        self._store(element, value, context, kind)
+        context.setdefault(element + '_parsed', parse_date(value, self.url))
+
+    def _author(self, elem, name, context, base, lang, kind):
+        for child in elem:
+            cname = _element_name(child.tag)
+            cbase, clang = _scope(child, base, lang)
+            if cname in ('name', 'email', 'itunes_name', 'itunes_email'):
+                key = cname.replace('itunes_', '')
+                detail = context.setdefault('author_detail', FeedParserDict())
+                detail[key] = _simple_text(child).strip()
+            elif cname in ('url', 'uri', 'homepage'):
+                value = self._value('href', _simple_text(child), cbase)
+                self._store('href', value, context, kind)
+                detail = context.setdefault('author_detail', FeedParserDict())
+                detail['href'] = value
+            else:
+                self._skip(child)
+        self._store('author', self._value('author', _direct_text(elem), base),
+                    context, kind)
+        _sync_author_detail(context)
+
+    def _contributor(self, elem, name, context, base, lang, kind):
+        contributor = FeedParserDict()
+        context.setdefault('contributors', []).append(contributor)
+        for child in elem:
+            cname = _element_name(child.tag)
+            cbase, clang = _scope(child, base, lang)
+            if cname in ('name', 'email'):
+                contributor[cname] = _simple_text(child).strip()
+            elif cname in ('url', 'uri', 'homepage'):
+                value = self._value('href', _simple_text(child), cbase)
+                self._store('href', value, context, kind)
+                contributor['href'] = value
+            else:
+                self._skip(child)
+
+    def _category(self, elem, name, context, base, lang, kind):
+        attrs = _attrs(elem)
+        _add_tag(context, attrs.get('term'), attrs.get('scheme', attrs.get('domain')),
+                 attrs.get('label'))
+        value = self._value('category', _simple_text(elem), base)
+        if not value:
+            return
+        tags = context['tags']
+        if len(tags) and not tags[-1]['term']:
+            tags[-1]['term'] = value
+        else:
+            _add_tag(context, value, None, None)
+
+    def _itunes_category(self, elem, name, context, base, lang, kind):
+        _add_tag(context, _attrs(elem).get('text'), ITUNES_SCHEME, None)
+        for child in elem:
+            if _element_name(child.tag) != 'itunes_category':
+                raise UnsupportedFeed('unexpected markup in <%s>' % elem.tag)
+            cbase, clang = _scope(child, base, lang)
+            self._itunes_category(child, name, context, cbase, clang, kind)
+        value = self._value('category', _direct_text(elem), base)
+        if not value:
+            return
+        tags = context['tags']
+        if len(tags) and not tags[-1]['term']:
+            tags[-1]['term'] = value
+        else:
+            _add_tag(context, value, None, None)
+
+    def _itunes_keywords(self, elem, name, context, base, lang, kind):
+        if len(elem.keys()):
+            raise UnsupportedFeed('unexpected attributes on <%s>' % elem.tag)
+        value = self._value(name, _simple_text(elem), base)
+        self._store(name, value, context, kind)
+        for term in value.split():
+            _add_tag(context, term, ITUNES_SCHEME, None)
+
+    def _enclosure(self, elem, name, context, base, lang, kind):
+        _add_enclosure(context, _attrs(elem))
+
+    def _source(self, elem, name, context, base, lang, kind):
+        if kind != 'entry':
+            raise UnsupportedFeed('source outside of an entry')
+        source = FeedParserDict()
+        attrs = _attrs(elem)
+        if 'url' in attrs:
+            source['href'] = attrs['url']
+        self.has_title = False
+        self._children(elem, source, base, lang, 'source')
+        value = self._value('source', _direct_text(elem), base)
+        if value:
+            source['title'] = value
+        context['source'] = source
+
+_HANDLERS = {
+    'item': _FeedBuilder._entry,
+    'entry': _FeedBuilder._entry,
+    'title': _FeedBuilder._title,
+    'dc_title': _FeedBuilder._title,
+    'rights': _FeedBuilder._text_construct,
+    'dc_rights': _FeedBuilder._text_construct,
+    'copyright': _FeedBuilder._text_construct,
+    'summary': _FeedBuilder._summary,
+    'description': _FeedBuilder._summary,
+    'dc_description': _FeedBuilder._summary,
+    'content': _FeedBuilder._content_element,
+    'content_encoded': _FeedBuilder._content_element,
+    'fullitem': _FeedBuilder._content_element,
+    'link': _FeedBuilder._link,
+    'id': _FeedBuilder._id,
+    'guid': _FeedBuilder._guid,
+    'updated': _FeedBuilder._date,
+    'modified': _FeedBuilder._date,
+    'pubdate': _FeedBuilder._date,
+    'dc_date': _FeedBuilder._date,
+    'dcterms_modified': _FeedBuilder._date,
+    'published': _FeedBuilder._date,
+    'issued': _FeedBuilder._date,
+    'dcterms_issued': _FeedBuilder._date,
+    'author': _FeedBuilder._author,
+    'managingeditor': _FeedBuilder._author,
+    'dc_author': _FeedBuilder._author,
+    'dc_creator': _FeedBuilder._author,
+    'itunes_author': _FeedBuilder._author,
+    'contributor': _FeedBuilder._contributor,
+    'category': _FeedBuilder._category,
+    'dc_subject': _FeedBuilder._category,
+    'keywords': _FeedBuilder._category,
+    'itunes_category': _FeedBuilder._itunes_category,
+    'itunes_keywords': _FeedBuilder._itunes_keywords,
+    'enclosure': _FeedBuilder._enclosure,
+    'source': _FeedBuilder._source,
+}
+
+def _its_an_href(attrs):
+    href = attrs.get('url', attrs.get('uri', attrs.get('href', None)))
+    if href:
+        attrs.pop('url', None)
+        attrs.pop('uri', None)
+        attrs['href'] = href
+    return attrs
+
+def _add_tag(context, term, scheme, label):
+    tags = context.setdefault('tags', [])
+    if (not term) and (not scheme) and (not label):
+        return
+    value = FeedParserDict({'term': term, 'scheme': scheme, 'label': label})
+    if value not in tags:
+        tags.append(value)
+
+def _add_enclosure(context, attrs):
+    attrs = _its_an_href(attrs)
+    attrs['rel'] = 'enclosure'
+    context.setdefault('links', []).append(FeedParserDict(attrs))
+    href = attrs.get('href')
+    if href and not context.get('id'):
+        context['id'] = href
+
+_EMAIL_PAT = re.compile(r'''(([a-zA-Z0-9\_\-\.\+]+)@((\[[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.)|(([a-zA-Z0-9\-]+\.)+))([a-zA-Z]{2,4}|[0-9]{1,3})(\]?))(\?subject=\S+)?''')
+def _sync_author_detail(context):
+    # see feedparser's _sync_author_detail
+    detail = context.get('author_detail')
+    if detail:
+        name = detail.get('name')
+        email = detail.get('email')
+        if name and email:
+            context['author'] = '%s (%s)' % (name, email)
+        elif name:
+            context['author'] = name
+        elif email:
+            context['author'] = email
+        return
+
+    author, email = context.get('author'), None
+    if not author:
+        return
+    m = _EMAIL_PAT.search(author)
+    if m:
+        email = m.group(0)
+        author = author.replace(email, '')
+        author = author.replace('()', '')
+        author = author.replace('<>', '')
+        author = author.replace('&lt;&gt;', '')
+        author = author.strip()
+        if author and (author[0] == '('):
+            author = author[1:]
+        if author and (author[-1] == ')'):
+            author = author[:-1]
+        author = author.strip()
+    if author or email:
+        context.setdefault('author_detail', FeedParserDict())
+    if author:
+        context['author_detail']['name'] = author
+    if email:
+        context['author_detail']['email'] = email
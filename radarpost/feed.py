@@ -7,6 +7,8 @@ from hashlib import md5
 import re
 
 from radarpost.mailbox import Message, SourceInfo, Subscription, DESIGN_DOC_PLUGIN
+from radarpost.mailbox import apply_subscription_state, update_subscription_state
+from radarpost import fastparse
 from radarpost import plugins
 
 __all__ = ['FEED_SUBSCRIPTION_TYPE',
@@ -32,6 +34,11 @@ class FeedSubscription(Subscription):
     # digest of last fetched content
     last_digest = TextField()
 
+    # cache validators sent by the server with 
+    # the last fetched content
+    etag = TextField()
+    last_modified = TextField()
+
     # helpful view constants
     by_url = '_design/feed/_view/feeds_by_url'
 
@@ -41,6 +48,8 @@ class FeedSubscription(Subscription):
         super(FeedSubscription, self).reset()
         self.last_ids = []
         self.last_digest = None
+        self.etag = None
+        self.last_modified = None
 
 @plugins.plugin(Subscription.SUBTYPE_PLUGIN)
 def create_feedsub(typename):
@@ -151,29 +160,36 @@ HTML_TYPES = ['text/html', 'application/xhtml+xml']
 def _make_text(content, strip=False):
     if content is None:
         return ''
+    # sanitize html left raw by the parser now that 
+    # it is going to be stored.
+    value = fastparse.clean(content)
     if content.type in HTML_TYPES:
         if strip: 
-            return strip_tags(content.value)
+            return strip_tags(value)
         else:
-            return content.value
+            return value
     else:
         # tags are stripped from text. although technically 
         # these could contain literal text that looks like 
         # a tag or character reference, they are more
         # often than not a mistake.
-        return cgi.escape(strip_tags(content.value))
-
-def create_atom_entry(entry, feed, subscription, message=None):
-    if message is None:
-        message = AtomEntry()
+        return cgi.escape(strip_tags(value))
 
-    # the guid of a basic news item is the 
-    # md5 digest of the item's id and the subscription's url.
+def entry_guid(entry, subscription):
+    """
+    the guid of a basic news item is the 
+    md5 digest of the item's id and the subscription's url.
+    """
     guid = md5()
     guid.update(entry.id)
     guid.update(subscription.url)
-    guid = guid.hexdigest()
+    return guid.hexdigest()
 
+def create_atom_entry(entry, feed, subscription, message=None):
+    if message is None:
+        message = AtomEntry()
+
+    guid = entry_guid(entry, subscription)
     message.id = guid
     message.entry_id = entry.id
 
@@ -255,10 +271,15 @@ def create_atom_entry(entry, feed, subscription, message=None):
     return message
 
 
+# maximum number of ids remembered in last_ids 
+# when appending during partial updates.
+MAX_LAST_IDS = 1000
+
 def update_feed_subscription(mailbox, subscription, feed, full_update=True,
                              message_processor=create_atom_entry,
                              message_filter=None,
-                             subscription_delta=None):
+                             subscription_delta=None,
+                             message_guid=entry_guid):
     """
     updates a single subscription in a single mailbox.
     returns - number of new items
@@ -273,27 +294,65 @@ def update_feed_subscription(mailbox, subscription, feed, full_update=True,
         returning a value indicating whether
         to accept the message.
     subscription_delta - if specified, the subscription is update()'d
-        with this as an argument before being saved.
+        with this as an argument before being saved.  may also be 
+        a callable accepting the number of new items and returning
+        the delta.
+    message_guid - a callable giving the id of the message that 
+        message_processor would produce for an entry, used to skip 
+        entries that were seen last time without processing them.
+
+    This is plan_feed_update followed by store_feed_update.
+    """
+    new_messages, current_ids = plan_feed_update(subscription, feed, 
+                                                 full_update=full_update,
+                                                 message_processor=message_processor,
+                                                 message_filter=message_filter,
+                                                 message_guid=message_guid)
+    return store_feed_update(mailbox, subscription, new_messages, current_ids,
+                             subscription_delta=subscription_delta)
+
+def plan_feed_update(subscription, feed, full_update=True,
+                     message_processor=create_atom_entry,
+                     message_filter=None,
+                     message_guid=entry_guid):
     """
+    works out the changes needed to update a subscription 
+    with a feed without touching the mailbox. 
     
+    returns (new_messages, current_ids) for store_feed_update
+    see update_feed_subscription for arguments.
+    """
+    last_ids = set(subscription.last_ids)
+
     # if this is a full update, we will 
     # replace subscription.last_ids, otherwise
     # we just append to the list.
     if full_update == True:
         current_ids = []
     else: 
-        current_ids = subscription.last_ids
+        current_ids = list(subscription.last_ids)
+    current = set(current_ids)
 
     new_messages = []
     for entry in feed.entries:
-        message = message_processor(entry, feed, subscription)
+        guid = message_guid(entry, subscription)
+        if guid in current:
+            # repeated within the feed or already recorded
+            continue
 
+        # don't re-add things we saw last time around.
+        if guid in last_ids:
+            current_ids.append(guid)
+            current.add(guid)
+            continue
+
+        message = message_processor(entry, feed, subscription)
         if message is None:
             continue
         
         current_ids.append(message.id)
-        # don't re-add things we saw last time around.
-        if message.id in subscription.last_ids: 
+        current.add(message.id)
+        if message.id in last_ids:
             continue
 
         if (message_filter is not None and message_filter(message) == False):
@@ -301,8 +360,36 @@ def update_feed_subscription(mailbox, subscription, feed, full_update=True,
     
         new_messages.append(message)
 
+    # a full update only remembers what is in the feed now, 
+    # appending must be bounded.
+    if full_update != True and len(current_ids) > MAX_LAST_IDS:
+        current_ids = current_ids[-MAX_LAST_IDS:]
+
+    return new_messages, current_ids
+
+def store_feed_update(mailbox, subscription, new_messages, current_ids, 
+                      subscription_delta=None):
+    """
+    stores the new messages and subscription state produced 
+    by plan_feed_update in the mailbox. 
+    returns - number of new items
+    """
+    new_message_count = count_new_messages(mailbox.update(new_messages))
+
+    # great, now update the subscription info.
+    now = datetime.utcnow()
+    if callable(subscription_delta):
+        subscription_delta = subscription_delta(new_message_count)
+    save_subscription_state(mailbox, subscription, current_ids, now, subscription_delta)
+    return new_message_count
+
+def count_new_messages(results):
+    """
+    counts the messages stored given the results of 
+    mailbox.update. Errors other than conflicts are raised.
+    """
     new_message_count = 0
-    for (success, doc_id, rev_ex) in mailbox.update(new_messages):
+    for (success, doc_id, rev_ex) in results:
         if success == True:
             new_message_count += 1
             
@@ -310,30 +397,34 @@ def update_feed_subscription(mailbox, subscription, feed, full_update=True,
         # this could also be exposed, reported or logged
         # if needed at some point.
         elif not isinstance(rev_ex, ResourceConflict):
-            raise
+            raise rev_ex
+    return new_message_count
 
-    # great, now update the subscription info.
-    now = datetime.utcnow()
+def _updated_state(current_ids, now, subscription_delta=None):
+    state = {'status': Subscription.STATUS_OK,
+             'last_ids': current_ids,
+             'last_update': now}
+    if subscription_delta is not None:
+        state.update(subscription_delta)
+    return state
 
-    # if we are the latest updater, put in our info.
-    while(subscription.last_update is None or subscription.last_update < now):
-        try:
-            subscription.status = Subscription.STATUS_OK
-            subscription.last_ids = current_ids
-            subscription.last_update = now
-            if subscription_delta is not None:
-                for k,v in subscription_delta.items():
-                    setattr(subscription, k, v)
-            subscription.store(mailbox)
-            break
-        except ResourceConflict:
-            # oops changed since we started, reload it.
-            try:
-                subscription = mailbox[subscription.id]
-            except ResourceNotFound:
-                # deleted from underneath us, bail out.
-                break
-    return new_message_count
+def set_subscription_state(subscription, current_ids, now, subscription_delta=None):
+    """
+    records a successful update made at the time now in the 
+    subscription without storing it.  returns False if the 
+    subscription already records a later update.
+    """
+    state = _updated_state(current_ids, now, subscription_delta)
+    return apply_subscription_state(subscription, state)
+
+def save_subscription_state(mailbox, subscription, current_ids, now, 
+                            subscription_delta=None):
+    """
+    records a successful update made at the time now in the 
+    subscription and stores it, see mailbox.update_subscription_state
+    """
+    state = _updated_state(current_ids, now, subscription_delta)
+    update_subscription_state(mailbox, subscription, state)
 
 #####################################
 #
@@ -344,7 +435,7 @@ def update_feed_subscription(mailbox, subscription, feed, full_update=True,
 class InvalidFeedError(Exception): 
     pass
 
-def parse(content, url):
+def parse(content, url, fast=True, raw=False):
     """
     produces a python representation of the RSS feed content 
     given. This representation is documented at: 
@@ -352,15 +443,29 @@ def parse(content, url):
 
     content - string containing RSS/atom/etc xml document
     url - the url that the content was retrieved from.
+    fast - if True, well formed Atom 1.0 and RSS 2.0 documents 
+           are parsed by radarpost.fastparse, anything else 
+           is handed to feedparser.
+    raw - if True, html in feeds handled by radarpost.fastparse 
+          is sanitized only when it is needed, eg by 
+          create_atom_entry.  see fastparse.parse
 
     raises: InvalidFeedError if no feed could be parse.
     """
 
-    fake_headers = {
-        'content-location': url,
-        'content-type': 'text/xml; charset=utf-8',
-    }
-    ff = feedparser.parse(content, header_defaults=fake_headers)
+    ff = None
+    if fast:
+        try:
+            ff = fastparse.parse(content, url, raw=raw)
+        except fastparse.UnsupportedFeed:
+            pass
+
+    if ff is None:
+        fake_headers = {
+            'content-location': url,
+            'content-type': 'text/xml; charset=utf-8',
+        }
+        ff = feedparser.parse(content, header_defaults=fake_headers)
 
     if ff is None or not 'feed' in ff:
         raise InvalidFeedError()
@@ -420,16 +525,23 @@ def find_best_entry_id(entry):
         return entry['link']
     elif entry.has_key('title') and entry['title']:
         return (entry.title_detail.base + "/" +
-                md5(entry['title']).hexdigest())
+                md5(_clean_value(entry, 'title')).hexdigest())
     elif entry.has_key('summary') and entry['summary']:
         return (entry['summary_detail']['base'] + "/" +
-                md5(entry['summary']).hexdigest())
+                md5(_clean_value(entry, 'summary')).hexdigest())
     elif entry.has_key("content") and entry['content']:
         return (entry['content'][0]['base'] + "/" + 
-                md5(entry['content'][0]['value']).hexdigest())
+                md5(fastparse.clean(entry['content'][0])).hexdigest())
     else:
         return None
 
+def _clean_value(entry, key):
+    # the value of key as it would be without raw parsing
+    detail = entry.get(key + '_detail')
+    if detail is not None and detail.get('raw'):
+        entry[key] = fastparse.clean(detail)
+    return entry[key]
+
 DESIGN_DOC = {
     '_id': '_design/feed',
     'views': {
@@ -507,48 +619,81 @@ ENTITIES = {
     'diams' : 9830, 
 }
 
-import HTMLParser
-class MLStripper(HTMLParser.HTMLParser):
-    def __init__(self):
-        self.reset()
-        self._text = []
-    def handle_data(self, d):
-        self._text.append(d)
-    def handle_charref(self, name):
-        if name.startswith('x'): 
-            base = 16
-            name = name[1:]
-        else: 
-            base = 10
-
-        try: 
-            code = int(name, base=base)
-            self._text.append(unichr(code))
-        except: 
-            pass # ignore it.
-
-    def handle_entityref(self, name):
-        if name in ENTITIES: 
-            self._text.append(unichr(ENTITIES[name]))
-        # just skip it otherwise.
+# markup that is dropped by strip_tags: comments, declarations,
+# processing instructions and tags (attribute values may be quoted
+# and contain '>').  The body of a script or style element is raw 
+# text up to its closing tag and is kept as is, like HTMLParser.
+# Anything left unterminated runs to the end of the input.  Each 
+# alternative matches a prefix of its input in a single pass, so 
+# the whole scan is linear in the size of the input.
+_MARKUP_PAT = re.compile(r"""
+    <!--.*?(?:-->|\Z)
+  | <(?P<raw>script|style)\b(?:[^>"']+|"[^"]*(?:"|\Z)|'[^']*(?:'|\Z))*(?:>|\Z)
+    (?P<rawtext>.*?)(?=</(?P=raw)|\Z)
+  | <[!?][^>]*(?:>|\Z)
+  | </?[a-zA-Z](?:[^>"']+|"[^"]*(?:"|\Z)|'[^']*(?:'|\Z))*(?:>|\Z)
+  | &\#[xX](?P<hex>[0-9a-fA-F]+);?
+  | &\#(?P<dec>[0-9]+);?
+  | &(?P<entity>[a-zA-Z][-.a-zA-Z0-9]*);?
+""", re.S | re.X | re.I)
+_LEADING_SPACE_PAT = re.compile(r'^\s+')
+
+def _iter_text(html):
+    """
+    yields the chunks of text in html in order, with 
+    character and entity references decoded.
+    """
+    pos = 0
+    for m in _MARKUP_PAT.finditer(html):
+        if m.start() > pos:
+            yield html[pos:m.start()]
+        pos = m.end()
+
+        if m.group('rawtext'):
+            yield m.group('rawtext')
+            continue
 
-    @property
-    def text(self):
-        text = u''
-        for chunk in self._text:
-            if not chunk:
-                continue
-            if chunk.startswith(' '):
-                text += re.sub('^\s+', ' ', chunk)
-            else:
-                text += chunk
-            text.strip()
-        return text
+        ref = m.group('entity')
+        if ref is not None:
+            if ref in ENTITIES:
+                yield unichr(ENTITIES[ref])
+            # just skip it otherwise.
+            continue
 
-def strip_tags(html):
+        ref, base = m.group('hex'), 16
+        if ref is None:
+            ref, base = m.group('dec'), 10
+        if ref is not None:
+            try:
+                yield unichr(int(ref, base))
+            except (ValueError, OverflowError):
+                pass # ignore it.
+    if pos < len(html):
+        yield html[pos:]
+
+def strip_tags(html, max_length=None):
+    """
+    returns the text of the html fragment given with all 
+    markup removed and character and entity references 
+    decoded.  Leading whitespace in a run of text beginning 
+    with a space is collapsed to a single space.
+
+    if max_length is given, at most max_length characters
+    are returned and the rest of the input is not examined.
+    """
     try:
-        stripper = MLStripper()
-        stripper.feed(html)
-        return stripper.text
+        chunks = []
+        length = 0
+        for chunk in _iter_text(html):
+            if chunk.startswith(' '):
+                chunk = _LEADING_SPACE_PAT.sub(' ', chunk)
+            chunks.append(chunk)
+            length += len(chunk)
+            if max_length is not None and length >= max_length:
+                break
+        text = u''.join(chunks)
+        if max_length is not None:
+            text = text[:max_length]
+        return text
     except:
-        return cgi.escape(html)
\ No newline at end of file
+        return cgi.escape(html)
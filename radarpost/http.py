@@ -1,12 +1,16 @@
 from httplib2 import Http as UnrestrictedHttp
+import threading
+import time
 from tinfoilhat import Http as RestrictedHttp
+from urlparse import urlparse
 from radarpost.config import CONFIG_INI_PARSER_PLUGIN, parse_bool, config_section
 from radarpost import plugins
 
-def create_client(cfg):
+def create_client(cfg, cache=True):
     """
     create an http client according to 
-    the configuration given.
+    the configuration given.  If cache is False, 
+    http.cache is ignored and nothing is cached.
     """
 
     cfg = config_section('http', cfg)
@@ -14,7 +18,7 @@ def create_client(cfg):
     kw = {}
     if 'timeout' in cfg: 
         kw['timeout'] = cfg['timeout']    
-    if 'cache' in cfg:
+    if cache and 'cache' in cfg:
         kw['cache'] = cfg['cache']
     
     if cfg.get('allow_local') == True: 
@@ -42,6 +46,121 @@ def close_all(client):
         conn.close()
     client.connections = {}
 
+DEFAULT_PER_HOST = 2
+DEFAULT_IDLE_TIMEOUT = 30
+
+class PollingSession(object):
+    """
+    A pool of keep-alive http clients that can be shared 
+    by many threads, eg for every subscription in every 
+    mailbox polled during a single run. 
+    
+    Each client in the pool is created by create_client, so
+    the same restrictions on addresses apply.  The clients do
+    not cache responses, so a 304 reaches the caller.  At most 
+    per_host clients are used at once for a given host, 
+    further requests for the host wait for one to be 
+    released.  Clients that sit idle for longer than
+    idle_timeout seconds are closed by a background thread,
+    whether or not any further requests are made.
+
+    request() has the same signature as httplib2's 
+    Http.request, so a session can be used anywhere 
+    a client is expected.
+    """
+
+    def __init__(self, cfg, per_host=DEFAULT_PER_HOST, idle_timeout=None):
+        self.config = cfg
+        if idle_timeout is None:
+            idle_timeout = cfg.get('http.idle_timeout', DEFAULT_IDLE_TIMEOUT)
+        self.per_host = max(int(per_host), 1)
+        self.idle_timeout = idle_timeout
+
+        self._cond = threading.Condition()
+        self._idle = {}   # host -> [(client, last used)]
+        self._busy = {}   # host -> number of clients in use
+        self._closed = False
+        self._reaper = threading.Thread(target=self._evict_idle,
+                                        name='polling-session-reaper')
+        self._reaper.daemon = True
+        self._reaper.start()
+
+    def request(self, uri, method='GET', body=None, headers=None, **kw):
+        host = urlparse(uri)[1].lower()
+        client = self._acquire(host)
+        ok = False
+        try:
+            result = client.request(uri, method=method, body=body, headers=headers, **kw)
+            ok = True
+            return result
+        finally:
+            self._release(host, client, reuse=ok)
+
+    def close(self):
+        """
+        close all idle connections, clients that are currently
+        in use are closed when they are released.
+        """
+        with self._cond:
+            self._closed = True
+            for host, idle in self._idle.items():
+                for client, last_used in idle:
+                    close_all(client)
+            self._idle = {}
+            self._cond.notify_all()
+        if self._reaper is not threading.current_thread():
+            self._reaper.join()
+
+    def _acquire(self, host):
+        with self._cond:
+            while True:
+                idle = self._idle.get(host)
+                if idle:
+                    client, last_used = idle.pop()
+                    break
+                if self._busy.get(host, 0) < self.per_host:
+                    client = create_client(self.config, cache=False)
+                    break
+                self._cond.wait()
+            self._busy[host] = self._busy.get(host, 0) + 1
+            return client
+
+    def _release(self, host, client, reuse=True):
+        with self._cond:
+            self._busy[host] -= 1
+            if self._busy[host] == 0:
+                del self._busy[host]
+            if reuse and not self._closed:
+                self._idle.setdefault(host, []).append((client, time.time()))
+            else:
+                close_all(client)
+            self._cond.notify_all()
+
+    def _evict_idle(self):
+        with self._cond:
+            while not self._closed:
+                now = time.time()
+                cutoff = now - self.idle_timeout
+                oldest = None
+                for host in self._idle.keys():
+                    keep = []
+                    for client, last_used in self._idle[host]:
+                        if last_used <= cutoff:
+                            close_all(client)
+                        else:
+                            keep.append((client, last_used))
+                            if oldest is None or last_used < oldest:
+                                oldest = last_used
+                    if keep:
+                        self._idle[host] = keep
+                    else:
+                        del self._idle[host]
+                if oldest is None:
+                    # woken by the next release or close
+                    self._cond.wait()
+                else:
+                    self._cond.wait(oldest + self.idle_timeout - now)
+
 @plugins.plugin(CONFIG_INI_PARSER_PLUGIN)
 def parse_http_config(cfg):
     if 'http.allow_local' in cfg: 
@@ -50,4 +169,6 @@ def parse_http_config(cfg):
         try:
             cfg['http.timeout'] = int(cfg['http.timeout'])
         except: 
-            pass
\ No newline at end of file
+            pass
+    if 'http.idle_timeout' in cfg:
+        cfg['http.idle_timeout'] = int(cfg['http.idle_timeout'])
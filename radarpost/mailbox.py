@@ -1,16 +1,37 @@
 import copy
+from couchdb.client import Database
 from couchdb.mapping import *
-from couchdb.http import ResourceNotFound, PreconditionFailed
-from datetime import datetime
+from couchdb.http import ResourceConflict, ResourceNotFound, PreconditionFailed, ServerError
+from datetime import datetime, timedelta
+from hashlib import md5
+import json
 import logging
+from Queue import Queue
+import threading
+import time
+import traceback
 from radarpost import plugins
+from radarpost.threads import join_all
 
 __all__ = ['Message', 'SourceInfo', 'Subscription', 'MailboxInfo', 
            'MESSAGE_TYPE', 'SUBSCRIPTION_TYPE', 'MAILBOXINFO_TYPE', 
            'MAILBOXINFO_ID', 'DESIGN_DOC', 'DESIGN_DOC_PLUGIN', 
+           'RETENTION_DESIGN_DOC', 
            'create_mailbox', 'is_mailbox', 'bless_mailbox', 'sync_mailbox',
+           'sync_retention_views',
+           'design_doc_digest', 'staging_id', 'STAGING_SUFFIX',
            'iter_mailboxes', 'trim_mailbox', 'trim_subscription',
-           'refresh_views', 'get_json_raw_url']
+           'count_subscription_messages',
+           'MailboxRegistration', 'MAILBOX_REGISTRATION_TYPE',
+           'get_registry', 'register_mailbox', 'unregister_mailbox',
+           'iter_registrations', 'list_registrations', 'rebuild_registry', 
+           'open_mailbox',
+           'refresh_views', 'ViewRefresher', 'DEFAULT_REFRESH_THRESHOLD',
+           'get_json_raw_url', 'apply_subscription_state', 
+           'update_subscription_state', 'enforce_retention', 
+           'has_retention_policy', 'DEFAULT_RETENTION_BUDGET',
+           'fragmentation', 'CompactionScheduler', 'CompactionStats',
+           'DEFAULT_COMPACTION_THRESHOLD', 'DEFAULT_COMPACTION_CONCURRENCY']
 
 log = logging.getLogger(__name__)
 
@@ -78,6 +99,7 @@ MESSAGE_TYPE = 'message'
 SUBSCRIPTION_TYPE = 'subscription'
 MAILBOXINFO_TYPE = 'mailboxinfo'
 MAILBOXINFO_ID = 'mailbox_meta'
+MAILBOX_REGISTRATION_TYPE = 'mailbox_registration'
 
 
 class SourceInfo(Mapping):
@@ -103,6 +125,8 @@ class Message(DowncastDoc):
     # helpful view constants
     by_timestamp = '_design/mailbox/_view/messages_by_timestamp'
     by_subscription = '_design/mailbox/_view/messages_by_subscription'
+    # only in mailboxes limited by size, see RETENTION_DESIGN_DOC
+    sizes = '_design/retention/_view/message_sizes'
     
     SUBTYPE_PLUGIN = 'radar.mailbox.mailbox_subtype'
     SUBTYPE_FIELD = 'message_type'
@@ -118,8 +142,14 @@ class Subscription(DowncastDoc):
     status = TextField()
     last_update = DateTimeField()
 
+    # polling schedule
+    next_poll = DateTimeField()
+    poll_interval = IntegerField()
+    error_count = IntegerField(default=0)
+
     # helpful view constants
     by_type = '_design/mailbox/_view/subscriptions_by_type'
+    by_next_poll = '_design/mailbox/_view/subscriptions_by_next_poll'
 
     # status constants
     STATUS_OK        = 'ok'
@@ -138,6 +168,9 @@ class Subscription(DowncastDoc):
         """
         self.last_update = None
         self.status = None
+        self.next_poll = None
+        self.poll_interval = None
+        self.error_count = 0
 
 class MailboxInfo(RadarDocument):
     """
@@ -146,6 +179,12 @@ class MailboxInfo(RadarDocument):
     type = TextField(default=MAILBOXINFO_TYPE)
     version = TextField(default="0.0.1")
     title = TextField()
+
+    # retention policy, see enforce_retention.
+    # empty or 0 means no limit.
+    max_age_days = IntegerField()
+    max_items_per_subscription = IntegerField()
+    max_bytes = IntegerField()
     
     def __init__(self, **values):
         Document.__init__(self, id=MAILBOXINFO_ID, **values)
@@ -156,62 +195,191 @@ class MailboxInfo(RadarDocument):
 
     user_updatable = ('title', )
 
+class MailboxRegistration(RadarDocument):
+    """
+    An entry in the mailbox registry, a database listing 
+    every mailbox on a server.  The id of the document is 
+    the name of the mailbox's database.
+    """
+    type = TextField(default=MAILBOX_REGISTRATION_TYPE)
+    title = TextField()
+    version = TextField()
+
+    @property
+    def db_name(self):
+        return self.id
+
 #####################################################
 #
 # Helpers for creating and managing mailbox databases
 #
 #####################################################
 
-def create_mailbox(couchdb, dbname):
+def create_mailbox(couchdb, dbname, registry=None):
     """
     create a mailbox on the given server with the given name.
+    if a registry database is given, the mailbox is registered 
+    in it.
     
     raises PreconditionFailed if a database with the given name 
            already exists.
     raises ValueError if name is not a valid mailbox name.
     """
     db = couchdb.create(dbname)
-    bless_mailbox(db)
+    bless_mailbox(db, registry=registry)
     return db
 
-def iter_mailboxes(couchdb, prefix=None): 
+def iter_mailboxes(couchdb, prefix=None, registry=None): 
     """
     iterate through mailboxes in the current context.
     if prefix is specified, only databases with names
     that start with the string specified are returned.
+
+    if a registry database is given, mailboxes are listed 
+    from the registry (see list_registrations), otherwise 
+    every database on the server is examined.
     """
+    if registry is not None:
+        for reg in list_registrations(couchdb, registry, prefix=prefix):
+            yield open_mailbox(couchdb, reg.db_name)
+        return
+
     for db_name in couchdb:
-        db = couchdb[db_name]
         if prefix is not None and not db_name.startswith(prefix):
             continue
+        db = couchdb[db_name]
         if is_mailbox(db):
             yield db
+
+def open_mailbox(couchdb, db_name):
+    """
+    get the mailbox database with the given name. unlike
+    couchdb[db_name], no request is made to check that 
+    the database exists.
+    """
+    return Database(couchdb.resource(db_name), db_name)
  
-def bless_mailbox(db):
+def bless_mailbox(db, registry=None):
     """
-    bootstrap a database as a Mailbox
+    bootstrap a database as a Mailbox, registering it
+    in the registry database given if any.
     """
     info = MailboxInfo()
     info.store(db)
     sync_mailbox(db)
+    if registry is not None:
+        register_mailbox(registry, db, info)
+
+STAGING_SUFFIX = '_staging'
 
-def sync_mailbox(db):
+def sync_mailbox(db, stage=False):
     """
-    update database design document and other
-    metadata.  This operation unconditionally
-    clobbers the current design document in the 
-    database.
+    update database design documents and other
+    metadata.  Only design documents whose content 
+    differs (see design_doc_digest) are written, so 
+    syncing an up to date mailbox leaves its view 
+    indexes alone.
+
+    If stage is True, a changed design document that 
+    already exists is first written under a staging 
+    id (see staging_id) and its views are built there, 
+    it is only then written under its own id.  couchdb 
+    shares an index between design documents with the 
+    same views, so the swapped in views are ready to 
+    read.  This blocks until the views are built.
+
+    The views used to enforce the mailbox's retention policy 
+    are synced as well, see sync_retention_views.
+
+    returns the ids of the design documents written.
     """
     if not is_mailbox(db):
         raise PreconditionFailed("database %s is not a mailbox" % db.name)
 
+    changed = []
     for dd in plugins.get(DESIGN_DOC_PLUGIN):
-        dd = copy.deepcopy(dd)
-        cur = db.get(dd['_id'])
-        if cur:
-            dd['_rev'] = cur['_rev']
-        db[dd['_id']] = dd
+        if _sync_design_doc(db, dd, stage):
+            changed.append(dd['_id'])
+    changed += sync_retention_views(db, stage=stage)
+    return changed
+
+def sync_retention_views(db, info=None, stage=False):
+    """
+    adds, updates or removes RETENTION_DESIGN_DOC so that only 
+    mailboxes limited by size (MailboxInfo.max_bytes) index 
+    the size of every message.  info is the mailbox's 
+    MailboxInfo, loaded if not given.  stage is as for 
+    sync_mailbox.
+
+    returns the ids of the design documents written or removed.
+    """
+    if info is None:
+        info = MailboxInfo.get(db)
+    ddid = RETENTION_DESIGN_DOC['_id']
+    if info is not None and info.max_bytes:
+        if _sync_design_doc(db, RETENTION_DESIGN_DOC, stage):
+            return [ddid]
+        return []
 
+    cur = db.get(ddid)
+    if cur is None:
+        return []
+    db.delete(cur)
+    return [ddid]
+
+def _mailbox_design_docs(db):
+    dds = list(plugins.get(DESIGN_DOC_PLUGIN))
+    info = MailboxInfo.get(db)
+    if info is not None and info.max_bytes:
+        dds.append(RETENTION_DESIGN_DOC)
+    return dds
+
+def _sync_design_doc(db, dd, stage):
+    dd = copy.deepcopy(dd)
+    cur = db.get(dd['_id'])
+    if cur and design_doc_digest(cur) == design_doc_digest(dd):
+        return False
+    staged = None
+    if cur and stage and dd.get('views'):
+        staged = _build_staged(db, dd)
+    if cur:
+        dd['_rev'] = cur['_rev']
+    db[dd['_id']] = dd
+    if staged is not None:
+        # the index outlives the staging document as 
+        # long as the deployed document has the same views.
+        del db[staged]
+    return True
+
+def design_doc_digest(dd):
+    """
+    digest of the content of a design document, 
+    ignoring its id and revision.
+    """
+    content = dict([(k, v) for k, v in dd.items() if k not in ('_id', '_rev')])
+    return md5(json.dumps(content, sort_keys=True)).hexdigest()
+
+def staging_id(ddid):
+    """
+    the id a design document's changes are built 
+    under before they are deployed by sync_mailbox.
+    """
+    return ddid + STAGING_SUFFIX
+
+def _build_staged(db, dd):
+    staged = copy.deepcopy(dd)
+    staged['_id'] = staging_id(dd['_id'])
+    cur = db.get(staged['_id'])
+    if cur:
+        staged['_rev'] = cur['_rev']
+    db[staged['_id']] = staged
+
+    first_view = dd['views'].keys()[0]
+    log.info("Building views in %s..." % staged['_id'])
+    # views are lazy, asking for the rows 
+    # makes the request and waits for the index.
+    db.view('%s/_view/%s' % (staged['_id'], first_view), limit=0).rows
+    return staged['_id']
 
 def is_mailbox(db):
     try:
@@ -228,6 +396,111 @@ def is_mailbox(db):
         # if it's not there, not a mailbox
         return False
 
+#####################################################
+#
+# Mailbox registry
+#
+#####################################################
+
+def get_registry(couchdb, name):
+    """
+    get the registry database with the given name, 
+    creating it if it does not exist.
+    """
+    try:
+        return couchdb[name]
+    except ResourceNotFound:
+        try:
+            return couchdb.create(name)
+        except PreconditionFailed:
+            # created by someone else in the meantime
+            return couchdb[name]
+
+def register_mailbox(registry, mb, info=None):
+    """
+    add or update the registry entry for the mailbox given.
+    info is the mailbox's MailboxInfo, loaded if not given.
+    """
+    if info is None:
+        info = MailboxInfo.get(mb)
+    while True:
+        reg = MailboxRegistration.load(registry, mb.name)
+        if reg is None:
+            reg = MailboxRegistration(id=mb.name)
+        elif reg.title == info.title and reg.version == info.version:
+            return reg
+        reg.title = info.title
+        reg.version = info.version
+        try:
+            reg.store(registry)
+            return reg
+        except ResourceConflict:
+            # updated by someone else, try again.
+            continue
+
+def unregister_mailbox(registry, db_name):
+    """
+    remove the registry entry for the mailbox database 
+    with the given name if there is one.
+    """
+    while True:
+        reg = registry.get(db_name)
+        if reg is None:
+            return
+        try:
+            registry.delete(reg)
+            return
+        except ResourceConflict:
+            continue
+        except ResourceNotFound:
+            return
+
+def iter_registrations(registry, prefix=None):
+    """
+    iterate the MailboxRegistrations in the registry 
+    given, in order of database name.  if prefix is 
+    specified, only mailboxes with database names that 
+    start with the string specified are returned.
+    """
+    params = {'include_docs': True}
+    if prefix:
+        params['startkey'] = prefix
+        params['endkey'] = prefix + u'\ufff0'
+    for row in registry.view('_all_docs', **params):
+        if row.doc is None or row.doc.get('type') != MAILBOX_REGISTRATION_TYPE:
+            continue
+        yield MailboxRegistration.wrap(row.doc)
+
+def list_registrations(couchdb, registry, prefix=None):
+    """
+    list the MailboxRegistrations in the registry given 
+    (see iter_registrations).  If there are none, the 
+    registry is first rebuilt from the databases on the 
+    server so that mailboxes created before the registry
+    are found.
+    """
+    regs = list(iter_registrations(registry, prefix=prefix))
+    if len(regs) == 0:
+        log.info("registry %s is empty, rebuilding it." % registry.name)
+        rebuild_registry(couchdb, registry, prefix=prefix)
+        regs = list(iter_registrations(registry, prefix=prefix))
+    return regs
+
+def rebuild_registry(couchdb, registry, prefix=None):
+    """
+    examine every database on the server and bring the 
+    registry in line with the mailboxes that exist.
+    returns the number of mailboxes registered.
+    """
+    found = set()
+    for mb in iter_mailboxes(couchdb, prefix=prefix):
+        register_mailbox(registry, mb)
+        found.add(mb.name)
+    for reg in list(iter_registrations(registry, prefix=prefix)):
+        if not reg.db_name in found:
+            unregister_mailbox(registry, reg.db_name)
+    return len(found)
+
 def get_json_raw_url(mb, path):
     """
     little workaround for skirting overzealous 
@@ -244,6 +517,62 @@ def get_json_raw_url(mb, path):
         data = json.decode(data.read())
     return status, headers, data
     
+def apply_subscription_state(sub, state):
+    """
+    sets the fields given in state (a dict of field name -> value 
+    including last_update) on the subscription unless it already 
+    records a later update.  returns True if the state was set.
+    """
+    last_update = sub.last_update
+    if last_update is not None and last_update > state['last_update']:
+        return False
+    for k, v in state.items():
+        setattr(sub, k, v)
+    return True
+
+def update_subscription_state(mb, sub, state):
+    """
+    records the state given (see apply_subscription_state) in 
+    the subscription and in the mailbox, unless the stored 
+    subscription records a later update. 
+
+    The stored subscription is patched by the mailbox design 
+    document's subscription_state update handler in a single 
+    request without regard to its revision so that other changes 
+    to it (eg by a user) do not conflict.  If the handler is 
+    missing (the design document has not been synced) the 
+    subscription is stored, reloading and retrying on conflicts.
+    """
+    if not apply_subscription_state(sub, state):
+        return
+    try:
+        _patch_subscription(mb, sub, state.keys())
+        return
+    except (ResourceNotFound, ServerError):
+        # no update handler or the subscription was deleted
+        pass
+
+    while True:
+        try:
+            sub.store(mb)
+            return
+        except ResourceConflict:
+            # oops changed since we started, reload it.
+            sub = Subscription.load(mb, sub.id)
+            if sub is None:
+                # deleted from underneath us, bail out.
+                return
+            if not apply_subscription_state(sub, state):
+                return
+
+def _patch_subscription(mb, sub, fields):
+    patch = dict((k, sub._data.get(k)) for k in fields)
+    resource = mb.resource('_design', 'mailbox', '_update', 'subscription_state', sub.id)
+    status, headers, data = resource.put_json(body=patch)
+    rev = headers.get('x-couch-update-newrev')
+    if rev:
+        sub._data['_rev'] = rev
+
 #####################################################
 #
 # Helpful operations over mailboxes
@@ -276,87 +605,449 @@ def trim_mailbox(mb, max_age, batch_size=100):
         if len(updates) < batch_size:
             done = True
     
+        # N.B. the view is brought up to date by 
+        # the query for the next batch.
         for (success, did, rev_exc) in mb.update(updates): 
             if success:
                 deletes += 1
             else:
                 errors += 1
-        refresh_views(mb)
 
     return deletes
     
-def trim_subscription(mb, sub, max_entries, batch_size=100):
+def trim_subscription(mb, sub, max_entries, batch_size=100, max_deletes=None):
     """
     trims an individual subscription to a maximum number of 
     items (by age)
+
+    The number of items is read from the view's reduce and 
+    the oldest items beyond max_entries are deleted starting 
+    from the oldest, so the kept items are never read.  With 
+    a max_entries of 0 everything is deleted without counting.
+    At most max_deletes items are deleted if given.
     """
-    
+    return _trim_subscription(mb, sub.id, max_entries, batch_size, max_deletes)
+
+def _trim_subscription(mb, sub_id, max_entries, batch_size=100, 
+                       max_deletes=None, deleted=None, **params):
+    if max_entries > 0:
+        remaining = count_subscription_messages(mb, sub_id, **params) - max_entries
+    else:
+        remaining = None
+    if max_deletes is not None and (remaining is None or max_deletes < remaining):
+        remaining = max_deletes
+
+    params['startkey'] = [sub_id]
+    params['endkey'] = [sub_id, {}]
+    params['reduce'] = False
+
+    deletes = 0
+    while remaining is None or remaining > 0:
+        limit = batch_size
+        if remaining is not None:
+            limit = min(limit, remaining)
+        rows = list(mb.view(Message.by_subscription, limit=limit, **params))
+        if len(rows) == 0:
+            break
+
+        batch_deletes = _delete_rows(mb, rows, deleted)
+        deletes += batch_deletes
+        if remaining is not None:
+            remaining -= len(rows)
+        if len(rows) < limit:
+            break
+        if 'stale' in params:
+            # continue after the last row, a stale view 
+            # still lists what was just deleted.
+            params['startkey'] = rows[-1].key
+            params['startkey_docid'] = rows[-1].id
+            params['skip'] = 1
+        elif batch_deletes == 0:
+            # N.B. the view is brought up to date by the query
+            # for the next batch, which would list the same rows.
+            break
+
+    return deletes
+
+def count_subscription_messages(mb, sub_id, **params):
+    """
+    the number of messages in the mailbox belonging to 
+    the subscription with the id given.
+    """
+    for row in mb.view(Message.by_subscription, startkey=[sub_id], 
+                       endkey=[sub_id, {}], **params):
+        return row.value
+    return 0
+
+DEFAULT_RETENTION_BUDGET = 100
+
+def has_retention_policy(info):
+    """
+    True if the MailboxInfo given limits what is kept
+    """
+    return bool(info is not None and (info.max_age_days or 
+                                      info.max_items_per_subscription or
+                                      info.max_bytes))
+
+def enforce_retention(mb, info=None, subscription_ids=None, 
+                      max_deletes=DEFAULT_RETENTION_BUDGET, stale=True):
+    """
+    deletes at most max_deletes messages that fall outside the 
+    retention policy of the mailbox, in order: 
+
+    * messages older than max_age_days
+    * the oldest messages of each of the subscriptions given 
+      (by id) beyond the newest max_items_per_subscription
+    * the oldest messages while the messages in the mailbox 
+      total more than max_bytes (as json)
+
+    info is the mailbox's MailboxInfo, loaded if not given.
+    If stale is True, views are not brought up to date first, 
+    anything missed is caught by a later call.  Messages a stale
+    view still lists after they were deleted by an earlier step 
+    are not deleted again.  The byte limit uses the views in 
+    RETENTION_DESIGN_DOC, which are added if they are missing.
+
+    Called with a small max_deletes after each update, this 
+    keeps the mailbox within its policy a little at a time.
+    returns the number of messages deleted.
+    """
+    if info is None:
+        info = MailboxInfo.get(mb)
+    if not has_retention_policy(info) or max_deletes <= 0:
+        return 0
+
     params = {}
-    params['startkey'] = [sub.id, {}]
-    params['endkey'] = [sub.id]
-    params['descending'] = True
-    # we ask for one more to indicate where to start the next batch
-    params['limit'] = batch_size + 1
+    if stale:
+        params['stale'] = 'ok'
 
-    done = False
+    # ids deleted so far
+    deleted = set()
     deletes = 0
-    errors = 0
-    skips = 0
-    
-    while not done:
-        updates = []
-        for index, mrow in enumerate(mb.view(Message.by_subscription, **params)):
-            if index == batch_size:
-                # this is the row we want as the first element of the next batch
-                params['startkey_docid'] = mrow.id
-                params['startkey'] = mrow.key
+    if info.max_age_days:
+        max_date = datetime.utcnow() - timedelta(days=info.max_age_days)
+        rows = mb.view(Message.by_timestamp, 
+                       endkey=DateTimeField()._to_json(max_date),
+                       reduce=False, limit=max_deletes - deletes, **params)
+        deletes += _delete_rows(mb, rows, deleted)
+
+    if info.max_items_per_subscription:
+        for sub_id in subscription_ids or []:
+            if deletes >= max_deletes:
                 break
+            deletes += _trim_subscription(mb, sub_id, info.max_items_per_subscription, 
+                                          max_deletes=max_deletes - deletes, 
+                                          deleted=deleted, **params)
 
-            updates.append({'_id': mrow.id, 
-                            '_rev': mrow.value['_rev'],
-                            '_deleted': True})
+    if info.max_bytes and deletes < max_deletes:
+        try:
+            deletes += _trim_bytes(mb, info.max_bytes, max_deletes - deletes, 
+                                   deleted, **params)
+        except ResourceNotFound:
+            log.warning("%s: no message size view, adding it (sync needed?)" % mb.name)
+            sync_retention_views(mb, info)
 
-        # if we ran out of items, we're done.
-        if len(updates) < batch_size: 
-            done = True
+    return deletes
 
-        # if we are still skipping items
-        # skip as many as we can using this 
-        # batch.
-        if skips < max_entries:
-            clip = min(len(updates), max_entries - skips)
-            updates = updates[clip:]
-            skips += clip
-        
-        # nothing to update this pass, continue
-        if len(updates) == 0:
-            continue
-            
-        # do any deletes for this batch.
-        for (success, did, rev_exc) in mb.update(updates): 
-            if success:
-                deletes += 1
-            else:
-                errors += 1
-        
-        # don't get too out of date while doing this.
-        refresh_views(mb)
+def _trim_bytes(mb, max_bytes, max_deletes, deleted, **params):
+    total = 0
+    for row in mb.view(Message.sizes, **params):
+        total += row.value
+    excess = total - max_bytes
+    if excess <= 0:
+        return 0
 
+    rows = []
+    for row in mb.view(Message.sizes, reduce=False, 
+                       limit=max_deletes + len(deleted), **params):
+        # anything already deleted still counts 
+        # toward a stale total.
+        excess -= row.value['size']
+        if not row.id in deleted:
+            rows.append(row)
+        if excess <= 0 or len(rows) >= max_deletes:
+            break
+    return _delete_rows(mb, rows, deleted)
+
+def _delete_rows(mb, rows, deleted=None):
+    """
+    deletes the messages in the view rows given, skipping any 
+    whose id is in deleted.  The ids deleted are added to 
+    deleted.  returns the number of messages deleted.
+    """
+    if deleted is None:
+        deleted = set()
+    updates = [{'_id': row.id, '_rev': row.value['_rev'], '_deleted': True} 
+               for row in rows if not row.id in deleted]
+    if len(updates) == 0:
+        return 0
+    deletes = 0
+    for (success, did, rev_exc) in mb.update(updates):
+        if success:
+            deletes += 1
+            deleted.add(did)
     return deletes
 
 def refresh_views(mb):
-    for dd in plugins.get(DESIGN_DOC_PLUGIN):
+    """
+    bring the views of each design document in the mailbox
+    up to date, blocks until indexing is finished.
+    """
+    for dd in _mailbox_design_docs(mb):
         if 'views' in dd and len(dd['views'].keys()) > 0:
             first_view = dd['views'].keys()[0]
-            view_url = '%s/%s' % (dd['_id'], first_view)
+            view_url = '%s/_view/%s' % (dd['_id'], first_view)
             log.info("Refreshing views in %s..." % dd['_id'])
             try:
-                mb.view(view_url, {'count': 0})
-                # aaaand wait...
+                # views are lazy, asking for the rows 
+                # makes the request... aaaand wait...
+                mb.view(view_url, limit=0).rows
             except: 
                 log.error("failed to refresh view %s: %s" % 
                           (view_url, traceback.format_exc()))
 
+DEFAULT_REFRESH_THRESHOLD = 500
+
+class ViewRefresher(object):
+    """
+    Debounces refresh_views for any number of mailboxes.
+
+    Changes to a mailbox are recorded using touch(), the 
+    mailbox's views are refreshed once the number of pending 
+    changes reaches threshold or when flush() is called, so 
+    a mailbox is refreshed at most once per flush however 
+    many times it is touched.
+
+    If background is True, refreshes are performed by a 
+    separate thread and never block the caller, use join() 
+    to wait for them to finish.
+    """
+
+    def __init__(self, threshold=DEFAULT_REFRESH_THRESHOLD, background=False):
+        self.threshold = threshold
+        self.background = background
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._queued = set()
+        self._queue = None
+
+    def touch(self, mb, changes=1):
+        """
+        record that changes were made to the mailbox given.
+        """
+        with self._lock:
+            mb, count = self._pending.get(mb.name, (mb, 0))
+            count += changes
+            if self.threshold is None or count < self.threshold:
+                self._pending[mb.name] = (mb, count)
+                return
+            self._pending.pop(mb.name, None)
+        self._refresh(mb)
+
+    def flush(self):
+        """
+        refresh all mailboxes with pending changes.
+        """
+        with self._lock:
+            pending = self._pending.values()
+            self._pending = {}
+        for mb, count in pending:
+            self._refresh(mb)
+
+    def join(self):
+        """
+        wait for any background refreshes to finish.
+        """
+        if self._queue is not None:
+            self._queue.join()
+
+    def _refresh(self, mb):
+        if not self.background:
+            refresh_views(mb)
+            return
+
+        with self._lock:
+            if self._queue is None:
+                self._queue = Queue()
+                worker = threading.Thread(target=self._work, name='view-refresher')
+                worker.daemon = True
+                worker.start()
+            # already waiting to be refreshed
+            if mb.name in self._queued:
+                return
+            self._queued.add(mb.name)
+        self._queue.put(mb)
+
+    def _work(self):
+        while True:
+            mb = self._queue.get()
+            try:
+                with self._lock:
+                    # anything changed from here on 
+                    # needs another refresh.
+                    self._queued.discard(mb.name)
+                refresh_views(mb)
+            finally:
+                self._queue.task_done()
+
+DEFAULT_COMPACTION_THRESHOLD = 0.3
+DEFAULT_COMPACTION_CONCURRENCY = 4
+
+def fragmentation(size_info):
+    """
+    the fraction of a database or view index file that is 
+    not live data given the 'disk_size' and 'data_size' of 
+    its info.  None if it cannot be told (couchdb before 1.2 
+    does not report data_size).
+    """
+    disk_size = size_info.get('disk_size')
+    data_size = size_info.get('data_size')
+    if not disk_size or data_size is None:
+        return None
+    return max(disk_size - data_size, 0) / float(disk_size)
+
+class CompactionStats(object):
+    """
+    thread safe record of a CompactionScheduler run.
+
+    mailboxes - number of mailboxes examined
+    compacted - number of databases and view indexes compacted
+    skipped - number of databases and view indexes below the 
+              fragmentation threshold
+    errors - number of failed compactions
+    reclaimed - bytes of disk freed by compaction
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.mailboxes = 0
+        self.compacted = 0
+        self.skipped = 0
+        self.errors = 0
+        self.reclaimed = 0
+
+    def record(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def __str__(self):
+        return ("%d mailboxes: %d compacted, %d skipped, %d errors, %d bytes reclaimed" %
+                (self.mailboxes, self.compacted, self.skipped, self.errors, self.reclaimed))
+
+class CompactionScheduler(object):
+    """
+    compacts the databases and view indexes of many mailboxes 
+    using a pool of threads.
+
+    Each thread works through one mailbox at a time, compacting 
+    its database and then the index of each of its design 
+    documents (see sync_mailbox), so up to concurrency mailboxes 
+    are compacted at once.  Anything with a fragmentation (see 
+    fragmentation()) below threshold is skipped, anything that 
+    does not report its fragmentation is compacted. 
+
+    on_progress - called as on_progress(mb, ddid, before, after) 
+                  once each compaction finishes with the disk 
+                  sizes before and after, ddid is None for the 
+                  database itself.  called from the worker threads.
+    """
+
+    def __init__(self, concurrency=DEFAULT_COMPACTION_CONCURRENCY, 
+                 threshold=DEFAULT_COMPACTION_THRESHOLD, poll_interval=3, 
+                 on_progress=None):
+        self.concurrency = max(int(concurrency), 1)
+        self.threshold = threshold
+        self.poll_interval = poll_interval
+        self.on_progress = on_progress
+        self.stats = CompactionStats()
+        self._lock = threading.Lock()
+        self._mailboxes = None
+        self._stopped = False
+
+    def run(self, mailboxes):
+        """
+        compact the mailboxes given, returns CompactionStats 
+        describing the run.
+        """
+        self._mailboxes = iter(mailboxes)
+        workers = []
+        for i in range(self.concurrency):
+            worker = threading.Thread(target=self._work, name='compactor-%d' % i)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        try:
+            join_all(workers)
+        except KeyboardInterrupt:
+            self.stop()
+            raise
+        return self.stats
+
+    def stop(self):
+        """
+        stop starting new compactions, those running are 
+        left to finish on the server.
+        """
+        with self._lock:
+            self._stopped = True
+
+    def _next_mailbox(self):
+        with self._lock:
+            if self._stopped:
+                return None
+            try:
+                return self._mailboxes.next()
+            except StopIteration:
+                return None
+
+    def _work(self):
+        while True:
+            mb = self._next_mailbox()
+            if mb is None:
+                break
+            self.stats.record(mailboxes=1)
+            self._compact_target(mb, None)
+            for ddoc in _mailbox_design_docs(mb):
+                if self._stopped:
+                    break
+                self._compact_target(mb, ddoc['_id'][len('_design/'):])
+
+    def _size_info(self, mb, ddid):
+        if ddid is None:
+            return mb.info()
+        status, headers, data = get_json_raw_url(mb, ['_design', ddid, '_info'])
+        return data.get('view_index', {})
+
+    def _compact_target(self, mb, ddid):
+        if ddid is None:
+            name = mb.name
+        else:
+            name = '%s / view %s' % (mb.name, ddid)
+        try:
+            info = self._size_info(mb, ddid)
+            ratio = fragmentation(info)
+            if ratio is not None and ratio < self.threshold:
+                log.debug("Skipping %s (%d%% fragmented)" % (name, ratio * 100))
+                self.stats.record(skipped=1)
+                return
+
+            before = info.get('disk_size', 0)
+            log.info("Compacting %s" % name)
+            mb.compact(ddid)
+            info = self._size_info(mb, ddid)
+            while info.get('compact_running', False) == True:
+                time.sleep(self.poll_interval)
+                info = self._size_info(mb, ddid)
+            after = info.get('disk_size', 0)
+            self.stats.record(compacted=1, reclaimed=max(before - after, 0))
+            log.info("Finished compacting %s" % name)
+            if self.on_progress is not None:
+                self.on_progress(mb, ddid, before, after)
+        except:
+            self.stats.record(errors=1)
+            log.error("Error compacting %s: %s" % (name, traceback.format_exc()))
+
 #####################################################
 #
 # Main mailbox design document 
@@ -397,6 +1088,17 @@ DESIGN_DOC = {
                         emit([doc.source.subscription_id, doc.timestamp], {'_rev': doc._rev});
                     }
                 }
+                """,
+            'reduce':
+                """
+                function(key, values, rereduce) {
+                    if (rereduce == true) {
+                        return sum(values);
+                    }
+                    else {
+                        return values.length;
+                    }
+                }
                 """
         },
 
@@ -409,9 +1111,78 @@ DESIGN_DOC = {
                     }
                 }
                 """
+        },
+
+        'subscriptions_by_next_poll': {
+            'map': 
+                """
+                function(doc) {
+                    if (doc.type == 'subscription') {
+                        // never polled sorts first (null)
+                        emit(doc.next_poll || null, {'_rev': doc._rev});
+                    }
+                }
+                """
         }
     },
     'filters': {
+    },
+    'updates': {
+        # see update_subscription_state
+        'subscription_state': 
+            """
+            function(doc, req) {
+                var headers = {'Content-Type': 'application/json'};
+                if (!doc || doc.type != 'subscription') {
+                    return [null, {'code': 404, 'headers': headers, 
+                                   'body': '{"error": "not_found"}'}];
+                }
+                var state = JSON.parse(req.body);
+                if (doc.last_update && state.last_update && 
+                    doc.last_update > state.last_update) {
+                    return [null, {'headers': headers, 'body': '{"ok": false}'}];
+                }
+                for (var field in state) {
+                    if (field.charAt(0) != '_' && field != 'type' && 
+                        field != 'subscription_type') {
+                        doc[field] = state[field];
+                    }
+                }
+                return [doc, {'headers': headers, 'body': '{"ok": true}'}];
+            }
+            """
+    }
+}
+plugins.register(DESIGN_DOC, DESIGN_DOC_PLUGIN)
+
+# not in the DESIGN_DOC_PLUGIN slot, only mailboxes 
+# limited by size have it (see sync_retention_views)
+RETENTION_DESIGN_DOC = {
+    '_id': '_design/retention',
+    'views': {
+        'message_sizes': {
+            'map':
+                """
+                function(doc) {
+                    if (doc.type == 'message') {
+                        emit(doc.timestamp, {'_rev': doc._rev, 
+                                             'size': JSON.stringify(doc).length});
+                    }
+                }
+                """,
+            'reduce':
+                """
+                function(key, values, rereduce) {
+                    if (rereduce == true) {
+                        return sum(values);
+                    }
+                    var total = 0;
+                    for (var i = 0; i < values.length; i++) {
+                        total += values[i].size;
+                    }
+                    return total;
+                }
+                """
+        }
     }
 }
-plugins.register(DESIGN_DOC, DESIGN_DOC_PLUGIN)
\ No newline at end of file
@@ -0,0 +1,177 @@
+"""
+micro-benchmarks over feed corpora.
+
+usage: python -m radarpost.tests.benchmarks [feed files...]
+
+by default all files in the test data directory are used.
+"""
+import cgi
+import HTMLParser
+import re
+import sys
+import time
+from os import listdir, path
+
+from radarpost.lib import feedparser
+from radarpost.tests.helpers import TEST_DATA_DIR
+
+def timed(fn, repeat):
+    """
+    returns the best time of repeat calls to fn
+    """
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def report(name, baseline, candidate, nbytes):
+    print "%-24s baseline %8.4fs  new %8.4fs  (%.1fx, %.1f MB/s)" % (
+        name, baseline, candidate, baseline / max(candidate, 0.000001),
+        nbytes / max(candidate, 0.000001) / 1000000.0)
+
+def load_corpus(filenames):
+    corpus = []
+    for filename in filenames:
+        corpus.append((filename, open(filename).read()))
+    return corpus
+
+def html_fields(corpus):
+    """
+    returns the text of every title, summary and content
+    in the corpus, as given to strip_tags when creating
+    messages.
+    """
+    fields = []
+    for filename, content in corpus:
+        feed = feedparser.parse(content)
+        for entry in feed.entries:
+            for key in ('title_detail', 'summary_detail'):
+                if key in entry:
+                    fields.append(entry[key].value)
+            for content in entry.get('content', []):
+                fields.append(content.value)
+    return fields
+
+class _HTMLParserStripper(HTMLParser.HTMLParser):
+    """
+    the HTMLParser based stripper that strip_tags replaced,
+    kept as the baseline.
+    """
+    def __init__(self):
+        self.reset()
+        self._text = []
+    def handle_data(self, d):
+        self._text.append(d)
+    def handle_charref(self, name):
+        if name.startswith('x'):
+            base = 16
+            name = name[1:]
+        else:
+            base = 10
+        try:
+            self._text.append(unichr(int(name, base)))
+        except:
+            pass
+    def handle_entityref(self, name):
+        from radarpost.feed import ENTITIES
+        if name in ENTITIES:
+            self._text.append(unichr(ENTITIES[name]))
+    @property
+    def text(self):
+        text = u''
+        for chunk in self._text:
+            if not chunk:
+                continue
+            if chunk.startswith(' '):
+                text += re.sub('^\s+', ' ', chunk)
+            else:
+                text += chunk
+        return text
+
+def _baseline_strip_tags(html):
+    try:
+        stripper = _HTMLParserStripper()
+        stripper.feed(html)
+        return stripper.text
+    except:
+        return cgi.escape(html)
+
+def bench_strip_tags(corpus, repeat=3):
+    from radarpost.feed import strip_tags
+    fields = html_fields(corpus)
+    nbytes = sum(len(f) for f in fields)
+    for field in fields:
+        assert strip_tags(field) == _baseline_strip_tags(field)
+
+    def run(fn, fields):
+        return lambda: [fn(f) for f in fields]
+    report('strip_tags (fields)', timed(run(_baseline_strip_tags, fields), repeat),
+           timed(run(strip_tags, fields), repeat), nbytes)
+
+    # a single long body shows the quadratic behavior
+    # of the baseline.
+    body = [u''.join(fields) * 5]
+    report('strip_tags (long body)', timed(run(_baseline_strip_tags, body), 1),
+           timed(run(strip_tags, body), 1), len(body[0]))
+
+def bench_parse(corpus, repeat=3):
+    from radarpost import fastparse
+    from radarpost.feed import parse
+    url = 'http://example.com/feed'
+    docs = [content for filename, content in corpus]
+    nbytes = sum(len(c) for c in docs)
+    for content in docs:
+        fastparse.parse(content, url) # not falling back
+
+    def run(fast):
+        return lambda: [parse(c, url, fast=fast) for c in docs]
+    report('parse', timed(run(False), repeat), timed(run(True), repeat), nbytes)
+
+    def run_raw():
+        return [fastparse.parse(c, url, raw=True) for c in docs]
+    report('parse (raw html)', timed(run(False), repeat), timed(run_raw, repeat), nbytes)
+
+def bench_dates(corpus, repeat=3):
+    from radarpost import dates
+    values = []
+    for filename, content in corpus:
+        feed = feedparser.parse(content)
+        for entry in feed.entries:
+            for key in ('updated', 'published'):
+                if key in entry:
+                    values.append((entry[key], filename))
+    nbytes = sum(len(v) for v, f in values)
+
+    def baseline():
+        for value, filename in values:
+            feedparser._parse_date(value)
+    def candidate():
+        dates._memo.clear()
+        dates._handler_for_url.clear()
+        for value, filename in values:
+            dates.parse_date(value, filename)
+    # feedparser's own _parse_date now tries parse_date first,
+    # time the baseline without it.
+    feedparser._date_handlers.remove(dates._feedparser_handler)
+    try:
+        report('parse_date', timed(baseline, repeat), timed(candidate, repeat), nbytes)
+    finally:
+        feedparser.registerDateHandler(dates._feedparser_handler)
+
+BENCHMARKS = [bench_strip_tags, bench_parse, bench_dates]
+
+def main(argv):
+    filenames = argv[1:]
+    if not filenames:
+        filenames = [path.join(TEST_DATA_DIR, f) for f in sorted(listdir(TEST_DATA_DIR))]
+    corpus = load_corpus(filenames)
+    print "corpus: %d files, %d bytes" % (len(corpus), sum(len(c) for f, c in corpus))
+    for bench in BENCHMARKS:
+        bench(corpus)
+
+if __name__ == '__main__':
+    main(sys.argv)
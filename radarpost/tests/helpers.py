@@ -145,6 +145,47 @@ def random_feed_info_and_entries(nitems=10):
     info = random_feed_info()
     entries = random_feed_entries(nitems, timestamp=info['timestamp'])
     return info, entries
+
+def serve_http(respond, content_type='application/json', etag=None):
+    """
+    serve the body returned by respond(path) from a local
+    threaded http server.  If etag is given, it is sent with
+    each response and a request that already has it gets a
+    304.  returns the server's url and the server, which 
+    should be shutdown() when done.
+    """
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    import threading
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def do_GET(self):
+            if etag is not None and self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = respond(self.path)
+            self.send_response(200)
+            if etag is not None:
+                self.send_header('ETag', etag)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:%d/' % server.server_address[1], server
     
     
 
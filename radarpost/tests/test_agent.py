@@ -0,0 +1,470 @@
+from helpers import *
+
+def test_poller_updates_all():
+    """
+    create a couple of mailboxes with subscriptions
+    poll them with a handler that fails for some subscriptions
+    assert every subscription was handed to the handler once
+    and that failures were counted without stopping the run.
+    """
+    from threading import Lock
+    from radarpost.agent import Poller
+    from radarpost.feed import FeedSubscription
+
+    mb1 = create_test_mailbox()
+    mb2 = create_test_mailbox(name=TEST_MAILBOX_ID + '_2')
+
+    expected = set()
+    for mb in (mb1, mb2):
+        for i in range(10):
+            sub = FeedSubscription(url='http://example.com/feeds/%d' % i)
+            sub.store(mb)
+            expected.add((mb.name, sub.id))
+
+    seen = []
+    lock = Lock()
+    def handler(mb, sub):
+        with lock:
+            seen.append((mb.name, sub.id))
+        if sub.url.endswith('/3'):
+            raise ValueError('boom')
+
+    poller = Poller(load_test_config(), concurrency=4, per_host=2, 
+                    handler=handler, planners=[])
+    stats = poller.run([mb1, mb2])
+
+    assert len(seen) == len(expected)
+    assert set(seen) == expected
+    assert stats.polled == len(expected)
+    assert stats.errors == 2
+
+class FakeResponse(dict):
+    def __init__(self, status, headers=None):
+        self.status = status
+        if headers is not None:
+            self.update(headers)
+
+class FakeClient(object):
+    """
+    stands in for an httplib2 client, returns the 
+    canned responses given in order and records
+    the request headers it was given.
+    """
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, url, headers=None):
+        self.requests.append((url, headers or {}))
+        return self.responses.pop(0)
+
+def test_poll_conditional_get():
+    """
+    poll a feed that returns validators
+    poll it again and check that the validators are sent
+    check that a 304 leaves the mailbox alone and marks 
+    the subscription unchanged.
+    check that validators sent with a 304 are recorded 
+    and those left out are kept.
+    """
+    from radarpost.agent import poll_feed
+    from radarpost.feed import FeedSubscription
+    from radarpost.mailbox import Message, Subscription
+
+    ff, entries = random_feed_info_and_entries(10)
+    feed_doc = create_atom_feed(ff, entries)
+
+    mb = create_test_mailbox()
+    sub = FeedSubscription(url=ff['url'])
+    sub.store(mb)
+
+    etag = '"abc123"'
+    modified = 'Mon, 01 Nov 2010 12:00:00 GMT'
+    new_etag = '"def456"'
+    client = FakeClient(
+        (FakeResponse(200, {'etag': etag, 'last-modified': modified}), feed_doc),
+        (FakeResponse(304), ''),
+        (FakeResponse(304, {'etag': new_etag}), ''))
+
+    poll_feed(mb, sub, client)
+    sub = FeedSubscription.load(mb, sub.id)
+    assert sub.etag == etag
+    assert sub.last_modified == modified
+    assert sub.status == Subscription.STATUS_OK
+    assert 'If-None-Match' not in client.requests[0][1]
+
+    poll_feed(mb, sub, client)
+    headers = client.requests[1][1]
+    assert headers['If-None-Match'] == etag
+    assert headers['If-Modified-Since'] == modified
+
+    sub = FeedSubscription.load(mb, sub.id)
+    assert sub.status == Subscription.STATUS_UNCHANGED
+    assert sub.etag == etag
+
+    poll_feed(mb, sub, client)
+    assert client.requests[2][1]['If-None-Match'] == etag
+    sub = FeedSubscription.load(mb, sub.id)
+    assert sub.status == Subscription.STATUS_UNCHANGED
+    assert sub.etag == new_etag
+    assert sub.last_modified == modified
+
+    count = 0
+    for r in mb.view(Message.by_timestamp, group=False):
+        count += r.value
+    assert count == len(entries)
+
+def test_poll_feed_fan_out():
+    """
+    subscribe two mailboxes to the same feed
+    poll the feed once for both of them 
+    check that a single fetch updated both mailboxes.
+    """
+    from radarpost.agent.feed import poll_feed_url, plan_feed_polls
+    from radarpost.feed import FeedSubscription
+    from radarpost.mailbox import Message, Subscription
+
+    ff, entries = random_feed_info_and_entries(10)
+    feed_doc = create_atom_feed(ff, entries)
+
+    mb1 = create_test_mailbox()
+    mb2 = create_test_mailbox(name=TEST_MAILBOX_ID + '_2')
+    subscribers = []
+    for mb in (mb1, mb2):
+        sub = FeedSubscription(url=ff['url'])
+        sub.store(mb)
+        subscribers.append((mb, sub))
+
+    jobs, leftover = plan_feed_polls(subscribers, load_test_config())
+    assert len(leftover) == 0
+    assert len(jobs) == 1
+    assert len(jobs[0].subscribers) == 2
+
+    client = FakeClient((FakeResponse(200), feed_doc))
+    results = poll_feed_url(ff['url'], subscribers, client)
+    assert len(client.requests) == 1
+    assert results == [(Subscription.STATUS_OK, len(entries))] * 2
+
+    for mb, sub in subscribers:
+        count = 0
+        for r in mb.view(Message.by_timestamp, group=False):
+            count += r.value
+        assert count == len(entries)
+
+def test_pipeline():
+    """
+    push work through a pipeline with a small depth
+    assert that every result is stored, errors are 
+    handed to the store callable and that the stages
+    never held more than their capacity.
+    """
+    from threading import Lock
+    from radarpost.agent.pipeline import IngestPipeline
+
+    stored = []
+    lock = Lock()
+    def store(ok, value):
+        with lock:
+            stored.append((ok, value))
+        return [('ok', value if ok else 0)]
+
+    results = []
+    pipeline = IngestPipeline(2, depth=2, on_result=lambda status, count: results.append(count))
+    for i in range(20):
+        pipeline.submit(sum, ([i, 1],), store)
+    pipeline.submit(int, ('not a number',), store)
+    # everything is stored by join, the pipeline keeps running.
+    pipeline.join()
+    assert len(stored) == 21
+    pipeline.submit(sum, ([0, 0],), store)
+    pipeline.close()
+    assert stored[-1] == (True, 0)
+    stored.pop()
+    results.remove(0)
+
+    assert sorted([v for ok, v in stored if ok]) == range(1, 21)
+    errors = [v for ok, v in stored if not ok]
+    assert len(errors) == 1 and 'ValueError' in errors[0]
+    assert sorted(results) == [0] + range(1, 21)
+    for stage in pipeline.stages:
+        assert stage.items == 22
+        assert stage.depth == 0
+        assert stage.max_depth <= 2
+
+def _unpicklable_result(value):
+    return lambda: value
+
+def _exit_process(value):
+    import os
+    os._exit(1)
+
+def test_pipeline_errors():
+    """
+    push work whose results cannot be returned, whose 
+    arguments cannot be sent or whose process dies through 
+    a pipeline with a small depth, check that each is stored 
+    as an error and that the pipeline does not block.
+    """
+    from threading import Lock
+    from radarpost.agent.pipeline import IngestPipeline
+
+    stored = []
+    lock = Lock()
+    def store(ok, value):
+        with lock:
+            stored.append((ok, value))
+        return []
+
+    pipeline = IngestPipeline(1, depth=1, parse_timeout=3)
+    for i in range(3):
+        pipeline.submit(_unpicklable_result, (i,), store)
+    pipeline.submit(sum, ([lambda: 1],), store)
+    pipeline.submit(_exit_process, (0,), store)
+    pipeline.submit(sum, ([1, 1],), store)
+    pipeline.close()
+
+    assert [ok for ok, v in stored] == [False] * 5 + [True]
+    assert stored[-1] == (True, 2)
+    for stage in pipeline.stages:
+        assert stage.depth == 0
+
+def test_poll_feed_pipeline():
+    """
+    poll a feed handing parsing and storing to a pipeline
+    check that the result is reported by the pipeline and 
+    the items are in the mailbox.
+    """
+    from radarpost.agent.feed import poll_feed_url
+    from radarpost.agent.pipeline import IngestPipeline
+    from radarpost.feed import FeedSubscription
+    from radarpost.mailbox import Message, Subscription
+
+    ff, entries = random_feed_info_and_entries(10)
+    feed_doc = create_atom_feed(ff, entries)
+
+    mb = create_test_mailbox()
+    sub = FeedSubscription(url=ff['url'])
+    sub.store(mb)
+
+    results = []
+    pipeline = IngestPipeline(2, on_result=lambda status, count: results.append((status, count)))
+    client = FakeClient((FakeResponse(200), feed_doc))
+    assert poll_feed_url(ff['url'], [(mb, sub)], client, pipeline=pipeline) == [None]
+    pipeline.close()
+    assert results == [(Subscription.STATUS_OK, len(entries))]
+
+    count = 0
+    for r in mb.view(Message.by_timestamp, group=False):
+        count += r.value
+    assert count == len(entries)
+
+    sub = FeedSubscription.load(mb, sub.id)
+    assert sub.status == Subscription.STATUS_OK
+    assert len(sub.last_ids) == len(entries)
+
+def test_poller_interrupt_writes():
+    """
+    interrupt a poll while an update is waiting in the 
+    writer, check that the update is written anyway.
+    """
+    import thread
+    import time
+    from radarpost.agent.poller import Poller, PollJob
+    from radarpost.feed import FeedSubscription
+
+    class FakeMailbox(object):
+        name = 'rp_test_fake'
+        def __init__(self):
+            self.written = []
+        def update(self, docs):
+            self.written += docs
+            return [(True, doc.id, '2-b') for doc in docs]
+
+    mb = FakeMailbox()
+    sub = FeedSubscription(id='sub1', url='http://example.org/feed')
+
+    class InterruptedJob(PollJob):
+        def run(self, poll):
+            poll.writer.add(mb, sub, [], ['a', 'b'])
+            thread.interrupt_main()
+            # still running when the interrupt arrives
+            time.sleep(0.5)
+
+    planner = lambda subscriptions, config: ([InterruptedJob()], subscriptions)
+    poller = Poller(load_test_config(), planners=[planner], 
+                    write_batch_size=100, retention_budget=0)
+    try:
+        poller.run([])
+        assert False, 'expected KeyboardInterrupt'
+    except KeyboardInterrupt:
+        pass
+    assert mb.written == [sub]
+    assert sub.last_ids == ['a', 'b']
+
+def test_feed_update_writer():
+    """
+    update several subscriptions in a mailbox through a writer
+    check that the messages and subscription states were written
+    in a couple of requests, that each subscription's count was 
+    reported and that messages that already exist are not counted.
+    """
+    from radarpost.agent.writer import FeedUpdateWriter
+    from radarpost.feed import FeedSubscription, parse, plan_feed_update, create_atom_entry
+    from radarpost.mailbox import Message, Subscription
+
+    mb = create_test_mailbox()
+    reported = []
+    def report(sub):
+        return lambda count: reported.append((sub.id, count))
+
+    writer = FeedUpdateWriter(max_docs=15, max_delay=60)
+    subs = []
+    for i in range(3):
+        ff, entries = random_feed_info_and_entries(5)
+        sub = FeedSubscription(url=ff['url'])
+        sub.store(mb)
+        subs.append((sub, parse(create_atom_feed(ff, entries), ff['url'])))
+        new_messages, current_ids = plan_feed_update(sub, subs[-1][1])
+        writer.add(mb, sub, new_messages, current_ids, 
+                   subscription_delta={'title': 'updated'}, callback=report(sub))
+    writer.close()
+
+    assert sorted(reported) == sorted([(sub.id, 5) for sub, feed in subs])
+    assert writer.requests == 2
+    count = 0
+    for r in mb.view(Message.by_timestamp, group=False):
+        count += r.value
+    assert count == 15
+    for sub, feed in subs:
+        sub = FeedSubscription.load(mb, sub.id)
+        assert sub.status == Subscription.STATUS_OK
+        assert sub.title == 'updated'
+        assert len(sub.last_ids) == 5
+
+    # the same messages again are conflicts
+    sub, feed = subs[0]
+    sub = FeedSubscription.load(mb, sub.id)
+    messages = [create_atom_entry(e, feed, sub) for e in feed.entries]
+    reported = []
+    writer = FeedUpdateWriter(max_docs=15, max_delay=60)
+    writer.add(mb, sub, messages, [m.id for m in messages], callback=report(sub))
+    writer.close()
+    assert reported == [(sub.id, 0)]
+
+def test_schedule_backoff():
+    """
+    check that the poll interval shrinks when new items 
+    are found, grows while unchanged, that errors back off 
+    without disturbing the interval and that server hints 
+    are respected.
+    """
+    from datetime import datetime, timedelta
+    from radarpost.agent.schedule import schedule_delta, is_due
+    from radarpost.feed import FeedSubscription
+    from radarpost.mailbox import Subscription
+
+    config = {'agent.min_interval': 60, 
+              'agent.max_interval': 10000,
+              'agent.default_interval': 1000}
+    now = datetime(2010, 11, 1, 12, 0, 0)
+    sub = FeedSubscription(url='http://example.com/feed')
+    assert is_due(sub, now)
+
+    delta = schedule_delta(sub, Subscription.STATUS_OK, config, new_items=3, now=now)
+    assert delta['poll_interval'] == 500
+    assert delta['next_poll'] == now + timedelta(seconds=500)
+    sub.poll_interval = delta['poll_interval']
+
+    delta = schedule_delta(sub, Subscription.STATUS_UNCHANGED, config, now=now)
+    assert delta['poll_interval'] == 750
+
+    delta = schedule_delta(sub, Subscription.STATUS_ERROR, config, now=now)
+    assert delta['poll_interval'] == 500
+    assert delta['error_count'] == 1
+    assert delta['next_poll'] == now + timedelta(seconds=1000)
+    sub.error_count = 5
+    delta = schedule_delta(sub, Subscription.STATUS_ERROR, config, now=now)
+    assert delta['next_poll'] == now + timedelta(seconds=10000)
+
+    sub.error_count = 0
+    response = FakeResponse(200, {'cache-control': 'public, max-age=3600'})
+    delta = schedule_delta(sub, Subscription.STATUS_OK, config, new_items=1, 
+                           response=response, now=now)
+    assert delta['poll_interval'] == 250
+    assert delta['next_poll'] == now + timedelta(seconds=3600)
+
+    response = FakeResponse(503, {'retry-after': '7200'})
+    delta = schedule_delta(sub, Subscription.STATUS_ERROR, config, 
+                           response=response, now=now)
+    assert delta['next_poll'] == now + timedelta(seconds=7200)
+    sub.next_poll = delta['next_poll']
+    assert not is_due(sub, now)
+    assert is_due(sub, now + timedelta(seconds=7200))
+
+def test_poller_schedule_without_view():
+    """
+    plan the polls of a mailbox that has no schedule view, 
+    check that only the subscriptions that are due are 
+    polled unless the schedule is ignored.
+    """
+    from couchdb.http import ResourceNotFound
+    from datetime import datetime, timedelta
+    from radarpost.agent.poller import Poller
+    from radarpost.feed import FeedSubscription
+    from radarpost.mailbox import Subscription
+
+    now = datetime.utcnow()
+    never = FeedSubscription(id='never', url='http://example.org/never')
+    due = FeedSubscription(id='due', url='http://example.org/due')
+    due.next_poll = now - timedelta(seconds=60)
+    later = FeedSubscription(id='later', url='http://example.org/later')
+    later.next_poll = now + timedelta(seconds=3600)
+
+    class FakeMailbox(object):
+        name = 'rp_test_fake'
+        def view(self, name, wrapper=None, **options):
+            if name == Subscription.by_next_poll:
+                raise ResourceNotFound(('not_found', 'missing'))
+            return [never, due, later]
+
+    mb = FakeMailbox()
+    poller = Poller({}, planners=[])
+    planned = [job.subscription.id for job in poller.plan([mb])]
+    assert planned == ['never', 'due']
+
+    poller = Poller({}, planners=[], ignore_schedule=True)
+    planned = [job.subscription.id for job in poller.plan([mb])]
+    assert planned == ['never', 'due', 'later']
+
+def test_poll_feed_caching_client():
+    """
+    poll a feed through an http client with a cache that 
+    answers the server's 304 from its cache, check that the
+    feed is treated as unchanged.
+    """
+    import shutil
+    import tempfile
+    from radarpost.agent.feed import poll_feed_url
+    from radarpost.feed import FeedSubscription
+    from radarpost.http import create_client
+    from radarpost.mailbox import Subscription
+
+    ff, entries = random_feed_info_and_entries(3)
+    feed_doc = create_atom_feed(ff, entries)
+
+    class FakeMailbox(object):
+        name = 'rp_test_fake'
+
+    tmp = tempfile.mkdtemp()
+    url, server = serve_http(lambda path: feed_doc, content_type='application/atom+xml',
+                             etag='"abc123"')
+    try:
+        client = create_client({'http.allow_local': True, 'http.cache': tmp})
+        client.request(url)
+
+        sub = FeedSubscription(id='sub1', url=url)
+        results = poll_feed_url(url, [(FakeMailbox(), sub)], client)
+        assert results == [(Subscription.STATUS_UNCHANGED, 0)]
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp)
@@ -0,0 +1,90 @@
+from helpers import *
+
+def test_lru_cache():
+    """
+    fill an LRUCache past its size and check that 
+    the least recently used entries are discarded.
+    """
+    from radarpost.cache import LRUCache
+
+    cache = LRUCache(100)
+    for i in range(10):
+        cache.set('key%d' % i, {'i': i}, 'x'*10)
+    assert cache.size == 100
+
+    # use the first key so that it is kept
+    assert cache.get('key0') == ({'i': 0}, 'x'*10)
+    cache.set('key10', {'i': 10}, 'x'*10)
+    assert cache.size <= 100
+    assert cache.get('key0') is not None
+    assert cache.get('key1') is None
+    assert cache.get_meta('key10') == {'i': 10}
+
+    # too big to keep
+    cache.set('big', {}, 'x'*101)
+    assert cache.get('big') is None
+
+def test_disk_cache():
+    """
+    store entries in a DiskCache, check they can be 
+    read back and that the directory stays bounded.
+    """
+    import os
+    import shutil
+    import tempfile
+    from radarpost.cache import DiskCache
+
+    directory = tempfile.mkdtemp()
+    try:
+        cache = DiskCache(directory, 100)
+        cache.set('key', {'status': '200 OK'}, 'hello')
+        assert cache.get_meta('key') == {'status': '200 OK'}
+        assert cache.get('key') == ({'status': '200 OK'}, 'hello')
+        assert cache.get('missing') is None
+
+        for i in range(50):
+            cache.set('key%d' % i, {}, 'x'*10)
+        size = 0
+        for name in os.listdir(directory):
+            if name.endswith('.body'):
+                size += os.path.getsize(os.path.join(directory, name))
+        assert size <= 100
+
+        cache.delete('key49')
+        assert cache.get('key49') is None
+    finally:
+        shutil.rmtree(directory)
+
+def test_disk_cache_overwrite():
+    """
+    overwrite an entry in a DiskCache many times, check
+    that its size is counted once and that a failed write
+    leaves no temporary file behind.
+    """
+    import os
+    import shutil
+    import tempfile
+    from radarpost.cache import DiskCache
+
+    directory = tempfile.mkdtemp()
+    try:
+        cache = DiskCache(directory, 100)
+        cache.set('other', {}, 'y'*50)
+        for i in range(10):
+            cache.set('key', {'i': i}, 'x'*40)
+        assert cache._size == 90
+        assert cache.get('other') == ({}, 'y'*50)
+        assert cache.get('key') == ({'i': 9}, 'x'*40)
+
+        def fail(fd, data):
+            raise OSError('disk full')
+        real_write = os.write
+        os.write = fail
+        try:
+            cache.set('key', {}, 'z'*10)
+        finally:
+            os.write = real_write
+        assert [n for n in os.listdir(directory) if n.endswith('.tmp')] == []
+        assert cache.get('key') == ({'i': 9}, 'x'*40)
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,64 @@
+from helpers import *
+
+def test_pooled_session_slots():
+    """
+    make more requests than the session allows at once,
+    check that a small response frees its slot right
+    away and that a streamed response holds its slot
+    until the body is read or closed.
+    """
+    from radarpost.couch import PooledSession
+
+    small_url, small_server = serve_http(lambda path: '{"ok": true}')
+    large_url, large_server = serve_http(lambda path: '"%s"' % ('x' * 100000))
+    try:
+        session = PooledSession(max_connections=2)
+
+        for i in range(5):
+            status, headers, data = session.request('GET', small_url)
+            assert status == 200
+            assert data.read() == '{"ok": true}'
+
+        status, headers, first = session.request('GET', large_url)
+        status, headers, second = session.request('GET', large_url)
+        # both slots are held by the unread bodies
+        assert not session._slots.acquire(False)
+
+        assert len(first.read()) == 100002
+        assert session._slots.acquire(False)
+        session._slots.release()
+
+        # closing twice frees a single slot
+        second.close()
+        second.close()
+        assert session._slots.acquire(False)
+        assert session._slots.acquire(False)
+        assert not session._slots.acquire(False)
+        session._slots.release()
+        session._slots.release()
+
+        status, headers, data = session.request('GET', small_url)
+        assert status == 200
+    finally:
+        small_server.shutdown()
+        large_server.shutdown()
+
+def test_bounded_cache():
+    """
+    fill a _BoundedCache past its size, check that it
+    stays bounded and that replacing an entry does not
+    evict anything.
+    """
+    from radarpost.couch import _BoundedCache
+
+    cache = _BoundedCache(3)
+    for i in range(3):
+        cache['k%d' % i] = i
+    cache['k0'] = 'replaced'
+    assert len(cache) == 3
+    assert cache['k0'] == 'replaced'
+
+    for i in range(3, 10):
+        cache['k%d' % i] = i
+        assert len(cache) == 3
+    assert cache['k9'] == 9
@@ -198,6 +198,184 @@ def test_feed_delete_sticks():
     for iid in seen_ids:
         assert iid in expected_ids
 
+def test_feed_update_skips_seen():
+    """
+    update a subscription twice with the same feed
+    assert that entries seen last time are not processed again
+    assert that last_ids stays bounded during partial updates
+    """
+    from radarpost import feed as feedmod
+    from radarpost.feed import FeedSubscription, update_feed_subscription, parse, create_atom_entry
+
+    ff, entries = random_feed_info_and_entries(10)
+    url = ff['url']
+    feed = parse(create_atom_feed(ff, entries), url)
+
+    mb = create_test_mailbox()
+    sub = FeedSubscription(url=url)
+    sub.store(mb)
+
+    processed = []
+    def processor(entry, feed, subscription):
+        processed.append(entry.id)
+        return create_atom_entry(entry, feed, subscription)
+
+    assert update_feed_subscription(mb, sub, feed, message_processor=processor) == len(entries)
+    assert len(processed) == len(entries)
+
+    processed = []
+    assert update_feed_subscription(mb, sub, feed, message_processor=processor) == 0
+    assert len(processed) == 0
+    assert len(sub.last_ids) == len(entries)
+
+    old_max = feedmod.MAX_LAST_IDS
+    try:
+        feedmod.MAX_LAST_IDS = 15
+        ff2, entries2 = random_feed_info_and_entries(10)
+        ff2['url'] = url
+        feed2 = parse(create_atom_feed(ff2, entries2), url)
+        update_feed_subscription(mb, sub, feed2, full_update=False)
+        assert len(sub.last_ids) == 15
+    finally:
+        feedmod.MAX_LAST_IDS = old_max
+
+def test_strip_tags():
+    """
+    assert that markup is removed and references are decoded
+    assert that the output is cut off at max_length
+    """
+    from radarpost.feed import strip_tags
+
+    assert strip_tags(u'<p class="x">a <b>b</b></p>') == u'a b'
+    assert strip_tags(u'<a title="1 > 2">c</a><!-- <b>d</b> -->') == u'c'
+    assert strip_tags(u'&lt;&amp;&#65;&#x42;&bogus;') == u'<&AB'
+    assert strip_tags(u'x\n<br/>   y') == u'x\n y'
+    assert strip_tags(u'<em>unterminated') == u'unterminated'
+    assert strip_tags(u'<script>if (a<b) x()</script>after') == u'if (a<b) x()after'
+    assert strip_tags(u'<STYLE type="text/css">a>b {}</style><b>c</b>') == u'a>b {}c'
+    assert strip_tags(u'<script>a<b') == u'a<b'
+    assert strip_tags(u'<p>hello</p> world', max_length=7) == u'hello w'
+    assert len(strip_tags(get_data('bb.xml').decode('utf-8'), max_length=100)) == 100
+
+def test_fast_parse_equivalence():
+    """
+    parse feeds with the fast parser and with feedparser 
+    assert that the same messages are created from both
+    assert that documents the fast parser does not handle
+    are still parsed
+    """
+    from radarpost import fastparse
+    from radarpost.feed import FeedSubscription, parse, create_atom_entry
+
+    ff, entries = random_feed_info_and_entries(10)
+    docs = [(get_data('bb.xml'), 'http://example.com/bb.xml'),
+            # enclosures, itunes and content:encoded with relative links
+            (get_data('rss_enclosures.xml'), 'http://example.com/podcast/feed.rss'),
+            # xhtml content, nested xml:base and relative links
+            (get_data('atom_xhtml.xml'), 'http://example.org/blog/feed.atom'),
+            (create_atom_feed(ff, entries), ff['url'])]
+    for content, url in docs:
+        fastparse.parse(content, url) # not falling back
+        fast = parse(content, url)
+        slow = parse(content, url, fast=False)
+        assert fast.version == slow.version
+        assert len(fast.entries) == len(slow.entries)
+        for fe, se in zip(fast.entries, slow.entries):
+            for key in ('id', 'link', 'links', 'title_detail', 'summary_detail', 
+                        'content', 'tags', 'author_detail', 'updated_parsed',
+                        'published_parsed'):
+                assert fe.get(key) == se.get(key), (url, key)
+
+        sub = FeedSubscription(url=url)
+        for fe, se in zip(fast.entries, slow.entries):
+            fm = create_atom_entry(fe, fast, sub)
+            sm = create_atom_entry(se, slow, sub)
+            assert fm.unwrap() == sm.unwrap()
+
+    not_well_formed = '<rss version="2.0"><channel><title>a&nbsp;b</title></channel></rss>'
+    try:
+        fastparse.parse(not_well_formed, 'http://example.com/')
+        assert False, 'expected UnsupportedFeed'
+    except fastparse.UnsupportedFeed:
+        pass
+    assert parse(not_well_formed, 'http://example.com/').feed.title == u'a\xa0b'
+
+def test_raw_parse():
+    """
+    parse feeds leaving html raw, assert that the html
+    is not sanitized until it is cleaned and that the
+    cleaned values and created messages are the same as
+    when parsing normally.
+    """
+    from radarpost import fastparse
+    from radarpost.feed import FeedSubscription, parse, create_atom_entry
+
+    content = """<?xml version="1.0" encoding="utf-8"?>
+    <rss version="2.0"><channel><title>Feed</title><link>http://example.com/</link>
+    <item><guid>http://example.com/1</guid><title>Item 1</title>
+    <description>&lt;a href="/one"&gt;one&lt;/a&gt;&lt;script&gt;bad()&lt;/script&gt;</description>
+    </item></channel></rss>"""
+    url = 'http://example.com/feed'
+    raw = parse(content, url, raw=True)
+    summary = raw.entries[0].summary_detail
+    assert summary.raw == True
+    assert summary.base == url
+    assert summary.type == 'text/html'
+    assert 'script' in summary.value
+
+    cooked = parse(content, url)
+    assert not 'raw' in cooked.entries[0].summary_detail
+    assert fastparse.clean(summary) == u'<a href="http://example.com/one">one</a>'
+    assert summary.value == cooked.entries[0].summary_detail.value
+    assert not 'raw' in summary
+
+    ff, entries = random_feed_info_and_entries(10)
+    content = create_atom_feed(ff, entries)
+    raw = parse(content, ff['url'], raw=True)
+    cooked = parse(content, ff['url'])
+    sub = FeedSubscription(url=ff['url'])
+    for raw_entry, entry in zip(raw.entries, cooked.entries):
+        rm = create_atom_entry(raw_entry, raw, sub)
+        cm = create_atom_entry(entry, cooked, sub)
+        assert rm.unwrap() == cm.unwrap()
+
+def test_parse_date():
+    """
+    parse dates in various formats with parse_date and
+    with feedparser's date handlers, assert that the
+    results are the same, including when the memo
+    and the remembered handler for a feed are used.
+    """
+    from radarpost.dates import parse_date
+    from radarpost.lib import feedparser
+    from radarpost import dates
+
+    def slow_parse_date(value):
+        for handler in feedparser._date_handlers:
+            if handler is dates._feedparser_handler:
+                continue
+            try:
+                date9 = handler(value)
+                if date9 and len(date9) == 9:
+                    return tuple(date9)
+            except:
+                pass
+
+    samples = ['2010-04-03T12:00:00Z', '2010-04-03T12:00+05:30',
+               '2010-04-03T12:00:00-0800', '2010-04-03T12:00:00.25Z',
+               'Sat, 03 Apr 2010 05:58:24 GMT', 'Sat, 3 Apr 2010 05:58:24 PDT',
+               '03 Apr 2010 05:58 +0200', 'Sat, 03 Apr 10 05:58:24 GMT',
+               'Fri, 2006/09/15 08:19:53 EDT', 'not a date']
+    for url in [None, 'http://example.com/a', 'http://example.com/a']:
+        for value in samples:
+            expected = slow_parse_date(value)
+            parsed = parse_date(value, url)
+            if expected is None:
+                assert parsed is None
+            else:
+                assert tuple(parsed)[:8] == expected[:8]
+    assert tuple(parse_date('2010-04-03T12:00:00+01:00'))[:6] == (2010, 4, 3, 11, 0, 0)
+
 def test_feeds_design_doc():
     """
     tests that the feeds design document is 
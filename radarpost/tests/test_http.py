@@ -0,0 +1,107 @@
+from helpers import *
+
+def test_polling_session_per_host():
+    """
+    make many requests at once to two hosts through a
+    session, check that no more than per_host requests
+    to either host are in flight at once and that the
+    clients are kept for reuse.
+    """
+    from threading import Lock, Thread
+    import time
+    from radarpost.http import PollingSession
+
+    lock = Lock()
+    def responder(state):
+        def respond(path):
+            with lock:
+                state['current'] += 1
+                state['most'] = max(state['most'], state['current'])
+            time.sleep(0.1)
+            with lock:
+                state['current'] -= 1
+            return 'ok'
+        return respond
+
+    state = {'current': 0, 'most': 0}
+    other_state = {'current': 0, 'most': 0}
+    url, server = serve_http(responder(state), content_type='text/plain')
+    other_url, other_server = serve_http(responder(other_state), content_type='text/plain')
+    session = PollingSession({'http.allow_local': True}, per_host=2)
+    try:
+        results = []
+        def fetch(u):
+            response, content = session.request(u)
+            results.append((response.status, content))
+        threads = [Thread(target=fetch, args=(u,)) for u in [url, other_url] * 5]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert results == [(200, 'ok')] * 10
+        assert state['most'] == 2
+        assert other_state['most'] == 2
+        assert session._busy == {}
+        assert sorted([len(idle) for idle in session._idle.values()]) == [2, 2]
+    finally:
+        session.close()
+        server.shutdown()
+        other_server.shutdown()
+
+def test_polling_session_idle_eviction():
+    """
+    leave a session's clients idle past the idle timeout
+    without making any further requests, check that they
+    are closed and dropped.
+    """
+    import time
+    from radarpost.http import PollingSession
+
+    url, server = serve_http(lambda path: 'ok', content_type='text/plain')
+    session = PollingSession({'http.allow_local': True}, idle_timeout=0.5)
+    try:
+        response, content = session.request(url)
+        assert content == 'ok'
+        assert len(session._idle) == 1
+        client, last_used = session._idle.values()[0][0]
+        assert len(client.connections) == 1
+
+        time.sleep(1.5)
+        assert session._idle == {}
+        assert client.connections == {}
+    finally:
+        session.close()
+        server.shutdown()
+
+def test_polling_session_no_cache():
+    """
+    fetch a url with an etag twice with a caching client and
+    with a session configured with the same cache, check 
+    that only the session's second request sees the 304.
+    """
+    import shutil
+    import tempfile
+    from radarpost.http import PollingSession, create_client
+
+    tmp = tempfile.mkdtemp()
+    url, server = serve_http(lambda path: 'ok', content_type='text/plain', 
+                             etag='"abc123"')
+    config = {'http.allow_local': True, 'http.cache': tmp}
+    session = PollingSession(config)
+    try:
+        client = create_client(config)
+        client.request(url)
+        response, content = client.request(url)
+        assert response.status == 200
+        assert response.fromcache
+
+        response, content = session.request(url)
+        assert response.status == 200
+        response, content = session.request(url, headers={'If-None-Match': '"abc123"'})
+        assert response.status == 304
+        assert not response.fromcache
+    finally:
+        session.close()
+        server.shutdown()
+        shutil.rmtree(tmp)
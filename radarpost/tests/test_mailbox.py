@@ -76,6 +76,7 @@ def test_mailbox_trim_sub():
     """
     from datetime import datetime, timedelta
     from radarpost.mailbox import Message, Subscription, trim_subscription
+    from radarpost.mailbox import count_subscription_messages
     
     # create a mailbox 
     mb = create_test_mailbox()
@@ -121,8 +122,11 @@ def test_mailbox_trim_sub():
     for m in other_messages:
         assert m.id in mb
     
+    assert count_subscription_messages(mb, sub1) == 125
+
     subscription = Subscription(id=sub1)
-    trim_subscription(mb, subscription, max_entries=51, batch_size=25)
+    assert trim_subscription(mb, subscription, max_entries=51, batch_size=25) == 74
+    assert count_subscription_messages(mb, sub1) == 51
     
     for i, m in enumerate(messages[:51]):
         assert m.id in mb
@@ -133,4 +137,318 @@ def test_mailbox_trim_sub():
     # irrelevant messages should not have been touched.
     for m in other_messages:
         assert m.id in mb
-    
\ No newline at end of file
+
+    # nothing more to trim
+    assert trim_subscription(mb, subscription, max_entries=51) == 0
+
+    # trimming to nothing removes everything
+    assert trim_subscription(mb, subscription, max_entries=0, batch_size=25) == 51
+    for m in messages:
+        assert not m.id in mb
+    for m in other_messages:
+        assert m.id in mb
+    
+def test_enforce_retention():
+    """
+    set a retention policy on a mailbox
+    add some dated messages for a couple of subscriptions
+    check that enforce_retention deletes at most the number 
+    of messages asked each time, oldest first, until the 
+    mailbox is within the policy.
+    """
+    from datetime import datetime, timedelta
+    from radarpost.mailbox import Message, MailboxInfo, enforce_retention
+
+    mb = create_test_mailbox()
+    info = MailboxInfo.get(mb)
+    info.max_items_per_subscription = 5
+    info.max_age_days = 30
+    info.store(mb)
+
+    now = datetime.utcnow()
+    messages = []
+    other_messages = []
+    for i in range(12):
+        m = Message()
+        m.timestamp = now - timedelta(days=i)
+        m.source.subscription_id = 'sub1'
+        m.store(mb)
+        messages.append(m)
+
+    # too old for the mailbox, but otherwise untouched.
+    for i in range(3):
+        m = Message()
+        m.timestamp = now - timedelta(days=40 + i)
+        m.source.subscription_id = 'sub2'
+        m.store(mb)
+        other_messages.append(m)
+
+    assert enforce_retention(mb, subscription_ids=['sub1'], max_deletes=4, stale=False) == 4
+    assert enforce_retention(mb, subscription_ids=['sub1'], max_deletes=4, stale=False) == 4
+    assert enforce_retention(mb, subscription_ids=['sub1'], max_deletes=4, stale=False) == 2
+    assert enforce_retention(mb, subscription_ids=['sub1'], max_deletes=4, stale=False) == 0
+
+    for m in messages[:5]:
+        assert m.id in mb
+    for m in messages[5:]:
+        assert not m.id in mb
+    for m in other_messages:
+        assert not m.id in mb
+
+def test_enforce_retention_stale():
+    """
+    set a retention policy limiting age, items and bytes
+    bring the views up to date and add nothing since
+    check that enforce_retention with its default stale views 
+    deletes each message outside the policy once and keeps 
+    what is within it.
+    check that the size view is only kept while there 
+    is a byte limit.
+    """
+    from datetime import datetime, timedelta
+    from radarpost.mailbox import Message, MailboxInfo, RETENTION_DESIGN_DOC
+    from radarpost.mailbox import enforce_retention, sync_retention_views, refresh_views
+
+    mb = create_test_mailbox()
+    assert not RETENTION_DESIGN_DOC['_id'] in mb
+
+    now = datetime.utcnow()
+    messages = []
+    for i in range(8):
+        m = Message()
+        m.timestamp = now - timedelta(days=i)
+        m.source.subscription_id = 'sub1'
+        m.store(mb)
+        messages.append(m)
+    old_messages = []
+    for i in range(2):
+        m = Message()
+        m.timestamp = now - timedelta(days=40 + i)
+        m.source.subscription_id = 'sub1'
+        m.store(mb)
+        old_messages.append(m)
+
+    info = MailboxInfo.get(mb)
+    info.max_age_days = 30
+    info.max_items_per_subscription = 5
+    info.max_bytes = 1
+    info.store(mb)
+    assert sync_retention_views(mb, info) == [RETENTION_DESIGN_DOC['_id']]
+    refresh_views(mb)
+
+    # exactly the size of the newest 5 messages
+    keep = [row.id for row in mb.view(Message.by_timestamp, reduce=False, 
+                                      descending=True, limit=5)]
+    assert keep == [m.id for m in messages[:5]]
+    info.max_bytes = sum([row.value['size'] for row in 
+                          mb.view(Message.sizes, reduce=False) if row.id in keep])
+    info.store(mb)
+
+    # the stale views still list the old messages and 
+    # count ten for sub1 after the old ones are deleted.
+    assert enforce_retention(mb, subscription_ids=['sub1']) == 5
+    for m in messages[:5]:
+        assert m.id in mb
+    for m in messages[5:] + old_messages:
+        assert not m.id in mb
+    assert enforce_retention(mb, subscription_ids=['sub1']) == 0
+
+    info.max_bytes = None
+    info.store(mb)
+    assert sync_retention_views(mb, info) == [RETENTION_DESIGN_DOC['_id']]
+    assert not RETENTION_DESIGN_DOC['_id'] in mb
+    assert sync_retention_views(mb, info) == []
+
+def test_sync_mailbox():
+    """
+    sync a mailbox that is up to date, check nothing is written
+    change its design document and sync with staging
+    check the design document is restored and the staging 
+    document is gone.
+    """
+    from radarpost.mailbox import DESIGN_DOC, sync_mailbox, design_doc_digest, staging_id
+
+    mb = create_test_mailbox()
+    rev = mb[DESIGN_DOC['_id']]['_rev']
+    assert sync_mailbox(mb) == []
+    assert mb[DESIGN_DOC['_id']]['_rev'] == rev
+
+    dd = mb[DESIGN_DOC['_id']]
+    del dd['views']['messages_by_timestamp']
+    mb[dd['_id']] = dd
+    assert design_doc_digest(mb[DESIGN_DOC['_id']]) != design_doc_digest(DESIGN_DOC)
+
+    assert sync_mailbox(mb, stage=True) == [DESIGN_DOC['_id']]
+    assert design_doc_digest(mb[DESIGN_DOC['_id']]) == design_doc_digest(DESIGN_DOC)
+    assert not staging_id(DESIGN_DOC['_id']) in mb
+    assert sync_mailbox(mb, stage=True) == []
+
+def test_view_refresher():
+    """
+    touch a couple of mailboxes many times 
+    check that views are refreshed once per mailbox 
+    on flush and when the threshold is passed.
+    """
+    from radarpost import mailbox
+    from radarpost.mailbox import ViewRefresher
+
+    mb1 = create_test_mailbox()
+    mb2 = create_test_mailbox(name=TEST_MAILBOX_ID + '_2')
+
+    refreshed = []
+    real_refresh = mailbox.refresh_views
+    mailbox.refresh_views = lambda mb: refreshed.append(mb.name)
+    try:
+        refresher = ViewRefresher(threshold=10)
+        for i in range(5):
+            refresher.touch(mb1)
+            refresher.touch(mb2)
+        assert refreshed == []
+        refresher.flush()
+        assert sorted(refreshed) == sorted([mb1.name, mb2.name])
+
+        refreshed = []
+        for i in range(10):
+            refresher.touch(mb1)
+        assert refreshed == [mb1.name]
+        refresher.flush()
+        assert refreshed == [mb1.name]
+
+        refreshed = []
+        refresher = ViewRefresher(threshold=10, background=True)
+        refresher.touch(mb1, changes=3)
+        refresher.touch(mb2, changes=30)
+        refresher.flush()
+        refresher.join()
+        assert sorted(refreshed) == sorted([mb1.name, mb2.name])
+    finally:
+        mailbox.refresh_views = real_refresh
+
+def test_compaction_scheduler():
+    """
+    check fragmentation of database info
+    compact a couple of mailboxes and check that 
+    every database and index is compacted.
+    """
+    from radarpost import plugins
+    from radarpost.mailbox import CompactionScheduler, DESIGN_DOC_PLUGIN, fragmentation
+
+    assert fragmentation({'disk_size': 1000, 'data_size': 250}) == 0.75
+    assert fragmentation({'disk_size': 1000, 'data_size': 1000}) == 0.0
+    assert fragmentation({'disk_size': 1000}) is None
+    assert fragmentation({'disk_size': 0, 'data_size': 0}) is None
+
+    mb1 = create_test_mailbox()
+    mb2 = create_test_mailbox(name=TEST_MAILBOX_ID + '_2')
+
+    progress = []
+    scheduler = CompactionScheduler(concurrency=2, threshold=0.0, poll_interval=0.1,
+                                    on_progress=lambda *args: progress.append(args))
+    stats = scheduler.run([mb1, mb2])
+
+    targets = 1 + len(plugins.get(DESIGN_DOC_PLUGIN))
+    assert stats.mailboxes == 2
+    assert stats.errors == 0
+    assert stats.compacted == 2 * targets
+    assert len(progress) == 2 * targets
+    assert len([p for p in progress if p[0] is mb1]) == targets
+
+def test_update_subscription_state():
+    """
+    record the state of a subscription that was changed
+    since it was loaded, check that the state is recorded 
+    without disturbing the other change, that an older 
+    state is ignored and that the state is still recorded
+    when the update handler is missing.
+    """
+    from datetime import datetime, timedelta
+    from radarpost.feed import FeedSubscription
+    from radarpost.mailbox import Subscription, update_subscription_state
+
+    mb = create_test_mailbox()
+    sub = FeedSubscription(url='http://example.com/feed', title='old title')
+    sub.store(mb)
+
+    # changed by someone else
+    other = FeedSubscription.load(mb, sub.id)
+    other.title = 'new title'
+    other.store(mb)
+
+    now = datetime.utcnow().replace(microsecond=0)
+    update_subscription_state(mb, sub, {'status': Subscription.STATUS_OK, 
+                                        'last_update': now, 
+                                        'etag': '"abc"'})
+    stored = FeedSubscription.load(mb, sub.id)
+    assert stored.title == 'new title'
+    assert stored.status == Subscription.STATUS_OK
+    assert stored.last_update == now
+    assert stored.etag == '"abc"'
+    assert sub.rev == stored.rev
+
+    update_subscription_state(mb, stored, {'status': Subscription.STATUS_ERROR, 
+                                           'last_update': now - timedelta(seconds=60)})
+    stored = FeedSubscription.load(mb, sub.id)
+    assert stored.status == Subscription.STATUS_OK
+
+    dd = mb['_design/mailbox']
+    del dd['updates']
+    mb[dd.id] = dd
+    later = now + timedelta(seconds=60)
+    update_subscription_state(mb, sub, {'status': Subscription.STATUS_UNCHANGED, 
+                                        'last_update': later})
+    stored = FeedSubscription.load(mb, sub.id)
+    assert stored.title == 'new title'
+    assert stored.status == Subscription.STATUS_UNCHANGED
+    assert stored.last_update == later
+
+def test_mailbox_registry():
+    """
+    register a mailbox, check that it is listed from the 
+    registry with its title, unregister it and check that
+    rebuilding the registry finds it again.
+    """
+    from couchdb import Server
+    from radarpost.mailbox import MailboxInfo, get_registry, register_mailbox
+    from radarpost.mailbox import unregister_mailbox, iter_registrations
+    from radarpost.mailbox import iter_mailboxes, rebuild_registry, create_mailbox
+
+    config = load_test_config()
+    couchdb = Server(config['couchdb.address'])
+    name = config['couchdb.registry_database']
+    if name in couchdb:
+        del couchdb[name]
+    registry = get_registry(couchdb, name)
+
+    mb = create_test_mailbox()
+    info = MailboxInfo.get(mb)
+    info.title = 'Registered'
+    info.store(mb)
+
+    register_mailbox(registry, mb)
+    regs = list(iter_registrations(registry, prefix=TEST_MAILBOX_ID))
+    assert len(regs) == 1
+    assert regs[0].db_name == mb.name
+    assert regs[0].title == 'Registered'
+    assert [x.name for x in iter_mailboxes(couchdb, prefix=TEST_MAILBOX_ID, 
+                                           registry=registry)] == [mb.name]
+
+    unregister_mailbox(registry, mb.name)
+    assert len(list(iter_registrations(registry, prefix=TEST_MAILBOX_ID))) == 0
+
+    rebuild_registry(couchdb, registry, prefix=TEST_MAILBOX_ID)
+    regs = list(iter_registrations(registry, prefix=TEST_MAILBOX_ID))
+    assert mb.name in [r.db_name for r in regs]
+
+    # listing from an empty registry rebuilds it first
+    unregister_mailbox(registry, mb.name)
+    assert [x.name for x in iter_mailboxes(couchdb, prefix=TEST_MAILBOX_ID, 
+                                           registry=registry)] == [mb.name]
+    regs = list(iter_registrations(registry, prefix=TEST_MAILBOX_ID))
+    assert [r.db_name for r in regs] == [mb.name]
+
+    # mailboxes are registered as they are created
+    del couchdb[mb.name]
+    unregister_mailbox(registry, mb.name)
+    mb = create_mailbox(couchdb, mb.name, registry=registry)
+    regs = list(iter_registrations(registry, prefix=TEST_MAILBOX_ID))
+    assert [r.db_name for r in regs] == [mb.name]
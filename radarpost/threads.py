@@ -0,0 +1,20 @@
+"""
+Helpers for the thread pools used by the agent and commands.
+"""
+
+__all__ = ['join_all', 'JOIN_INTERVAL']
+
+JOIN_INTERVAL = 1.0
+
+def join_all(threads):
+    """
+    wait for each of the threads given to finish.
+
+    A plain join() blocks signals in the main thread until
+    it returns, so each thread is joined with a timeout in
+    a loop to keep the main thread responsive to
+    KeyboardInterrupt.
+    """
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(JOIN_INTERVAL)
@@ -1,6 +1,8 @@
+import base64
 import copy
 from couchdb import ResourceConflict
 from couchdb import ResourceNotFound, PreconditionFailed
+from couchdb.mapping import DateTimeField
 from datetime import datetime
 import html5lib
 from html5lib import treebuilders
@@ -8,10 +10,12 @@ import json
 import logging
 import re
 import traceback
+from urllib import urlencode
 from xml.etree import cElementTree as etree
 from webob import Response as HttpResponse
 from radarpost.lib import feedparser
 from radarpost.mailbox import create_mailbox as _create_mailbox, is_mailbox
+from radarpost.mailbox import register_mailbox, unregister_mailbox
 from radarpost.mailbox import Message, MESSAGE_TYPE, MailboxInfo
 from radarpost.mailbox import Subscription, SUBSCRIPTION_TYPE
 from radarpost import plugins
@@ -21,7 +25,8 @@ from radarpost import http
 from radarpost.user import User, ROLE_ADMIN
 from radarpost.user import PERM_CREATE, PERM_READ, PERM_UPDATE, PERM_DELETE
 from radarpost.user import PERM_CREATE_MAILBOX
-from radarpost.web.context import TemplateContext, check_etag, get_mailbox_etag
+from radarpost.web.context import TemplateContext, check_etag
+from radarpost.web.context import cached_response, cached_fragment, template_version
 
 log = logging.getLogger(__name__)
 
@@ -241,7 +246,7 @@ def mailbox_exists(request, mailbox_slug):
     if mb is None:
         return HttpResponse(status=404)
     
-    etag = get_mailbox_etag(mb)
+    etag = ctx.get_mailbox_etag(mb)
     cached = check_etag(request, etag)
     if cached is not None:
         return cached
@@ -268,12 +273,16 @@ def create_mailbox(request, mailbox_slug):
         
         ctx = request.context
         dbname = ctx.get_database_name(mailbox_slug)
-        mb = _create_mailbox(ctx.get_couchdb_server(), dbname)
+        couchdb = ctx.get_couchdb_server()
+        registry = ctx.get_mailbox_registry(couchdb)
+        mb = _create_mailbox(couchdb, dbname, registry=registry)
+        mbinfo = MailboxInfo.get(mb)
         if info is not None and len(info) > 0:
-            mbinfo = MailboxInfo.get(mb)
             for k, v in info.items():
                 setattr(mbinfo, k, v)
             mbinfo.store(mb)
+            if registry is not None:
+                register_mailbox(registry, mb, mbinfo)
 
         return HttpResponse(status=201)
     except PreconditionFailed:
@@ -304,6 +313,10 @@ def update_mailbox(request, mailbox_slug):
         except: 
             return HttpResponse(status=400)
         mbinfo.store(mb)
+
+        registry = ctx.get_mailbox_registry(couchdb)
+        if registry is not None:
+            register_mailbox(registry, mb, mbinfo)
         
         return HttpResponse()
     except ResourceNotFound:
@@ -334,6 +347,10 @@ def delete_mailbox(request, mailbox_slug):
         if not ctx.user.has_perm(PERM_DELETE, mb):
             return HttpResponse(status=401)
         del couchdb[dbname]
+
+        registry = ctx.get_mailbox_registry(couchdb)
+        if registry is not None:
+            unregister_mailbox(registry, dbname)
         return HttpResponse()
     except ResourceNotFound:
         return HttpResponse(status=404)
@@ -355,7 +372,11 @@ radar/atom/entry/<message_type>.xml
 Specifically, the slot is filled with callables that accept a Message 
 and a Request, and produce a zero argument callable returning the text
 of an atom entry representing the Message.  If the Message cannot be handled,
-None should be returned. eg: 
+None should be returned.  
+
+The output is cached by the Message's id and revision, see 
+radarpost.web.context.cached_fragment for how to version or 
+opt out of caching. eg: 
 
 @plugin(ATOM_RENDERER_PLUGIN)
 def _render_empty(message, request):
@@ -366,9 +387,17 @@ def _render_empty(message, request):
 
 DEFAULT_ATOM_ENTRIES = 25
 MAX_ATOM_ENTRIES = 100
+# number of messages fetched at once while streaming
+ATOM_BATCH_SIZE = 50
+# updated time of a feed for a mailbox with no messages
+EMPTY_FEED_UPDATED = datetime(1970, 1, 1)
 def atom_feed_latest(request, mailbox_slug):
     """
-    renders the mailbox as an atom feed
+    renders the mailbox as an atom feed, newest first.
+
+    The feed is paged (RFC 5005) using opaque 'cursor' 
+    parameters given in rel="next" links.  Entries are 
+    streamed to the client as they are rendered.
     """
     ctx = request.context
     mb = ctx.get_mailbox(mailbox_slug)
@@ -378,11 +407,17 @@ def atom_feed_latest(request, mailbox_slug):
     if not ctx.user.has_perm(PERM_READ, mb):
         return HttpResponse(status=401)
 
-    etag = get_mailbox_etag(mb)
+    etag = ctx.get_mailbox_etag(mb)
     cached = check_etag(request, etag)
     if cached is not None: 
         return cached
 
+    # the feed is the same for every reader until the mailbox changes, 
+    # its links are absolute so it depends on the host asked for too.
+    return cached_response(request, 'atom:%s:%s%s' % (etag, request.host_url, request.path_qs),
+                           lambda: _render_atom_feed_latest(request, mb, etag))
+
+def _render_atom_feed_latest(request, mb, etag):
     # number of entries
     try:
         limit = min(int(request.GET.get('limit', DEFAULT_ATOM_ENTRIES)), 
@@ -390,24 +425,67 @@ def atom_feed_latest(request, mailbox_slug):
     except:
         return HttpResponse(status=400)
 
-    params = {'limit': limit, 
-              'include_docs': True,
-              'reduce': False,
-              'descending': True}
+    # starting point 
+    start = {}
+    if 'cursor' in request.GET:
+        try:
+            start['startkey'], start['startkey_docid'] = _decode_cursor(request.GET['cursor'])
+        except:
+            return HttpResponse(status=400)
+    elif 'startkey' in request.GET:
+        # point in time
+        start['startkey'] = request.GET['startkey']
+
+    # the rows of the page plus one more, which is where the 
+    # next page starts.  docs are fetched as they are rendered.
+    params = {'reduce': False, 'descending': True, 'limit': limit + 1}
+    params.update(start)
+    rows = mb.view(Message.by_timestamp, **params).rows
+    next_link = None
+    if len(rows) > limit:
+        row = rows[limit]
+        next_link = '%s?%s' % (request.path_url, 
+                               urlencode({'limit': limit, 
+                                          'cursor': _encode_cursor(row.key, row.id)}))
+
+    # the feed was last updated by its newest message, the 
+    # newest in the mailbox if paged past the last one.
+    newest = rows[:1]
+    if len(newest) == 0 and start:
+        newest = mb.view(Message.by_timestamp, reduce=False, descending=True, limit=1).rows
+    if len(newest) > 0:
+        updated = DateTimeField()._to_python(newest[0].key)
+    else:
+        updated = EMPTY_FEED_UPDATED
+
+    latest_messages = _iter_messages(mb, [row.id for row in rows[:limit]])
+    return _render_atom_feed(request, mb, latest_messages, updated, 
+                             etag=etag, next_link=next_link)
 
-    # starting point in time
-    if 'startkey' in request.GET:
-        params['startkey'] = request.GET['startkey']
+def _iter_messages(mb, ids):
+    """
+    lazily iterate the messages with the ids given, fetching 
+    ATOM_BATCH_SIZE messages at once.  messages deleted in the 
+    meantime are left out.
+    """
+    for i in range(0, len(ids), ATOM_BATCH_SIZE):
+        for row in mb.view('_all_docs', keys=ids[i:i + ATOM_BATCH_SIZE], include_docs=True):
+            if row.doc is not None:
+                yield Message.wrap(row.doc)
 
-    latest_messages = Message.view(mb, Message.by_timestamp, **params) 
-    return _render_atom_feed(request, mb, latest_messages)
+def _encode_cursor(key, docid):
+    return base64.urlsafe_b64encode(json.dumps([key, docid]))
 
-def _render_atom_feed(request, mb, messages):    
-    entries = []
-    for message in messages:
-        renderer = _get_atom_renderer(message, request)
-        if renderer is not None:
-            entries.append(renderer)
+def _decode_cursor(cursor):
+    key, docid = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    return key, docid
+
+def _render_atom_feed(request, mb, messages, updated, etag=None, next_link=None):
+    def entries():
+        for message in messages:
+            renderer = _get_atom_renderer(message, request)
+            if renderer is not None:
+                yield renderer
 
     info = MailboxInfo.get(mb)
     
@@ -416,15 +494,22 @@ def _render_atom_feed(request, mb, messages):
     template_info = TemplateContext(request,
           {'id': feed_url,
            'self_link': feed_url,
-           'updated': datetime.utcnow(), # XXX
+           'next_link': next_link,
+           'updated': updated,
            'title': info.title or request.context.get_mailbox_slug(mb.name),
-           'entries': entries,
+           'entries': entries(),
           })
 
+    if etag is None:
+        etag = request.context.get_mailbox_etag(mb)
+
     res = HttpResponse(content_type='application/atom+xml')
     res.charset = 'utf-8'
-    res.unicode_body = request.context.render('radar/atom/atom.xml', template_info)
-    res.headers['etag'] = get_mailbox_etag(mb)
+    # stream the feed as it is rendered.
+    template = request.context.get_template('radar/atom/atom.xml')
+    res.app_iter = (chunk.encode('utf-8') for chunk in 
+                    template.generate(template_info))
+    res.headers['etag'] = etag
     
     return res
 
@@ -433,7 +518,7 @@ def _get_atom_renderer(message, request):
     for renderer in plugins.get(ATOM_RENDERER_PLUGIN):
         r = renderer(message, request)
         if r is not None:
-            return r
+            return cached_fragment(request, message, renderer, r)
     return None
 
 
@@ -446,6 +531,7 @@ def _render_from_type_template(message, request):
     def render_entry():
         return template.render(TemplateContext(request, 
                                {'message': message}))
+    render_entry.version = template_version(template)
     return render_entry
 
 def _atom_type_template(message, request, force_type=None):
@@ -932,6 +932,83 @@ class TestAtomFeeds(RadarTestCase):
         c.get(feed_url, headers=[('if-none-match', '"%s"' % etag)], status=304)        
 
 
+    def test_atom_feed_paging(self):
+        """
+        page through a feed whose items share timestamps 
+        by following rel="next" links, check every item 
+        is seen exactly once.
+        """
+        from datetime import datetime
+        from radarpost.feed import parse as parse_feed, AtomEntry
+
+        c = self.get_test_app()
+        slug = self.TEST_MAILBOX_SLUG
+        mb = self.create_test_mailbox(slug)
+        
+        base_date = datetime(1999, 12, 29, 0)
+        expected = set()
+        for i in range(10):
+            item_id = 'TestItem%d' % i
+            item = AtomEntry(
+                fingerprint = item_id,
+                entry_id = item_id,
+                # pairs of items with the same timestamp
+                timestamp = base_date.replace(minute=i/2),
+                title = 'Test Item %d' % i,
+                content = "Blah Blah %d" % i,
+            )
+            item.store(mb)
+            expected.add(item_id)
+
+        feed_url = self.url_for('atom_feed', mailbox_slug=slug) + '?limit=3'
+        seen = []
+        pages = 0
+        while feed_url is not None:
+            response = c.get(feed_url, status=200)
+            ff = parse_feed(response.body, feed_url)
+            pages += 1
+            assert len(ff.entries) <= 3
+            seen += [e.id for e in ff.entries]
+            feed_url = None
+            for link in ff.feed.get('links', []):
+                if link.rel == 'next':
+                    feed_url = link.href
+
+        assert pages == 4
+        assert len(seen) == len(expected)
+        assert set(seen) == expected
+
+    def test_atom_feed_cache_host(self):
+        """
+        with the response cache on, ask for the same feed 
+        using different hosts, check that each gets links 
+        to its own host and that updated is the time of 
+        the newest item.
+        """
+        import copy
+        from datetime import datetime
+        from radarpost.feed import parse as parse_feed, AtomEntry
+        from radarpost.web.app import make_app
+        from webtest import TestApp
+
+        config = copy.deepcopy(self.config)
+        config['web.response_cache'] = 'memory'
+        c = TestApp(make_app(config))
+        slug = self.TEST_MAILBOX_SLUG
+        mb = self.create_test_mailbox(slug)
+        for i in range(2):
+            AtomEntry(fingerprint='TestItem%d' % i, entry_id='TestItem%d' % i,
+                      timestamp=datetime(1999, 12, 29, i), title='Test Item %d' % i,
+                      content='Blah Blah %d' % i).store(mb)
+
+        feed_url = self.url_for('atom_feed', mailbox_slug=slug)
+        for host in ['a.example.org', 'b.example.org', 'a.example.org']:
+            res = c.get(feed_url, extra_environ={'HTTP_HOST': host}, status=200)
+            ff = parse_feed(res.body, feed_url)
+            assert ff.feed.id == 'http://%s%s' % (host, feed_url)
+            assert ff.feed.updated_parsed[:4] == (1999, 12, 29, 1)
+
+
 class TestOPML(RadarTestCase):
     
     def test_opml_empty_get(self):
@@ -86,8 +86,14 @@ def _get_action(match):
 def parse_web_config(config):
     if 'web.apps' in config: 
         config['web.apps'] = [x.strip() for x in config['web.apps'].split(',')]
-    if 'web.debug' in config:
-        config['web.debug'] = parse_bool(config['web.debug'])
+    for key in ['web.debug', 'web.watch_changes']:
+        if key in config:
+            config[key] = parse_bool(config[key])
+    for key in ['web.template_cache_size', 'web.response_cache_size', 
+                'web.response_cache_max_item', 'web.watch_timeout',
+                'web.fragment_cache_size']:
+        if key in config:
+            config[key] = int(config[key])
 
 @plugins.plugin(CONFIG_INI_PARSER_PLUGIN)
 def parse_cherrypy_config(config):
@@ -0,0 +1,150 @@
+"""
+Follows the CouchDB server's _db_updates feed so that the 
+update_seq of a mailbox can be known without asking CouchDB 
+on every request.
+"""
+from couchdb import Server
+from couchdb.http import ResourceNotFound, ServerError
+import logging
+import threading
+import time
+import traceback
+
+__all__ = ['ChangeWatcher', 'get_change_watcher']
+
+log = logging.getLogger(__name__)
+
+DEFAULT_WATCH_TIMEOUT = 60
+RETRY_DELAY = 5
+
+class ChangeWatcher(object):
+    """
+    Remembers the update_seq of each database asked about and 
+    forgets it as soon as the _db_updates feed reports that the 
+    database has changed.  While the feed is not being followed 
+    (not yet heard from, disconnected or unsupported by the server, 
+    which includes the 1.x feed that cannot resume from a sequence)
+    update_seq falls back to asking CouchDB every time.
+    """
+
+    def __init__(self, address, timeout=DEFAULT_WATCH_TIMEOUT):
+        # a dedicated connection, this one is held open 
+        # most of the time.
+        self.server = Server(address)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._seqs = {}
+        self._generations = {}
+        # bumped whenever everything is forgotten
+        self._epoch = 0
+        self._last_heard = None
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='change-watcher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+
+    @property
+    def is_fresh(self):
+        """
+        True if the feed has been heard from recently enough 
+        to trust what is remembered.
+        """
+        last_heard = self._last_heard
+        if last_heard is None:
+            return False
+        return time.time() - last_heard < self.timeout * 2
+
+    def update_seq(self, db):
+        """
+        get the current update_seq of the database given.
+        """
+        if not self.is_fresh:
+            return db.info()['update_seq']
+
+        with self._lock:
+            seq = self._seqs.get(db.name)
+            generation = (self._epoch, self._generations.get(db.name, 0))
+        if seq is not None:
+            return seq
+
+        seq = db.info()['update_seq']
+        with self._lock:
+            # only remember it if nothing changed in the meantime.
+            if (self._epoch, self._generations.get(db.name, 0)) == generation:
+                self._seqs[db.name] = seq
+        return seq
+
+    def _changed(self, db_name):
+        with self._lock:
+            self._seqs.pop(db_name, None)
+            self._generations[db_name] = self._generations.get(db_name, 0) + 1
+
+    def _forget_all(self):
+        with self._lock:
+            self._last_heard = None
+            self._seqs = {}
+            self._epoch += 1
+
+    def _run(self):
+        since = 'now'
+        while not self._stopped:
+            try:
+                params = {'feed': 'longpoll', 
+                          'timeout': self.timeout * 1000,
+                          'since': since}
+                status, headers, data = self.server.resource.get_json('_db_updates', **params)
+                if not 'results' in data:
+                    # couchdb 1.x reports one update per request and 
+                    # cannot resume from a sequence, anything that 
+                    # changes between requests would be missed.
+                    log.error("CouchDB server's _db_updates cannot resume, not watching for changes.")
+                    self._forget_all()
+                    return
+                for update in data['results']:
+                    self._changed(update['db_name'])
+                since = data.get('last_seq', since)
+                self._last_heard = time.time()
+            except (ResourceNotFound, ServerError):
+                log.error("CouchDB server does not support _db_updates, not watching for changes.")
+                self._forget_all()
+                return
+            except:
+                # updates may have been missed, start over 
+                # from what is current.
+                self._forget_all()
+                since = 'now'
+                log.error("error following _db_updates: %s" % traceback.format_exc())
+                time.sleep(RETRY_DELAY)
+        self._forget_all()
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+def get_change_watcher(config):
+    """
+    get the running ChangeWatcher for the configured 
+    CouchDB server or None if changes are not watched 
+    (web.watch_changes)
+    """
+    if not config.get('web.watch_changes', False):
+        return None
+    address = config['couchdb.address']
+    watcher = _watchers.get(address)
+    if watcher is None:
+        with _watchers_lock:
+            watcher = _watchers.get(address)
+            if watcher is None:
+                watcher = ChangeWatcher(address, 
+                    timeout=config.get('web.watch_timeout', DEFAULT_WATCH_TIMEOUT))
+                watcher.start()
+                _watchers[address] = watcher
+    return watcher
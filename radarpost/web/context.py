@@ -1,7 +1,7 @@
 import base64
-from couchdb import Server, ResourceNotFound
+from couchdb import ResourceNotFound
 from hashlib import md5
-from jinja2 import Environment
+from jinja2 import Environment, FileSystemBytecodeCache
 from jinja2.loaders import ChoiceLoader, PackageLoader
 import logging
 import mimetypes
@@ -10,13 +10,18 @@ from pytz import timezone, utc
 import routes
 from routes.route import Route
 import sys
+import threading
 import traceback
 from webob import Response as HttpResponse
 from webob.etag import ETagMatcher
 
+from radarpost.cache import LRUCache, DiskCache
+from radarpost import couch
+from radarpost.web.changes import get_change_watcher
 from radarpost import plugins
 from radarpost.plugins import plugin
 from radarpost.mailbox import iter_mailboxes as _iter_mailboxes
+from radarpost.mailbox import get_registry as _get_registry
 from radarpost.user import User, AnonymousUser
 from radarpost.user import PERM_CREATE, PERM_READ, PERM_UPDATE, PERM_DELETE
 from radarpost.user import PERM_CREATE_MAILBOX
@@ -24,6 +29,9 @@ from radarpost.user import PERM_CREATE_MAILBOX
 __all__ = ['RequestContext', 'build_routes', 
            'get_couchdb_server', 'get_database_name', 'get_mailbox_slug',
            'get_mailbox', 'get_mailbox_db_prefix', 'iter_mailboxes',
+           'get_mailbox_registry', 'get_template_env',
+           'get_response_cache', 'cached_response',
+           'get_fragment_cache', 'cached_fragment', 'template_version',
            'TEMPLATE_FILTERS','TEMPLATE_CONTEXT_PROCESSORS']
 
 log = logging.getLogger(__name__)
@@ -42,7 +50,7 @@ class RequestContext(object):
     def __init__(self, request, config):
         self.request = request
         self.config = config
-        self.template_env = _make_template_env(config)
+        self.template_env = get_template_env(config)
         self._current_user = None
         
     def url_for(self, *args, **kw):
@@ -162,6 +170,20 @@ class RequestContext(object):
     def iter_mailboxes(self, couchdb=None):
         return iter_mailboxes(self.config, couchdb=couchdb)
 
+    def get_mailbox_etag(self, mailbox):
+        """
+        generate a string that uniquely identifies the current
+        state of the given mailbox.
+        """
+        return get_mailbox_etag(mailbox, watcher=get_change_watcher(self.config))
+
+    def get_mailbox_registry(self, couchdb=None):
+        """
+        get the database listing all mailboxes or None if
+        no registry is configured.
+        """
+        return get_mailbox_registry(self.config, couchdb=couchdb)
+
 ################################
 
 def app_ids(config):
@@ -251,11 +273,48 @@ def render_to_response(template_name, template_context):
     ctx = template_context.request.context
     return HttpResponse(ctx.get_template(template_name).render(template_context))
 
+DEFAULT_TEMPLATE_CACHE_SIZE = 400
+
+_template_envs = {}
+_template_envs_lock = threading.Lock()
+
+def get_template_env(config):
+    """
+    get the template environment for the given configuration.
+    The environment is shared by every request made with an 
+    equivalent configuration so that compiled templates are 
+    reused across requests.
+    """
+    key = _template_env_key(config)
+    env = _template_envs.get(key)
+    if env is None:
+        with _template_envs_lock:
+            env = _template_envs.get(key)
+            if env is None:
+                env = _make_template_env(config)
+                _template_envs[key] = env
+    return env
+
+def _template_env_key(config):
+    return (tuple(app_ids(config)),
+            config.get('web.debug', False),
+            config.get('web.template_cache_size', DEFAULT_TEMPLATE_CACHE_SIZE),
+            config.get('web.template_bytecode_cache'))
+
 def _make_template_env(config):
     loader = ChoiceLoader([
         PackageLoader(package) for package in app_ids(config)
     ])
 
+    # compiled templates may also be kept on disk 
+    # to speed up starting new processes.
+    bytecode_cache = None
+    cache_dir = config.get('web.template_bytecode_cache')
+    if cache_dir:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
     def escape_ml(template_name):
         if template_name is None:
             return False
@@ -264,7 +323,12 @@ def _make_template_env(config):
 
     env = Environment(loader=loader,
                       autoescape=escape_ml,
-                      extensions=['jinja2.ext.autoescape'])
+                      extensions=['jinja2.ext.autoescape'],
+                      cache_size=config.get('web.template_cache_size', 
+                                            DEFAULT_TEMPLATE_CACHE_SIZE),
+                      bytecode_cache=bytecode_cache,
+                      # only check for modified templates while debugging
+                      auto_reload=config.get('web.debug', False))
     for filt in plugins.get(TEMPLATE_FILTERS):
         env.filters[filt.__name__] = filt
 
@@ -437,14 +501,195 @@ def serve_static_file(request, path):
 
 ###################
 
-def get_mailbox_etag(mailbox):
+def get_mailbox_etag(mailbox, watcher=None):
     """
     generate a string that uniquely identifies the current
-    state of the given mailbox.
+    state of the given mailbox.  If a ChangeWatcher is given, 
+    it is used to avoid asking CouchDB for the mailbox's state.
     """
-    info = mailbox.info()
+    if watcher is not None:
+        update_seq = watcher.update_seq(mailbox)
+    else:
+        update_seq = mailbox.info()['update_seq']
     # digest of "dbname@update_seq"
-    return md5("%s@%d" % (info['db_name'], info['update_seq'])).hexdigest()
+    return md5("%s@%s" % (mailbox.name, update_seq)).hexdigest()
+
+#############################
+#
+# Rendered response cache
+#
+#############################
+
+DEFAULT_RESPONSE_CACHE_SIZE = 64*1024*1024
+DEFAULT_RESPONSE_CACHE_MAX_ITEM = 4*1024*1024
+
+_response_caches = {}
+_response_caches_lock = threading.Lock()
+
+def get_response_cache(config):
+    """
+    get the cache of rendered responses given by the 
+    configuration (web.response_cache = memory | disk) or
+    None if responses should not be cached.
+    """
+    kind = config.get('web.response_cache')
+    if not kind or kind == 'none':
+        return None
+    size = config.get('web.response_cache_size', DEFAULT_RESPONSE_CACHE_SIZE)
+    directory = config.get('web.response_cache_dir')
+    key = (kind, size, directory)
+    cache = _response_caches.get(key)
+    if cache is None:
+        with _response_caches_lock:
+            cache = _response_caches.get(key)
+            if cache is None:
+                if kind == 'memory':
+                    cache = LRUCache(size)
+                elif kind == 'disk':
+                    if not directory:
+                        raise ValueError('web.response_cache_dir must be specified for a disk cache')
+                    cache = DiskCache(directory, size)
+                else:
+                    raise ValueError('Unknown response cache type "%s"' % kind)
+                _response_caches[key] = cache
+    return cache
+
+def cached_response(request, key, render):
+    """
+    answer the request from the response cache if possible,
+    otherwise render() is called to produce a response that is 
+    cached as it is sent.  HEAD requests are answered using
+    only the metadata of the cached response.
+
+    key - a string identifying everything the response depends on,
+          eg. the mailbox etag and the query string.
+    """
+    cache = get_response_cache(request.context.config)
+    if cache is None:
+        return render()
+
+    if request.method == 'HEAD':
+        meta = cache.get_meta(key)
+        if meta is not None:
+            res = HttpResponse(status=meta['status'], headerlist=list(meta['headers']))
+            res.content_length = meta['length']
+            return res
+    else:
+        cached = cache.get(key)
+        if cached is not None:
+            meta, body = cached
+            res = HttpResponse(status=meta['status'], headerlist=list(meta['headers']))
+            res.body = body
+            return res
+
+    res = render()
+    if res.status_int != 200:
+        return res
+
+    def store(body):
+        meta = {'status': res.status,
+                'headers': [(k, v) for k, v in res.headerlist 
+                            if k.lower() != 'content-length'],
+                'length': len(body)}
+        cache.set(key, meta, body)
+    max_item = request.context.config.get('web.response_cache_max_item', 
+                                          DEFAULT_RESPONSE_CACHE_MAX_ITEM)
+    res.app_iter = _tee(res.app_iter, store, max_item)
+    return res
+
+def _tee(app_iter, store, max_size):
+    """
+    passes along the chunks of app_iter, calling store with 
+    the complete body if it was sent in full and is no larger 
+    than max_size.
+    """
+    chunks = []
+    size = 0
+    try:
+        for chunk in app_iter:
+            if chunks is not None:
+                size += len(chunk)
+                if size > max_size:
+                    chunks = None
+                else:
+                    chunks.append(chunk)
+            yield chunk
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+    if chunks is not None:
+        store(''.join(chunks))
+
+#############################
+#
+# Rendered fragment cache
+#
+#############################
+
+DEFAULT_FRAGMENT_CACHE_SIZE = 16*1024*1024
+
+_fragment_caches = {}
+_fragment_caches_lock = threading.Lock()
+
+def get_fragment_cache(config):
+    """
+    get the cache of rendered message fragments or None 
+    if web.fragment_cache_size is 0
+    """
+    size = config.get('web.fragment_cache_size', DEFAULT_FRAGMENT_CACHE_SIZE)
+    if size <= 0:
+        return None
+    cache = _fragment_caches.get(size)
+    if cache is None:
+        with _fragment_caches_lock:
+            cache = _fragment_caches.get(size)
+            if cache is None:
+                cache = LRUCache(size)
+                _fragment_caches[size] = cache
+    return cache
+
+def cached_fragment(request, message, renderer, render_entry):
+    """
+    wraps render_entry, a zero argument callable produced by 
+    renderer for message, so that its output is cached using 
+    the message's id and revision.  
+
+    render_entry may set the attribute 'version' to identify
+    the version of whatever it renders with, eg. using 
+    template_version, or set 'cacheable' to False if its 
+    output depends on more than the message.
+    """
+    cache = get_fragment_cache(request.context.config)
+    if (cache is None or not message.rev or
+        getattr(render_entry, 'cacheable', True) == False):
+        return render_entry
+
+    key = '%s.%s:%s:%s:%s' % (renderer.__module__, renderer.__name__, 
+                              getattr(render_entry, 'version', ''),
+                              message.id, message.rev)
+    def render():
+        cached = cache.get(key)
+        if cached is not None:
+            return cached[1]
+        text = render_entry()
+        cache.set(key, None, text)
+        return text
+    return render
+
+def template_version(template):
+    """
+    a string identifying the source of a template, changes 
+    when the template is reloaded with a different source.
+    """
+    # worked out once per compiled template.
+    version = getattr(template, '_radar_version', None)
+    if version is None:
+        env = template.environment
+        source = env.loader.get_source(env, template.name)[0]
+        version = '%s@%s' % (template.name, 
+                             md5(source.encode('utf-8')).hexdigest())
+        template._radar_version = version
+    return version
 
 def check_etag(request, etag):
     """
@@ -477,7 +722,7 @@ def get_couchdb_server(config):
     """
     get a connection to the configured couchdb server. 
     """
-    return Server(config['couchdb.address'])
+    return couch.get_server(config)
 
 def get_database_name(config, mailbox_slug):
     """
@@ -522,7 +767,20 @@ def get_mailbox_db_prefix(config):
 def iter_mailboxes(config, couchdb=None):
     if couchdb is None:
         couchdb = get_couchdb_server(config)
-    return _iter_mailboxes(couchdb, prefix=get_mailbox_db_prefix(config))
+    return _iter_mailboxes(couchdb, prefix=get_mailbox_db_prefix(config),
+                           registry=get_mailbox_registry(config, couchdb=couchdb))
+
+def get_mailbox_registry(config, couchdb=None):
+    """
+    get the database listing all mailboxes or None if
+    no registry is configured.
+    """
+    name = config.get('couchdb.registry_database')
+    if not name:
+        return None
+    if couchdb is None:
+        couchdb = get_couchdb_server(config)
+    return _get_registry(couchdb, name)
 
 def get_users_database(config, couchdb = None):
     if couchdb is None:
@@ -2,9 +2,11 @@ from operator import attrgetter
 from urllib import quote_plus
 from webob import Response as HttpResponse
 from radarpost.mailbox import MailboxInfo, Subscription, Message, MailboxInfo
+from radarpost.mailbox import list_registrations, open_mailbox
 from radarpost.user import PERM_CREATE, PERM_READ, PERM_UPDATE, PERM_DELETE
 from radarpost.user import PERM_CREATE_MAILBOX
 from radarpost.web.context import TemplateContext, render_to_response
+from radarpost.web.context import cached_response, cached_fragment, template_version
 from radarpost import plugins
 from radarpost.plugins import plugin
 
@@ -68,13 +70,22 @@ def front_page(request):
 
 def list_mailboxes(request):
     ctx = request.context
+    couchdb = ctx.get_couchdb_server()
+    registry = ctx.get_mailbox_registry(couchdb)
+    if registry is not None:
+        # everything needed is in the registry.
+        listing = [(open_mailbox(couchdb, reg.db_name), reg) 
+                   for reg in list_registrations(couchdb, registry, 
+                                                 prefix=ctx.get_mailbox_db_prefix())]
+    else:
+        listing = [(mb, MailboxInfo.get(mb)) for mb in ctx.iter_mailboxes(couchdb)]
+
     mailboxes = []
-    for mb in ctx.iter_mailboxes():
+    for mb, info in listing:
         if not ctx.user.has_perm(PERM_READ, mb): 
             continue
 
         slug = ctx.get_mailbox_slug(mb.name)
-        info = MailboxInfo.get(mb)
         mailboxes.append({
             'slug': slug,
             'title': info.title or 'Untitled',
@@ -106,6 +117,13 @@ def view_mailbox_latest(request, mailbox_slug):
     if not ctx.user.has_perm(PERM_READ, mb):
         return handle_unauth(request)
 
+    # the page shows who is logged in as well as the contents of the mailbox.
+    key = 'hatom:%s:%s:%s' % (ctx.get_mailbox_etag(mb), getattr(ctx.user, 'id', ''), 
+                              request.path_qs)
+    return cached_response(request, key, 
+                           lambda: _render_mailbox_latest(request, mb))
+
+def _render_mailbox_latest(request, mb):
     start = request.GET.get('start', None)
     limit = 10
     params = {'limit': limit + 1, 
@@ -166,7 +184,7 @@ def _get_hatom_renderer(message, request):
     for renderer in plugins.get(HATOM_RENDERER_PLUGIN):
         r = renderer(message, request)
         if r is not None:
-            return r
+            return cached_fragment(request, message, renderer, r)
     return None
 
 
@@ -179,6 +197,7 @@ def _render_hatom_from_type_template(message, request):
     def render_entry():
         return template.render(TemplateContext(request, 
                                {'message': message}))
+    render_entry.version = template_version(template)
     return render_entry
 
 def _hatom_type_template(message, request, force_type=None):
@@ -2,12 +2,12 @@ from couchdb import Server, PreconditionFailed
 import json
 from routes.util import URLGenerator
 from unittest import TestCase
-from radarpost.mailbox import create_mailbox as _create_mailbox
+from radarpost.mailbox import create_mailbox as _create_mailbox, unregister_mailbox
 from radarpost.user import User, ROLE_ADMIN
 from radarpost.tests.helpers import load_test_config
 from radarpost.web.context import build_routes
 from radarpost.web.context import get_couchdb_server, get_database_name
-from radarpost.web.context import get_mailbox
+from radarpost.web.context import get_mailbox, get_mailbox_registry
 
 __all__ = ['RadarTestCase']
 
@@ -52,6 +52,9 @@ class RadarTestCase(TestCase):
         dbname = get_database_name(self.config, self.TEST_MAILBOX_SLUG)
         if dbname in couchdb:
             del couchdb[dbname]
+        registry = get_mailbox_registry(self.config, couchdb=couchdb)
+        if registry is not None:
+            unregister_mailbox(registry, dbname)
 
     def url_for(self, *args, **kw):
         return self.url_gen(*args, **kw)
@@ -75,4 +78,214 @@ class RadarTestCase(TestCase):
         return get_mailbox(self.config, slug)
 
     def get_users_database(self):
-        return self._users_db
\ No newline at end of file
+        return self._users_db
+class _CountingDatabase(object):
+    """
+    stands in for a mailbox, counts requests for its info
+    """
+    def __init__(self, name):
+        self.name = name
+        self.update_seq = 1
+        self.info_requests = 0
+
+    def info(self):
+        self.info_requests += 1
+        return {'update_seq': self.update_seq}
+
+def test_change_watcher():
+    """
+    check that update_seq is remembered while the watcher is 
+    fresh, forgotten when the database changes and that the 
+    database is asked every time while the watcher is stale.
+    """
+    import time
+    from radarpost.web.changes import ChangeWatcher
+    from radarpost.web.context import get_mailbox_etag
+
+    watcher = ChangeWatcher('http://localhost:5984')
+    db = _CountingDatabase('rp_test_changes')
+
+    # never heard from the feed, the database is asked every time
+    assert not watcher.is_fresh
+    etag = get_mailbox_etag(db, watcher=watcher)
+    assert get_mailbox_etag(db, watcher=watcher) == etag
+    assert db.info_requests == 2
+
+    # fresh, the seq is remembered
+    watcher._last_heard = time.time()
+    get_mailbox_etag(db, watcher=watcher)
+    assert get_mailbox_etag(db, watcher=watcher) == etag
+    assert db.info_requests == 3
+
+    # a change is reported, the seq is asked for again
+    db.update_seq = 2
+    watcher._changed(db.name)
+    changed_etag = get_mailbox_etag(db, watcher=watcher)
+    assert changed_etag != etag
+    assert get_mailbox_etag(db, watcher=watcher) == changed_etag
+    assert db.info_requests == 4
+
+    # the feed was lost, back to asking every time
+    watcher._forget_all()
+    db.update_seq = 3
+    assert get_mailbox_etag(db, watcher=watcher) != changed_etag
+    get_mailbox_etag(db, watcher=watcher)
+    assert db.info_requests == 6
+
+    # heard from again much too long ago
+    watcher._last_heard = time.time() - watcher.timeout * 3
+    get_mailbox_etag(db, watcher=watcher)
+    assert db.info_requests == 7
+
+def test_change_watcher_feed():
+    """
+    follow fake _db_updates feeds, check that the watcher is 
+    only fresh once it has heard from a feed that can resume, 
+    that reported changes are forgotten and that it gives up 
+    on a feed that cannot resume.
+    """
+    from radarpost.web.changes import ChangeWatcher
+
+    class FakeResource(object):
+        def __init__(self, watcher, responses):
+            self.watcher = watcher
+            self.responses = responses
+            self.requests = []
+        def get_json(self, path, **params):
+            self.requests.append((params['since'], self.watcher.is_fresh, 
+                                  sorted(self.watcher._seqs.keys())))
+            response = self.responses.pop(0)
+            if not self.responses:
+                self.watcher.stop()
+            return 200, {}, response
+
+    # couchdb 2.x and later
+    watcher = ChangeWatcher('http://localhost:5984')
+    watcher._seqs = {'rp_test_changes': 10, 'rp_test_other': 20}
+    watcher.server.resource = FakeResource(watcher, 
+        [{'results': [], 'last_seq': '1-a'},
+         {'results': [{'db_name': 'rp_test_changes', 'type': 'updated'}], 
+          'last_seq': '2-b'},
+         {'results': [], 'last_seq': '2-b'}])
+    watcher._run()
+    assert watcher.server.resource.requests == [
+        ('now', False, ['rp_test_changes', 'rp_test_other']),
+        ('1-a', True, ['rp_test_changes', 'rp_test_other']),
+        ('2-b', True, ['rp_test_other'])]
+    # stopping forgets everything
+    assert not watcher.is_fresh
+    assert watcher._seqs == {}
+
+    # couchdb 1.x, cannot resume
+    watcher = ChangeWatcher('http://localhost:5984')
+    watcher.server.resource = FakeResource(watcher, 
+        [{'db_name': 'rp_test_changes', 'type': 'updated'}, 
+         {'db_name': 'rp_test_changes', 'type': 'updated'}])
+    watcher._run()
+    assert len(watcher.server.resource.requests) == 1
+    assert not watcher.is_fresh
+
+def test_template_env():
+    """
+    get the template environment twice for the same config,
+    check that it is shared, that it differs for another 
+    config and that the bytecode cache directory is created
+    and filled when a template is compiled.
+    """
+    import os
+    import shutil
+    import tempfile
+    # parses web.apps
+    import radarpost.web.app
+    from radarpost.web.context import get_template_env
+
+    tmp = tempfile.mkdtemp()
+    try:
+        cache_dir = os.path.join(tmp, 'templates')
+        config = load_test_config()
+        config['web.template_bytecode_cache'] = cache_dir
+
+        env = get_template_env(config)
+        assert os.path.isdir(cache_dir)
+        assert get_template_env(dict(config)) is env
+        assert get_template_env(load_test_config()) is not env
+
+        env.get_template('radar/atom/atom.xml')
+        assert len(os.listdir(cache_dir)) == 1
+    finally:
+        shutil.rmtree(tmp)
+
+def test_cached_fragment():
+    """
+    render a fragment twice, check that the second time is
+    served from the cache and that a new revision of the 
+    message or a change to its template renders it again.
+    """
+    import os
+    import shutil
+    import tempfile
+    import time
+    from jinja2 import Environment, FileSystemLoader
+    from radarpost.web.context import cached_fragment, template_version
+
+    class FakeContext(object):
+        config = {'web.fragment_cache_size': 4096}
+    class FakeRequest(object):
+        context = FakeContext()
+    class FakeMessage(object):
+        def __init__(self, id, rev):
+            self.id = id
+            self.rev = rev
+
+    tmp = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp, 'entry.html')
+        def write_template(text):
+            f = open(filename, 'w')
+            f.write(text)
+            f.close()
+        write_template('{{ message.id }}@{{ message.rev }}')
+        env = Environment(loader=FileSystemLoader(tmp), auto_reload=True)
+
+        renders = []
+        def renderer(message, request):
+            template = env.get_template('entry.html')
+            def render_entry():
+                renders.append(message.rev)
+                return template.render(message=message)
+            render_entry.version = template_version(template)
+            return render_entry
+        def render(message):
+            request = FakeRequest()
+            return cached_fragment(request, message, renderer, 
+                                   renderer(message, request))()
+
+        message = FakeMessage('rp_test_fragment', '1-a')
+        assert render(message) == 'rp_test_fragment@1-a'
+        assert render(message) == 'rp_test_fragment@1-a'
+        assert renders == ['1-a']
+
+        # a new revision of the message
+        message = FakeMessage('rp_test_fragment', '2-b')
+        assert render(message) == 'rp_test_fragment@2-b'
+        assert render(message) == 'rp_test_fragment@2-b'
+        assert renders == ['1-a', '2-b']
+
+        # the template changes, the same source 
+        # reloaded keeps its version.
+        template = env.get_template('entry.html')
+        version = template_version(template)
+        write_template('{{ message.id }}@{{ message.rev }}')
+        mtime = time.time() + 10
+        os.utime(filename, (mtime, mtime))
+        reloaded = env.get_template('entry.html')
+        assert reloaded is not template
+        assert template_version(reloaded) == version
+
+        write_template('<p>{{ message.id }}@{{ message.rev }}</p>')
+        os.utime(filename, (mtime + 10, mtime + 10))
+        assert render(message) == '<p>rp_test_fragment@2-b</p>'
+        assert render(message) == '<p>rp_test_fragment@2-b</p>'
+        assert renders == ['1-a', '2-b', '2-b']
+    finally:
+        shutil.rmtree(tmp)